@@ -0,0 +1,276 @@
+import os
+import json
+import shutil
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+from itertools import chain
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+class Csr_rows(Mapping):
+    """read only {row_id: {key: value}} view over CSR arrays
+
+       rows are only turned into dicts when accessed, so a loaded
+       artifact costs no python objects until it is used
+    """
+    def __init__(self, ids, order, indptr, indices, data):
+        self.ids = ids
+        # ids[order] is sorted, for binary search lookups
+        self.order = order
+        self.sorted_ids = ids[order]
+        self.indptr = indptr
+        self.indices = indices
+        # not values, which would hide Mapping.values()
+        self.data = data
+
+    def position(self, row_id):
+        i = np.searchsorted(self.sorted_ids, row_id)
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == row_id:
+            return self.order[i]
+        raise KeyError(row_id)
+
+    def row(self, position):
+        start, end = self.indptr[position], self.indptr[position+1]
+        return dict(zip(self.indices[start:end].tolist(),
+                        self.data[start:end].tolist()))
+
+    def top(self, row_id, k):
+        """first k (key, value) pairs of a row, rows written with
+           sort_desc=True are ordered by decreasing value
+        """
+        position = self.position(row_id)
+        start, end = self.indptr[position], self.indptr[position+1]
+        end = min(end, start+k)
+        return list(zip(self.indices[start:end].tolist(),
+                        self.data[start:end].tolist()))
+
+    def __getitem__(self, row_id):
+        return self.row(self.position(row_id))
+
+    def __contains__(self, row_id):
+        try:
+            self.position(row_id)
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class Object_rows(Csr_rows):
+    """read only {id: object} view, e.g. {user_id: User}, every
+       dict attribute of the objects is one CSR field
+
+       an object is built on its first access and kept, hot users
+       and items (e.g. the neighbours of UserCF) are read from the
+       arrays once, at most max_cached objects are kept
+    """
+    max_cached = 2**17
+
+    def __init__(self, cls, ids, order, fields, scalars):
+        self.cls = cls
+        self.ids = ids
+        self.order = order
+        self.sorted_ids = ids[order]
+        self.fields = fields
+        self.scalars = scalars
+        # least recently used first
+        self.cached = OrderedDict()
+
+    def lengths(self, attr):
+        """length of the dict attribute of every object, ids order"""
+        return np.diff(self.fields[attr][0])
+
+    def __getitem__(self, obj_id):
+        try:
+            obj = self.cached[obj_id]
+            self.cached.move_to_end(obj_id)
+            return obj
+        except KeyError:
+            pass
+        obj = self.build(self.position(obj_id))
+        self.cached[obj_id] = obj
+        if len(self.cached) > self.max_cached:
+            self.cached.popitem(last=False)
+        return obj
+
+    def build(self, position):
+        obj = self.cls(self.ids[position].item())
+        for attr, (indptr, indices, values) in self.fields.items():
+            start, end = indptr[position], indptr[position+1]
+            setattr(obj, attr, dict(zip(indices[start:end].tolist(),
+                                        values[start:end].tolist())))
+        for attr, values in self.scalars.items():
+            setattr(obj, attr, values[position].item())
+        return obj
+
+
+class Edited_rows(MutableMapping):
+    """writable {id: object} view over loaded Object_rows
+
+       objects set, or taken with edit to be changed in place, are kept
+       in a dict, all the others are still read from the arrays, so
+       folding a batch of events into loaded histories costs O(batch)
+       instead of building every object
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.edited = {}
+        # ids not in rows, in insertion order
+        self.new_ids = []
+
+    def edit(self, obj_id):
+        """the object of obj_id, kept so changes to it are not lost
+           when rows drops its cached objects
+        """
+        try:
+            return self.edited[obj_id]
+        except KeyError:
+            pass
+        obj = self.rows[obj_id]
+        self.edited[obj_id] = obj
+        return obj
+
+    def __getitem__(self, obj_id):
+        try:
+            return self.edited[obj_id]
+        except KeyError:
+            return self.rows[obj_id]
+
+    def __setitem__(self, obj_id, obj):
+        if obj_id not in self:
+            self.new_ids.append(obj_id)
+        self.edited[obj_id] = obj
+
+    def __delitem__(self, obj_id):
+        raise TypeError("histories are append only")
+
+    def __contains__(self, obj_id):
+        return obj_id in self.edited or obj_id in self.rows
+
+    def __iter__(self):
+        return chain(self.rows, self.new_ids)
+
+    def __len__(self):
+        return len(self.rows)+len(self.new_ids)
+
+
+class Artifact:
+    """a saved model part: a directory of .npy arrays and a manifest
+
+       arrays are loaded with mmap_mode='r', loading takes
+       milliseconds whatever the size and forked workers share the
+       pages through the page cache, directories are written aside
+       and renamed into place so readers never see a partial artifact
+    """
+    @staticmethod
+    def to_array(values, dtype=None):
+        values = list(values)
+        if dtype is not None:
+            return np.array(values, dtype=dtype)
+        if values and isinstance(values[0], str):
+            return np.array(values, dtype=str)
+        if values and isinstance(values[0], (float, np.floating)):
+            return np.array(values, dtype=np.float64)
+        return np.array(values, dtype=np.int64)
+
+    @staticmethod
+    def pack_ids(arrays, prefix, ids):
+        ids = Artifact.to_array(ids)
+        arrays[prefix+"_ids"] = ids
+        arrays[prefix+"_order"] = np.argsort(ids, kind="stable")
+
+    @staticmethod
+    def pack_field(arrays, name, rows, value_dtype=None, sort_desc=False):
+        """rows is a list of dicts, all of them go to one CSR field"""
+        if sort_desc:
+            # ties by increasing key, as Sim_build.sorted_rows
+            rows = [dict(sorted(row.items(), key=lambda item: (-item[1], item[0])))
+                    for row in rows]
+        lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+        arrays[name+"_indptr"] = np.r_[0, np.cumsum(lengths)]
+        arrays[name+"_indices"] = Artifact.to_array(chain.from_iterable(row.keys() for row in rows))  # noqa
+        arrays[name+"_values"] = Artifact.to_array(chain.from_iterable(row.values() for row in rows),  # noqa
+                                                   value_dtype)
+
+    @staticmethod
+    def pack_rows(arrays, prefix, rows, value_dtype=None, sort_desc=False):
+        """{row_id: {key: value}} -> CSR arrays, see Csr_rows"""
+        Artifact.pack_ids(arrays, prefix, rows.keys())
+        Artifact.pack_field(arrays, prefix, [rows[row_id] for row_id in rows],
+                            value_dtype, sort_desc)
+        return arrays
+
+    @staticmethod
+    def pack_objects(arrays, prefix, objects, fields, scalars=()):
+        """{id: object} -> ids plus one CSR field per dict attribute
+           and one array per scalar attribute, see Object_rows
+        """
+        Artifact.pack_ids(arrays, prefix, objects.keys())
+        objects = [objects[obj_id] for obj_id in objects]
+        for attr in fields:
+            Artifact.pack_field(arrays, "{}_{}".format(prefix, attr),
+                                [getattr(obj, attr) for obj in objects])
+        for attr in scalars:
+            arrays["{}_{}".format(prefix, attr)] = Artifact.to_array(getattr(obj, attr) for obj in objects)  # noqa
+        return {"fields": list(fields), "scalars": list(scalars)}
+
+    @staticmethod
+    def rows(arrays, prefix):
+        return Csr_rows(arrays[prefix+"_ids"], arrays[prefix+"_order"],
+                        arrays[prefix+"_indptr"], arrays[prefix+"_indices"],
+                        arrays[prefix+"_values"])
+
+    @staticmethod
+    def objects(arrays, meta, prefix, cls):
+        fields = {attr: tuple(arrays["{}_{}_{}".format(prefix, attr, part)]
+                              for part in ("indptr", "indices", "values"))
+                  for attr in meta[prefix]["fields"]}
+        scalars = {attr: arrays["{}_{}".format(prefix, attr)]
+                   for attr in meta[prefix]["scalars"]}
+        return Object_rows(cls, arrays[prefix+"_ids"], arrays[prefix+"_order"],
+                           fields, scalars)
+
+    @staticmethod
+    def write(path, arrays, meta=None):
+        """write arrays into the directory path atomically, an existing
+           artifact at path is kept
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = "{}.tmp-{}".format(path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        manifest = {"version": FORMAT_VERSION, "meta": meta or {}, "arrays": {}}
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name+".npy"), array, allow_pickle=False)
+            manifest["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape)}
+        # the manifest is written last, a directory without it is incomplete
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=1)
+        try:
+            # fails on an existing non empty directory
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @staticmethod
+    def read(path, mmap_mode="r"):
+        """return ({name: array}, meta), raise FileNotFoundError if
+           there is no complete artifact at path
+        """
+        with open(os.path.join(path, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        if manifest["version"] != FORMAT_VERSION:
+            raise FileNotFoundError("Artifact {} has format version {}, expected {}".format(
+                path, manifest["version"], FORMAT_VERSION))
+        arrays = {name: np.load(os.path.join(path, name+".npy"), mmap_mode=mmap_mode,
+                                allow_pickle=False)
+                  for name in manifest["arrays"]}
+        return arrays, manifest["meta"]
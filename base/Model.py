@@ -1,12 +1,28 @@
 import pandas as pd
-import pickle
+import numpy as np
 import os
+import heapq
+from operator import itemgetter
 from .User import User
 from .Item import Item
 from .Tag import Tag
+from .Artifact import Artifact, Object_rows, Edited_rows
+from utils.Metrics import Metrics
+from utils.Instrument import Instrument
+from utils.Cache import Cache
+
+# fixed current time of the time context scores of ItemCF and UserCF
+T_NOW = 1146454548
 
 
 class Model:
+    # where all models save and look for their trained files
+    saved_models_dir = 'models/saved_models'
+    # users and items histories only depend on these columns
+    history_columns = ['visitorid', 'itemid', 'timestamp', 'tagid']
+    # append-only event logs of partial_fit, outside the evicted cache
+    event_logs_dir = 'models/event_logs'
+
     def __init__(self, n, model_type, data_type, ensure_new=True):
         """base class for all recommendation models
 
@@ -21,7 +37,13 @@ class Model:
         self.model_type = model_type
         self.data_type = data_type
         self.name = '{}_{}'.format(data_type, model_type)
+        # saved files are named by training parameters only, so models
+        # differing only in serving parameters (n, k) share them
+        self.artifact_name = self.name
         self.ensure_new = ensure_new
+        self.cache = Cache(self.saved_models_dir)
+        # make_recommendation results of recommend, cleared by partial_fit
+        self.recommendations = {}
 
     @staticmethod
     def time_elapse(t1, t2, alpha=0.5):
@@ -116,30 +138,379 @@ class Model:
            self.users -> {user_id:user_object}
            self.item -> {item_id:item_object}
         """
+        # saved files are keyed by the training data content, changed
+        # data is never served a stale model
+        self.tag = tag
+        self.data_key = Cache.fingerprint(train_data, self.history_columns)
+        # events folded in by partial_fit are logged per fitted model
+        self.log_key = Cache.key(self.data_key, self.artifact_name)
         try:
             self.load()
             return 1
         except OSError as E:
             print(E)
             print("[{}] Previous trained model not found, start forming history info...".format(self.name))
+        try:
+            # histories saved by other models fitted on the same events,
+            # as dicts since the training stages access them heavily
+            Model.load(self)
+            self.users, self.items = dict(self.users.items()), dict(self.items.items())
+            if tag:
+                self.tags = dict(self.tags.items())
+            return
+        except OSError:
+            pass
         print("[{}] Init user and item objects...".format(self.name))
-        if tag:
-            self.items, self.users, self.tags = self.init_item_and_user_objects(train_data, tag)
-        else:
-            self.items, self.users = self.init_item_and_user_objects(train_data)
+        with Instrument.stage("init_objects"):
+            if tag:
+                self.items, self.users, self.tags = self.init_item_and_user_objects(train_data, tag)
+            else:
+                self.items, self.users = self.init_item_and_user_objects(train_data)
         print("[{}] Init done!".format(self.name))
 
+    @staticmethod
+    def edit_obj(objects, obj_id):
+        """object of obj_id to be changed in place"""
+        if isinstance(objects, Edited_rows):
+            return objects.edit(obj_id)
+        return objects[obj_id]
+
+    def update_history(self, events):
+        """fold new events into the users and items histories, loaded
+           (read only) histories are wrapped in Edited_rows first, only
+           the objects of the batch are built, O(batch)
+        """
+        if isinstance(self.users, Object_rows):
+            self.users, self.items = Edited_rows(self.users), Edited_rows(self.items)
+        new_items, new_users = self.init_item_and_user_objects(events)
+        for objects, new_objects, attr in ((self.items, new_items, "covered_users"),
+                                           (self.users, new_users, "covered_items")):
+            for obj_id, obj in new_objects.items():
+                try:
+                    covered = getattr(self.edit_obj(objects, obj_id), attr)
+                except KeyError:
+                    objects[obj_id] = obj
+                    continue
+                for other_id, timestamp in getattr(obj, attr).items():
+                    Model.update_obj(covered, other_id, timestamp)
+        # saved files of the updated histories
+        self.data_key = Cache.key(self.data_key, Cache.fingerprint(events, self.history_columns))
+
+    def init_state(self):
+        """hook of subclasses deriving their own state from the
+           histories, called after fit and after restoring a snapshot
+        """
+        pass
+
+    def partial_update(self, events):
+        """hook of subclasses folding a batch of new events into their
+           own state, histories are already updated
+        """
+        pass
+
+    def event_log(self):
+        # imported here, utils.Data_util imports this module
+        from utils.Event_log import Event_log
+        return Event_log(os.path.join(self.event_logs_dir, "log-{}".format(self.log_key)))
+
+    def partial_fit(self, events, snapshot=False):
+        """fold a batch of new events into the fitted model in
+           O(batch): the batch is appended to the event log, then
+           histories (latest timestamps, new ids) and subclass state
+           are updated and cached recommendations are invalidated;
+           the first call of a process first catches up with the log
+
+        Parameters
+        ----------
+        events : [pd.DataFrame]
+            [new events, same columns as the training events]
+        snapshot : [bool]
+            [save the state afterwards, see snapshot]
+
+        Returns
+        -------
+        [int]
+            [sequence number of the batch in the event log]
+        """
+        if not hasattr(self, "log_seq"):
+            self.restore()
+        self.log_seq = self.event_log().append(events)
+        self.apply_events(events)
+        if snapshot:
+            self.snapshot()
+        return self.log_seq
+
+    def apply_events(self, events):
+        self.update_history(events)
+        self.partial_update(events)
+        self.recommendations.clear()
+
+    def snapshot(self):
+        """save the current state, a fresh process restores it and
+           replays only the batches logged after it
+        """
+        self.save()
+        self.event_log().write_snapshot(self.log_seq, self.data_key)
+        print("[{}] Snapshot saved at batch {}".format(self.name, self.log_seq))
+
+    def restore(self):
+        """after fit on the original events: load the last snapshot of
+           the event log, if any, and replay the batches logged after it;
+           if the cache evicted the snapshot, the fitted model is loaded
+           back and the whole log is replayed
+
+        Returns
+        -------
+        [int]
+            [number of batches replayed]
+        """
+        log = self.event_log()
+        snapshot = log.read_snapshot()
+        self.log_seq = 0
+        if snapshot is not None:
+            fitted_key = self.data_key
+            try:
+                self.data_key = snapshot["data_key"]
+                self.load()
+                self.log_seq = snapshot["seq"]
+            except OSError as E:
+                print(E)
+                print("[{}] Snapshot at batch {} evicted, replaying the whole event log...".format(
+                    self.name, snapshot["seq"]))
+                Instrument.count("snapshots_evicted", model=self.model_type)
+                self.data_key = fitted_key
+                self.load()
+            self.init_state()
+        n_replayed = 0
+        for seq, events in log.batches(after=self.log_seq):
+            self.apply_events(events)
+            self.log_seq = seq
+            n_replayed += 1
+        print("[{}] Restored to batch {}, {} batches replayed".format(
+            self.name, self.log_seq, n_replayed))
+        return n_replayed
+
+    def recommend(self, user_id):
+        """make_recommendation, results are cached until the next
+           partial_fit
+        """
+        try:
+            return self.recommendations[user_id]
+        except KeyError:
+            pass
+        self.recommendations[user_id] = self.make_recommendation(user_id)
+        return self.recommendations[user_id]
+
+    @staticmethod
+    def most_similar(sim_matrix, obj_id, k):
+        """k most similar (id, sim) of one row of a sim matrix, ties
+           by increasing id, rows of a loaded matrix are stored sorted
+           so no sort is needed
+        """
+        if hasattr(sim_matrix, "top"):
+            return sim_matrix.top(obj_id, k)
+        return heapq.nsmallest(k, sim_matrix[obj_id].items(),
+                               key=lambda item: (-item[1], item[0]))
+
+    def items_popularity(self):
+        """{item_id: number of users who touched the item}"""
+        if hasattr(self.items, "lengths"):
+            return dict(zip(self.items.ids.tolist(),
+                            self.items.lengths("covered_users").tolist()))
+        return {item_id: len(item.covered_users) for item_id, item in self.items.items()}
+
+    def user_item_csr(self, times=False):
+        """users x items 0/1 matrix of the histories as CSR arrays
+
+        Parameters
+        ----------
+        times : [bool]
+            [also return the timestamp of every history entry]
+
+        Returns
+        -------
+        [tuple]
+            [(users_id, items_id, indptr, indices), row u is user
+             users_id[u], indices are positions in items_id, plus the
+             timestamps aligned with indices if times]
+        """
+        items_id = np.fromiter(self.items, dtype=np.int64, count=len(self.items))
+        if hasattr(self.users, "fields"):
+            # loaded histories are already CSR
+            indptr, history_items_id, history_times = self.users.fields["covered_items"]
+            users_id = np.asarray(self.users.ids)
+        else:
+            users_id = np.fromiter(self.users, dtype=np.int64, count=len(self.users))
+            lengths = [len(user.covered_items) for user in self.users.values()]
+            indptr = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+            history_items_id = np.fromiter((item_id for user in self.users.values()
+                                            for item_id in user.covered_items),
+                                           dtype=np.int64, count=indptr[-1])
+            if times:
+                history_times = np.fromiter((time for user in self.users.values()
+                                             for time in user.covered_items.values()),
+                                            dtype=np.float64, count=indptr[-1])
+        order = np.argsort(items_id)
+        indices = order[np.searchsorted(items_id[order], history_items_id)]
+        if times:
+            return users_id, items_id, np.asarray(indptr), indices, np.asarray(history_times)
+        return users_id, items_id, np.asarray(indptr), indices
+
+    def history_matrix(self):
+        """users x items scipy CSR matrix of the histories, values are
+           the timestamps, built once per histories version
+
+        Returns
+        -------
+        [tuple]
+            [(users index, items_id, matrix), pd.Index of the row
+             users id and items id of the columns]
+        """
+        cached = getattr(self, "history_cache", None)
+        if cached is None or cached[0] != self.data_key:
+            # imported here, most models never build the matrix
+            from scipy import sparse
+            users_id, items_id, indptr, indices, times = self.user_item_csr(times=True)
+            matrix = sparse.csr_matrix((times.astype(np.float64), indices, indptr),
+                                       shape=(len(users_id), len(items_id)))
+            self.history_cache = cached = self.data_key, pd.Index(users_id), items_id, matrix
+        return cached[1:]
+
     def get_top_n_items(self, items_rank):
-        items_rank = sorted(items_rank.items(), key=lambda item: item[1],
-                            reverse=True)
-        items_id = [x[0] for x in items_rank]
+        items_id = self.get_ranked_items(items_rank, self.n)
         if len(items_id) < self.n:
             print("Number of ranked items is smaller than n:{}".format(self.n))
-        return set(items_id[:self.n])  # further lookup complexity is O(1)
+        return set(items_id)  # further lookup complexity is O(1)
+
+    @staticmethod
+    def get_ranked_items(items_rank, n):
+        """return the n highest scored items id, best first
+        """
+        items_rank = heapq.nlargest(n, items_rank.items(), key=itemgetter(1))
+        return [x[0] for x in items_rank]
+
+    def rank_items(self, user_id):
+        """score the potential items of one user,
+           return {item_id: score} or a negative int when
+           no recommendation can be made for this user
+        """
+        raise NotImplementedError
+
+    def score_items(self, user_id, items_id):
+        """scores of the items of items_id for one user as an array
+           aligned with items_id, NaN for the items the model does not
+           rank (e.g. touched or unknown), a negative int when no
+           recommendation can be made for this user, subclasses may
+           score the array directly instead of through rank_items
+        """
+        items_rank = self.rank_items(user_id)
+        if isinstance(items_rank, int):
+            return items_rank
+        scores = np.full(len(items_id), np.nan)
+        ranked_id = np.fromiter(items_rank.keys(), dtype=np.int64, count=len(items_rank))
+        positions = pd.Index(items_id).get_indexer(ranked_id)
+        found = positions >= 0
+        scores[positions[found]] = np.fromiter(items_rank.values(), dtype=np.float64,
+                                               count=len(items_rank))[found]
+        return scores
+
+    def score_users(self, users_id, items_id):
+        """scores of the items of items_id for many users at once, a
+           users x items array, NaN where score_items gives NaN and on
+           the rows of users that cannot be scored; subclasses may
+           score all the users with matrix products, by default every
+           user is scored by score_items
+        """
+        scores = np.full((len(users_id), len(items_id)), np.nan)
+        for row, user_id in enumerate(users_id):
+            user_scores = self.score_items(user_id, items_id)
+            if not isinstance(user_scores, int):
+                scores[row] = user_scores
+        return scores
+
+    @staticmethod
+    def sparse_scores(scores, scores_items_id, items_id, touched=None):
+        """users x items_id array of a scipy sparse users x
+           scores_items_id score matrix, NaN where no entry is stored
+           and where touched (same shape) has one
+        """
+        columns = pd.Index(scores_items_id).get_indexer(items_id)
+        known = columns >= 0
+        dense = np.full((scores.shape[0], len(scores_items_id)), np.nan)
+        scores = scores.tocoo()
+        dense[scores.row, scores.col] = scores.data
+        if touched is not None:
+            touched = touched.tocoo()
+            dense[touched.row, touched.col] = np.nan
+        aligned = np.full((scores.shape[0], len(items_id)), np.nan)
+        aligned[:, known] = dense[:, columns[known]]
+        return aligned
+
+    def prepare_users(self, users_id, max_n):
+        """hook of subclasses ranking many users at once, called by the
+           evaluations with all the users about to be ranked, before
+           make_recommendation / make_ranking of each of them
+        """
+        pass
+
+    def keep_items(self, items_id):
+        """drop the item side state of the items outside items_id, e.g.
+           in a serving shard (utils/Shard_serving.py), by default all
+           is kept, memory mapped state is only paged in for the items
+           scored
+        """
+        pass
+
+    @staticmethod
+    def is_param(value):
+        if isinstance(value, (list, tuple)):
+            return all(Model.is_param(item) for item in value)
+        return value is None or isinstance(value, (str, int, float, np.generic, np.dtype, Cache))
+
+    def shard_spec(self):
+        """copy of the model without its fitted or loaded state: the
+           parameters, the cache and its keys, small enough to be sent
+           to the serving shards, which load_shard their slice
+        """
+        spec = object.__new__(type(self))
+        spec.__dict__ = {name: value for name, value in self.__dict__.items()
+                         if self.is_param(value)}
+        spec.recommendations = {}
+        return spec
+
+    def load_shard(self, items_id):
+        """load the saved model of a shard_spec keeping the item side
+           state of items_id only, models holding their item side state
+           in memory override it to read their slice of the saved files
+        """
+        self.load()
+        self.init_state()
+        self.keep_items(items_id)
+
+    @Instrument.timed("make_recommendation_seconds")
+    def make_recommendation(self, user_id):
+        items_rank = self.rank_items(user_id)
+        if isinstance(items_rank, int):
+            return items_rank
+        Instrument.observe("candidates_scored", len(items_rank),
+                           Instrument.size_buckets, model=self.model_type)
+        return self.get_top_n_items(items_rank)
+
+    @Instrument.timed("make_ranking_seconds")
+    def make_ranking(self, user_id, max_n):
+        """ordered list of at most max_n recommended items id
+        """
+        items_rank = self.rank_items(user_id)
+        if isinstance(items_rank, int):
+            return items_rank
+        Instrument.observe("candidates_scored", len(items_rank),
+                           Instrument.size_buckets, model=self.model_type)
+        return self.get_ranked_items(items_rank, max_n)
 
     def valid_user(self, user_id):
         if user_id in self.users.keys():
             return True
+        Instrument.count("users_unseen", model=self.model_type)
         print("[{}] User {} not seen in the training set.".format(self.name, user_id))
         return False
 
@@ -160,11 +531,13 @@ class Model:
         real_items_id = pd.unique(user_data['itemid'])
         return real_items_id
 
+    @Instrument.staged("evaluate")
     def evaluate_recommendation(self, test_data):
         """compute average recall, precision and coverage upon test event data
         """
         print("[{}] Start evaluating model with test data...".format(self.name))  # noqa
         users_id = pd.unique(test_data['visitorid'])
+        self.prepare_users(users_id, self.n)
         recall = precision = n_valid_users = covered_users = fallout = 0
         n_items = len(self.items)
         covered_items = set()
@@ -173,6 +546,7 @@ class Model:
             reco_items_id = self.make_recommendation(user_id)
             if not isinstance(reco_items_id, set):
                 print('[{}] Cannot make recommendation for user {}'.format(self.name, user_id))  # noqa
+                Instrument.count("users_skipped", model=self.model_type)
                 continue
             n_TP = self.compute_n_hit(reco_items_id, real_items_id)
             n_FP = len(reco_items_id) - n_TP
@@ -194,27 +568,205 @@ class Model:
         print('[{}] Recall:{}, Precision:{}, Coverage:{}'.format(self.name, recall, precision, coverage))
         return {'recall': recall, 'precision': precision, 'fallout': fallout, 'coverage': coverage}
 
+    @Instrument.staged("evaluate")
+    def evaluate_ranking(self, test_data, max_n):
+        """rank items once per user up to max_n, then compute metrics
+           at every cutoff n in 1..max_n from the rank-hit matrix
+
+           returns a DataFrame indexed by n with recall, precision,
+           fallout, ndcg, map, mrr, hit_rate and coverage columns,
+           the partial AUC over all cutoffs is in its attrs
+        """
+        print("[{}] Start ranking evaluation with test data, max n: {}...".format(self.name, max_n))  # noqa
+        real_items = test_data.groupby('visitorid', sort=False)['itemid'].unique()
+        hits = np.zeros((len(real_items), max_n), dtype=bool)
+        n_real = np.zeros(len(real_items), dtype=np.int64)
+        n_reco = np.zeros(len(real_items), dtype=np.int64)
+        # best rank each item reached over all users, for coverage
+        items_best_rank = {}
+        n_valid_users = 0
+        self.prepare_users(real_items.index, max_n)
+        for user_id, real_items_id in real_items.items():
+            ranked_items_id = self.make_ranking(user_id, max_n)
+            if isinstance(ranked_items_id, int):
+                print('[{}] Cannot make recommendation for user {}'.format(self.name, user_id))  # noqa
+                Instrument.count("users_skipped", model=self.model_type)
+                continue
+            real_items_id = set(real_items_id)
+            for rank, item_id in enumerate(ranked_items_id):
+                if item_id in real_items_id:
+                    hits[n_valid_users, rank] = True
+                if rank < items_best_rank.get(item_id, max_n):
+                    items_best_rank[item_id] = rank
+            n_real[n_valid_users] = len(real_items_id)
+            n_reco[n_valid_users] = len(ranked_items_id)
+            n_valid_users += 1
+        result = Metrics.rank_hit_metrics(hits[:n_valid_users],
+                                          n_real[:n_valid_users],
+                                          n_reco[:n_valid_users],
+                                          len(self.items))
+        best_ranks = np.fromiter(items_best_rank.values(), dtype=np.int64,
+                                 count=len(items_best_rank))
+        covered = np.cumsum(np.bincount(best_ranks, minlength=max_n))
+        result["coverage"] = covered/len(self.items)
+        result.attrs["AUC"] = Metrics.partial_auc(result["fallout"], result["recall"])
+        print('[{}] Number of valid unique users: {}'.format(self.name, n_valid_users))
+        print('[{}] Total unique users in the test set: {}'.format(self.name, len(real_items)))
+        print('[{}] Recall@{}:{}, NDCG@{}:{}, partial AUC:{}'.format(
+            self.name, max_n, result["recall"].iloc[-1],
+            max_n, result["ndcg"].iloc[-1], result.attrs["AUC"]))
+        return result
+
+    def sampled_ranking(self, user_id, real_items_id, n, n_negatives, all_items_id, rng):
+        """(hits, n_real, n_reco) of one user for evaluate_sampled, the
+           real items are ranked against the whole catalog, or against
+           n_negatives random untouched items when given
+        """
+        if n_negatives is None:
+            ranked_items_id = self.make_ranking(user_id, n)
+            if isinstance(ranked_items_id, int):
+                return ranked_items_id
+            real_items_id = set(real_items_id)
+            return ([item_id in real_items_id for item_id in ranked_items_id],
+                    len(real_items_id), len(ranked_items_id))
+        real_items_id = np.asarray(real_items_id)[np.isin(real_items_id, all_items_id)]
+        if len(real_items_id) == 0:
+            return -1
+        # negatives drawn among the items neither touched nor real
+        excluded = np.r_[np.fromiter(self.users[user_id].covered_items, dtype=np.int64), real_items_id]
+        pool = rng.choice(all_items_id, replace=False,
+                          size=min(len(all_items_id), n_negatives+len(excluded)))
+        negatives = pool[~np.isin(pool, excluded)][:n_negatives]
+        candidates = np.r_[real_items_id, negatives]
+        scores = self.score_items(user_id, candidates)
+        if isinstance(scores, int):
+            return scores
+        scores = np.nan_to_num(scores, nan=-np.inf)
+        # ties broken at random, real items are first in candidates
+        ranked = np.lexsort((rng.random(len(candidates)), -scores))[:n]
+        return ranked < len(real_items_id), len(real_items_id), len(ranked)
+
+    @Instrument.staged("evaluate")
+    def evaluate_sampled(self, test_data, n, n_negatives=None, n_strata=4, max_users=None,
+                         batch_size=100, metric="recall", tolerance=0.01, confidence=0.95,
+                         n_bootstrap=1000, seed=100):
+        """metrics at n estimated on a random subset of the test users,
+           stratified by history length, with bootstrap confidence
+           intervals; users are evaluated by rounds of batch_size, each
+           stratum in proportion to its size, until the interval of
+           metric is narrower than 2*tolerance or max_users is reached
+
+        Parameters
+        ----------
+        n_negatives : [int]
+            [rank the real items of a user against that many random
+             untouched items (Model.score_items) instead of the whole
+             catalog, much faster for LFM and Wide&Deep, but sampled
+             metrics are higher than full ranking ones, only compare
+             them with each other]
+        n_strata : [int]
+            [number of history length quantile strata]
+        max_users : [int]
+            [evaluated users at most, all test users by default]
+        metric, tolerance : [str, float]
+            [early stop once the half width of the interval of metric
+             is at most tolerance]
+
+        Returns
+        -------
+        [pd.DataFrame]
+            [estimate, low and high of recall, precision, ndcg, map,
+             mrr and hit_rate at n, number of evaluated users and
+             whether it stopped early in attrs]
+        """
+        print("[{}] Start sampled evaluation with test data, n: {}...".format(self.name, n))  # noqa
+        rng = np.random.default_rng(seed)
+        real_items = test_data.groupby('visitorid', sort=False)['itemid'].unique()
+        real_items = real_items[[user_id in self.users for user_id in real_items.index.tolist()]]
+        lengths = np.array([len(self.users[user_id].covered_items) for user_id in real_items.index.tolist()])  # noqa
+        edges = np.quantile(lengths, np.linspace(0, 1, n_strata+1)[1:-1]) if len(lengths) else []
+        strata = np.searchsorted(edges, lengths, side="right")
+        # users of every stratum in random order
+        queues = [rng.permutation(np.flatnonzero(strata == h)).tolist() for h in range(n_strata)]
+        weights = np.array([len(queue) for queue in queues], dtype=np.float64)
+        all_items_id = np.fromiter(self.items, dtype=np.int64, count=len(self.items))
+        names = ["recall", "precision", "ndcg", "map", "mrr", "hit_rate"]
+        values = [np.zeros((0, len(names))) for _ in range(n_strata)]
+        max_users = min(max_users or len(real_items), len(real_items))
+        n_evaluated, early_stop = 0, False
+        estimate = low = high = np.full(len(names), np.nan)
+        while n_evaluated < max_users and any(queues):
+            for h, queue in enumerate(queues):
+                n_take = min(int(np.ceil(batch_size*weights[h]/weights.sum())),
+                             max_users-n_evaluated)
+                rows = []
+                for position in queue[:n_take]:
+                    user_id = real_items.index[position]
+                    ranking = self.sampled_ranking(user_id, real_items.iloc[position], n,
+                                                   n_negatives, all_items_id, rng)
+                    if isinstance(ranking, int):
+                        Instrument.count("users_skipped", model=self.model_type)
+                        continue
+                    hits = np.zeros((1, n), dtype=bool)
+                    hits[0, :len(ranking[0])] = ranking[0]
+                    metrics = Metrics.user_metrics(hits, [ranking[1]], [ranking[2]], len(self.items))
+                    rows.append([metrics[name][0, -1] for name in names])
+                del queue[:n_take]
+                # skipped users are not evaluated
+                n_evaluated += len(rows)
+                if rows:
+                    values[h] = np.r_[values[h], np.array(rows)]
+            if not any(len(stratum) for stratum in values):
+                continue
+            estimate, low, high = Metrics.stratified_bootstrap(values, weights, n_bootstrap,
+                                                               confidence, rng)
+            half_width = (high-low)[names.index(metric)]/2
+            if half_width <= tolerance and any(queues):
+                early_stop = True
+                break
+        result = pd.DataFrame({"estimate": estimate, "low": low, "high": high},
+                              index=pd.Index(names, name="metric"))
+        result.attrs.update(n_users=int(sum(len(stratum) for stratum in values)),
+                            n_test_users=len(real_items), early_stop=early_stop,
+                            n_negatives=n_negatives, confidence=confidence)
+        print("[{}] {}@{}: {:.4f} [{:.4f}, {:.4f}] from {} of {} users{}".format(
+            self.name, metric, n, result.loc[metric, "estimate"], result.loc[metric, "low"],
+            result.loc[metric, "high"], result.attrs["n_users"], len(real_items),
+            ", stopped early" if early_stop else ""))
+        return result
+
+    def artifact_path(self, part, *params):
+        """cache entry of one saved part, keyed by the training data
+           and params, artifact_name (training parameters) by default
+        """
+        params = params or (self.artifact_name,)
+        return self.cache.path(part, Cache.key(self.data_key, *params))
+
+    @Instrument.staged("save")
     def save(self):
         """
-            all models need to save users and items history info
+            all models need to save users and items history info,
+            objects are packed into CSR arrays, see base/Artifact.py
         """
-        users = os.path.join('models/saved_models/users_{}'.format(self.name + '.pickle'))
-        items = os.path.join('models/saved_models/items_{}'.format(self.name + '.pickle'))
-        with open(users, 'wb') as f:
-            f.write(pickle.dumps(self.users))
-        with open(items, 'wb') as f:
-            f.write(pickle.dumps(self.items))
+        arrays, meta = {}, {}
+        meta["users"] = Artifact.pack_objects(arrays, "users", self.users, ["covered_items", "tags_count"])  # noqa
+        meta["items"] = Artifact.pack_objects(arrays, "items", self.items, ["covered_users", "tags_count"])  # noqa
+        if hasattr(self, "tags"):
+            meta["tags"] = Artifact.pack_objects(arrays, "tags", self.tags, ["items_count"], ["n_used"])  # noqa
+        # shared by all models fitted on the same events
+        self.cache.write(self.artifact_path("history", self.tag), arrays, meta)
         print("[{}] users and items objects saved.".format(self.name))
 
+    @Instrument.staged("load")
     def load(self):
         """
-            all models need to load users and items history info
+            all models need to load users and items history info,
+            arrays are memory mapped and objects built on access
         """
         print("[{}] Trying to find and load previous history info...".format(self.name))
-        users = os.path.join('models/saved_models/users_{}'.format(self.name + '.pickle'))
-        items = os.path.join('models/saved_models/items_{}'.format(self.name + '.pickle'))
-        with open(users, 'rb') as f:
-            self.users = pickle.loads(f.read())
-        with open(items, 'rb') as f:
-            self.items = pickle.loads(f.read())
+        arrays, meta = self.cache.read(self.artifact_path("history", self.tag))
+        self.users = Artifact.objects(arrays, meta, "users", User)
+        self.items = Artifact.objects(arrays, meta, "items", Item)
+        if "tags" in meta:
+            self.tags = Artifact.objects(arrays, meta, "tags", Tag)
         print("[{}] Previous info found and loaded.".format(self.name))
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import platform
+import resource
+from contextlib import contextmanager
+import numpy as np
+
+
+class Bench_util:
+    @staticmethod
+    @contextmanager
+    def timer(timings, stage):
+        """record the wall time of the with block in timings[stage]"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[stage] = time.perf_counter()-start
+
+    @staticmethod
+    def peak_rss():
+        """peak resident set size of this process in bytes"""
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # linux reports kilobytes, macOS bytes
+        return peak if sys.platform == "darwin" else peak*1024
+
+    @staticmethod
+    def latency_summary(latencies):
+        latencies = np.asarray(latencies)
+        if len(latencies) == 0:
+            return {}
+        return {"count": int(len(latencies)),
+                "mean": float(latencies.mean()),
+                "p50": float(np.percentile(latencies, 50)),
+                "p95": float(np.percentile(latencies, 95)),
+                "p99": float(np.percentile(latencies, 99))}
+
+    @staticmethod
+    def dir_size(path, prefix=""):
+        """total size of the files under path whose name contain prefix"""
+        size = 0
+        for root, _, files in os.walk(path):
+            for file_name in files:
+                if prefix in file_name or prefix in root:
+                    size += os.path.getsize(os.path.join(root, file_name))
+        return size
+
+    @staticmethod
+    def meta():
+        return {"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "cpu_count": os.cpu_count()}
+
+    @staticmethod
+    def write_json(result, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print("[bench] results written to {}".format(path))
+
+    @staticmethod
+    def read_json(path):
+        with open(path, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def compare(results, baseline, key_fields, metric_fields,
+                threshold=0.2, min_delta=0.05):
+        """compare metrics of matching results, lower is better
+
+        Parameters
+        ----------
+        results, baseline : [list of dict]
+            [flat result records]
+        key_fields : [list of str]
+            [fields identifying the same benchmark case]
+        metric_fields : [list of str]
+            [fields to compare, e.g. stage timings]
+        threshold : [float]
+            [relative slowdown tolerated, 0.2 -> 20%]
+        min_delta : [float]
+            [absolute increase below which a change is noise]
+
+        Returns
+        -------
+        [list of tuples]
+            [(case, metric, baseline value, new value) that regressed]
+        """
+        base_cases = {tuple(r.get(k) for k in key_fields): r for r in baseline}
+        regressions = []
+        for result in results:
+            case = tuple(result.get(k) for k in key_fields)
+            if case not in base_cases:
+                continue
+            base = base_cases[case]
+            for metric in metric_fields:
+                new_value, old_value = result.get(metric), base.get(metric)
+                if new_value is None or old_value is None:
+                    continue
+                if new_value > old_value*(1+threshold) and new_value-old_value > min_delta:
+                    regressions.append((case, metric, old_value, new_value))
+        return regressions
+
+    @staticmethod
+    def report_regressions(regressions):
+        if not regressions:
+            print("[bench] No regression found against the baseline.")
+            return 0
+        for case, metric, old_value, new_value in regressions:
+            print("[bench] REGRESSION {} {}: {:.4g} -> {:.4g} ({:+.1%})".format(
+                case, metric, old_value, new_value, new_value/old_value-1))
+        return 1
@@ -0,0 +1,80 @@
+"""compare the fit time and ranking quality of the LFM trainers
+
+run from the repository root:
+
+    python -m benchmarks.bench_als --trainers als keras --n 10
+
+every trainer fits LFM from scratch into an empty cache, then the
+model is evaluated with one ranking pass up to n
+"""
+import os
+import sys
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+from benchmarks.Bench_util import Bench_util
+
+# run_model kwargs of every trainer
+TRAINER_PARAMS = {
+    "als": {"trainer": "als", "als_params": {"dim": 32, "alpha": 10.0, "reg": 0.1,
+                                             "iterations": 10}},
+    "keras": {"trainer": "keras", "neg_frac": 40},
+    "keras_static": {"trainer": "keras", "neg_frac": 40, "sampling": "static"},
+}
+
+
+def bench_trainer(trainer, data_type, n, verbose):
+    """fit and evaluate one trainer, run in its own process"""
+    from base.Model import Model
+    from utils.Data_util import Data_util
+    from run_model import fit_model
+    timings = {}
+    out = sys.stdout if verbose else open(os.devnull, "w")
+    try:
+        with contextlib.redirect_stdout(out):
+            DU = Data_util(data_type)
+            train_data, test_data = DU.read_event_data()
+            # fit from scratch, never reuse artifacts of other runs
+            Model.saved_models_dir = tempfile.mkdtemp(prefix="bench_")
+            with Bench_util.timer(timings, "fit"):
+                model = fit_model("LFM", data_type, DU, train_data,
+                                  n=n, **TRAINER_PARAMS[trainer])
+            with Bench_util.timer(timings, "evaluate"):
+                result = model.evaluate_ranking(test_data, n)
+    except Exception as E:
+        return {"trainer": trainer, "data_type": data_type, "error": repr(E)}
+    return {"trainer": trainer, "data_type": data_type, "n": n, "stages": timings,
+            "recall": float(result["recall"].iloc[-1]),
+            "precision": float(result["precision"].iloc[-1]),
+            "ndcg": float(result["ndcg"].iloc[-1]),
+            "peak_rss_bytes": Bench_util.peak_rss()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--trainers", nargs="+", default=list(TRAINER_PARAMS))
+    parser.add_argument("--data-type", default="MovieLens_100K")
+    parser.add_argument("--n", type=int, default=10)
+    parser.add_argument("--output", default="benchmarks/results/als.json")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for trainer in args.trainers:
+        with context.Pool(1) as pool:
+            result = pool.apply(bench_trainer, (trainer, args.data_type, args.n, args.verbose))
+        results.append(result)
+        if "error" in result:
+            print("[bench] LFM {}: failed {}".format(trainer, result["error"]))
+            continue
+        print("[bench] LFM {}: fit {:.2f}s, recall@{n} {:.4f}, precision@{n} {:.4f}, "
+              "ndcg@{n} {:.4f}, peak rss {:.1f}MB".format(
+                  trainer, result["stages"]["fit"], result["recall"], result["precision"],
+                  result["ndcg"], result["peak_rss_bytes"]/2**20, n=args.n))
+    Bench_util.write_json({"meta": Bench_util.meta(), "results": results}, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
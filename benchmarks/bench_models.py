@@ -0,0 +1,173 @@
+"""time every stage of every model across data set scales
+
+run from the repository root:
+
+    python -m benchmarks.bench_models --models ItemCF MostPopular \
+        --scales 0.25 1.0 --output benchmarks/results/latest.json
+
+and gate on a stored baseline:
+
+    python -m benchmarks.bench_models --baseline benchmarks/baseline.json
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+import numpy as np
+from benchmarks.Bench_util import Bench_util
+from models.Registry import Registry
+
+ALL_MODELS = Registry.names()
+# run_model kwargs used for every model
+MODEL_PARAMS = {
+    "UserCF": {"n": 20, "k": 80, "timestamp": True},
+    "ItemCF": {"n": 20, "k": 20, "timestamp": True},
+    "TagBasic": {"n": 20, "k": 2},
+    "LFM": {"n": 20, "neg_frac": 40},
+    "Wide&Deep": {"n": 20, "neg_frac": 40},
+    "MostPopular": {"n": 20},
+    "Random": {"n": 20},
+    "PersonalRank": {"n": 20},
+    "EASE": {"n": 20, "reg": 500.0},
+}
+STAGES = ["load", "split", "init_objects", "fit", "save", "load_artifacts",
+          "batch_recommend", "evaluate"]
+KEY_FIELDS = ["model_type", "data_type", "scale"]
+
+
+def subsample_users(event_data, scale, seed=100):
+    """keep all events of a random scale fraction of the users"""
+    if scale >= 1:
+        return event_data
+    users_id = event_data["visitorid"].unique()
+    rng = np.random.default_rng(seed)
+    n_keep = max(1, int(len(users_id)*scale))
+    kept = rng.choice(users_id, size=n_keep, replace=False)
+    return event_data.loc[event_data["visitorid"].isin(kept), :].reset_index(drop=True)
+
+
+def bench_model(model_type, data_type, scale, n_single):
+    """benchmark one model on one data scale, run in its own process
+       so that the peak RSS belongs to this case only
+    """
+    from base.Model import Model
+    from utils.Data_util import Data_util
+    from utils.Cache import Cache
+    from run_model import fit_model
+    timings = {}
+    DU = Data_util(data_type)
+    with Bench_util.timer(timings, "load"):
+        raw_data = DU.read_raw_event_data()
+    raw_data = subsample_users(raw_data, scale)
+    with Bench_util.timer(timings, "split"):
+        train_data, test_data = DU.sort_user_actions(raw_data, 0.25)
+    with Bench_util.timer(timings, "init_objects"):
+        Model.init_item_and_user_objects(train_data, tag="tagid" in train_data)
+    # always fit from scratch, never reuse artifacts of other runs
+    Model.saved_models_dir = tempfile.mkdtemp(prefix="bench_")
+    # fit includes the save done at the end of every model's fit
+    with Bench_util.timer(timings, "fit"):
+        model = fit_model(model_type, data_type, DU, train_data.copy(),
+                          **MODEL_PARAMS[model_type])
+    # existing cache entries are not written again, save into an
+    # empty cache so that save and load are timed in full
+    model.cache = Cache(tempfile.mkdtemp(prefix="bench_"))
+    with Bench_util.timer(timings, "save"):
+        model.save()
+    with Bench_util.timer(timings, "load_artifacts"):
+        model.load()
+    artifact_bytes = Bench_util.dir_size(model.cache.root)
+    users_id = [user_id for user_id in test_data["visitorid"].unique()
+                if user_id in model.users]
+    latencies = []
+    for user_id in random.Random(100).sample(users_id, min(n_single, len(users_id))):
+        start = time.perf_counter()
+        model.make_recommendation(user_id)
+        latencies.append(time.perf_counter()-start)
+    with Bench_util.timer(timings, "batch_recommend"):
+        for user_id in users_id:
+            model.make_recommendation(user_id)
+    with Bench_util.timer(timings, "evaluate"):
+        model.evaluate(test_data)
+    return {"model_type": model_type, "data_type": data_type, "scale": scale,
+            "n_events": int(len(raw_data)), "n_users": int(len(users_id)),
+            "stages": timings,
+            "single_recommend": Bench_util.latency_summary(latencies),
+            "batch_recommend_users_per_sec": len(users_id)/timings["batch_recommend"],
+            "peak_rss_bytes": Bench_util.peak_rss(),
+            "artifact_bytes": artifact_bytes}
+
+
+def bench_case(args):
+    model_type, data_type, scale, n_single, verbose = args
+    out = sys.stdout if verbose else open(os.devnull, "w")
+    try:
+        with contextlib.redirect_stdout(out):
+            return bench_model(model_type, data_type, scale, n_single)
+    except Exception as E:
+        return {"model_type": model_type, "data_type": data_type,
+                "scale": scale, "error": repr(E)}
+
+
+def flatten(result):
+    """one flat record per case for baseline comparison"""
+    record = {k: result.get(k) for k in KEY_FIELDS}
+    for stage, seconds in result.get("stages", {}).items():
+        record[stage] = seconds
+    record["single_recommend_p95"] = result.get("single_recommend", {}).get("p95")
+    record["peak_rss_bytes"] = result.get("peak_rss_bytes")
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--models", nargs="+", default=ALL_MODELS)
+    parser.add_argument("--data-types", nargs="+", default=["MovieLens_100K"])
+    parser.add_argument("--scales", nargs="+", type=float, default=[1.0])
+    parser.add_argument("--n-single", type=int, default=200,
+                        help="number of single user requests timed")
+    parser.add_argument("--output", default="benchmarks/results/latest.json")
+    parser.add_argument("--baseline", default=None,
+                        help="json of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown counted as a regression")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    cases = [(model_type, data_type, scale, args.n_single, args.verbose)
+             for data_type in args.data_types for scale in args.scales
+             for model_type in args.models]
+    results = []
+    # a fresh process per case, the peak RSS of one case must not
+    # include the memory of the previous ones
+    context = multiprocessing.get_context("spawn")
+    for case in cases:
+        with context.Pool(1) as pool:
+            result = pool.apply(bench_case, (case,))
+        results.append(result)
+        if "error" in result:
+            print("[bench] {} {} x{}: failed {}".format(*case[:3], result["error"]))
+        else:
+            print("[bench] {} {} x{}: {}, peak rss {:.1f}MB, artifacts {:.1f}MB".format(
+                *case[:3],
+                ", ".join("{} {:.3f}s".format(s, result["stages"][s]) for s in STAGES),
+                result["peak_rss_bytes"]/2**20, result["artifact_bytes"]/2**20))
+    Bench_util.write_json({"meta": Bench_util.meta(), "results": results}, args.output)
+    if args.baseline is None:
+        return 0
+    baseline = [flatten(r) for r in Bench_util.read_json(args.baseline)["results"]]
+    records = [flatten(r) for r in results]
+    regressions = Bench_util.compare(records, baseline, KEY_FIELDS,
+                                     STAGES+["single_recommend_p95"],
+                                     threshold=args.threshold, min_delta=0.05)
+    regressions += Bench_util.compare(records, baseline, KEY_FIELDS,
+                                      ["peak_rss_bytes"], threshold=args.threshold,
+                                      min_delta=16*2**20)
+    return Bench_util.report_regressions(regressions)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""PersonalRank throughput with the number of users iterated together
+
+run from the repository root:
+
+    python -m benchmarks.bench_personal_rank --data-type MovieLens_100K --batch-sizes 1 32 256 1024
+
+for every batch size the top --n of --n-users test users are computed
+with PersonalRank.prepare_users (power iteration on dense blocks of
+batch size users), rankings are checked against the first batch size
+"""
+import os
+import sys
+import random
+import argparse
+import contextlib
+from benchmarks.Bench_util import Bench_util
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--data-type", default="MovieLens_100K")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 32, 256, 1024])
+    parser.add_argument("--n-users", type=int, default=1000)
+    parser.add_argument("--n", type=int, default=10)
+    parser.add_argument("--alpha", type=float, default=0.8)
+    parser.add_argument("--max-iter", type=int, default=30)
+    parser.add_argument("--output", default="benchmarks/results/personal_rank.json")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    from run_model import build
+    out = sys.stdout if args.verbose else open(os.devnull, "w")
+    with contextlib.redirect_stdout(out):
+        model, test_data = build("PersonalRank", args.data_type, n=args.n, alpha=args.alpha,
+                                 max_iter=args.max_iter)
+    users_id = [user_id for user_id in test_data["visitorid"].unique().tolist()
+                if user_id in model.user_rows]
+    users_id = random.Random(100).sample(users_id, min(args.n_users, len(users_id)))
+    results, reference = [], None
+    for batch_size in args.batch_sizes:
+        model.batch_size = batch_size
+        model.rankings = {}
+        result = {"batch_size": batch_size}
+        with Bench_util.timer(result, "seconds"):
+            model.prepare_users(users_id, args.n)
+        reference = reference or dict(model.rankings)
+        result.update({"throughput": len(users_id)/result["seconds"],
+                       "peak_rss": Bench_util.peak_rss(),
+                       "same_rankings": sum(model.rankings[user_id] == reference[user_id]
+                                            for user_id in users_id)/len(users_id)})
+        results.append(result)
+        print("[bench] batch size {}: {:.2f}s, {:.0f} users/s, same rankings as batch size {} "
+              "{:.1%}".format(batch_size, result["seconds"], result["throughput"],
+                              args.batch_sizes[0], result["same_rankings"]))
+    Bench_util.write_json({"meta": Bench_util.meta(), "data_type": args.data_type,
+                           "n_users": len(users_id), "n_items": len(model.items_id),
+                           "n_events": int(model.indptr[-1]), "alpha": args.alpha,
+                           "results": results}, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""time ordered replay of the events as a live stream, with online updates
+
+run from the repository root:
+
+    python -m benchmarks.bench_replay --models MostPopular PersonalRank ItemCF --batch-events 500
+
+the events of read_event_data (train and test) are sorted by timestamp,
+the model is fitted on the first --warmup fraction and the rest is
+replayed in batches of --batch-events events. Before an event is
+seen, its user asks for a top n recommendation (prequential
+evaluation: a hit when the event's item is in it), then every batch
+is folded in with Model.partial_fit. Models without partial_update
+only run static (no updates), the others run both ways.
+
+reported per model and mode: prequential hit rate overall, over the
+users known after the warmup (the only ones a static model serves)
+and per --window-days window of event time, request latency, update
+throughput, staleness (wall time from reading an event to the end of
+the update making it visible) and the event time lag of the model at
+every request; Model.recommend returns cached recommendations until the
+next update, request latency is also reported over the cache misses
+only, the requests computed by make_recommendation
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+import pandas as pd
+from benchmarks.Bench_util import Bench_util
+
+# run_model kwargs of the models
+MODEL_PARAMS = {
+    "MostPopular": {},
+    "Random": {},
+    "TagBasic": {"k": 2},
+    "PersonalRank": {"max_iter": 20},
+    "EASE": {"reg": 500.0},
+    "ItemCF": {"k": 20, "timestamp": True},
+    "UserCF": {"k": 80, "timestamp": True},
+}
+
+
+def supports_updates(model):
+    from base.Model import Model
+    return type(model).partial_update is not Model.partial_update
+
+
+def replay(model, stream, batch_events, update, window_seconds, request_frac, seed=100):
+    """prequential replay of stream (sorted by timestamp) on model"""
+    rng = np.random.default_rng(seed)
+    latencies, miss_latencies, update_latencies, staleness, lags = [], [], [], [], []
+    windows = {}
+    n_requests = n_hits = n_cold = 0
+    # users known before the replay, requested in both modes
+    warm_users = set(model.users.keys())
+    n_warm_requests = n_warm_hits = 0
+    start_ts = stream["timestamp"].iloc[0]
+    # event time of the newest event the model has seen
+    model_ts = start_ts
+    for start in range(0, len(stream), batch_events):
+        batch = stream.iloc[start:start+batch_events]
+        received = np.empty(len(batch))
+        requested = rng.random(len(batch)) < request_frac
+        for j, (user_id, item_id, ts) in enumerate(zip(batch["visitorid"].tolist(),
+                                                         batch["itemid"].tolist(),
+                                                         batch["timestamp"].tolist())):
+            received[j] = time.perf_counter()
+            if not requested[j]:
+                continue
+            if user_id not in model.users.keys():
+                n_cold += 1
+                continue
+            cached = user_id in model.recommendations
+            request_start = time.perf_counter()
+            reco_items_id = model.recommend(user_id)
+            latencies.append(time.perf_counter()-request_start)
+            if not cached:
+                miss_latencies.append(latencies[-1])
+            lags.append(ts-model_ts)
+            hit = isinstance(reco_items_id, set) and item_id in reco_items_id
+            window = windows.setdefault(int((ts-start_ts)//window_seconds), [0, 0])
+            window[0] += 1
+            window[1] += hit
+            n_requests += 1
+            n_hits += hit
+            if user_id in warm_users:
+                n_warm_requests += 1
+                n_warm_hits += hit
+        if update:
+            update_start = time.perf_counter()
+            model.partial_fit(batch)
+            update_end = time.perf_counter()
+            update_latencies.append(update_end-update_start)
+            staleness.extend((update_end-received).tolist())
+            model_ts = batch["timestamp"].iloc[-1]
+    result = {"requests": n_requests, "cold_requests": n_cold,
+              "hit_rate": n_hits/max(n_requests, 1),
+              "warm_requests": n_warm_requests,
+              "warm_hit_rate": n_warm_hits/max(n_warm_requests, 1),
+              "request_latency": Bench_util.latency_summary(latencies),
+              "cache_hit_rate": 1-len(miss_latencies)/max(len(latencies), 1),
+              "miss_latency": Bench_util.latency_summary(miss_latencies),
+              "model_lag_hours": Bench_util.latency_summary(np.asarray(lags)/3600),
+              "windows": [{"window": window, "requests": requests, "hit_rate": hits/requests}
+                          for window, (requests, hits) in sorted(windows.items())]}
+    if update:
+        result.update({"update_throughput": len(stream)/sum(update_latencies),
+                       "update_latency": Bench_util.latency_summary(update_latencies),
+                       "staleness": Bench_util.latency_summary(staleness)})
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--models", nargs="+", default=["MostPopular", "PersonalRank", "ItemCF"],
+                        choices=list(MODEL_PARAMS))
+    parser.add_argument("--data-type", default="MovieLens_100K")
+    parser.add_argument("--warmup", type=float, default=0.5)
+    parser.add_argument("--batch-events", type=int, default=500)
+    parser.add_argument("--request-frac", type=float, default=1.0)
+    parser.add_argument("--window-days", type=float, default=7)
+    parser.add_argument("--n", type=int, default=10)
+    parser.add_argument("--output", default="benchmarks/results/replay.json")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    from models.Registry import Registry
+    from utils.Data_util import Data_util
+    DU = Data_util(args.data_type)
+    train_data, test_data = DU.read_event_data()
+    events = pd.concat([train_data, test_data], ignore_index=True)
+    events = events.iloc[np.argsort(events["timestamp"].to_numpy(), kind="stable")]
+    events = events.reset_index(drop=True)
+    n_warmup = int(args.warmup*len(events))
+    warmup, stream = events.iloc[:n_warmup], events.iloc[n_warmup:]
+    out = sys.stdout if args.verbose else open(os.devnull, "w")
+    results = []
+    for model_type in args.models:
+        params = dict(MODEL_PARAMS[model_type], n=args.n)
+        for update in (False, True):
+            with contextlib.redirect_stdout(out), tempfile.TemporaryDirectory() as logs_dir:
+                model = Registry.create(model_type, args.data_type, DU, warmup, **params)
+                if update and not supports_updates(model):
+                    continue
+                # the replay's event log is thrown away with the run
+                model.event_logs_dir = logs_dir
+                result = replay(model, stream, args.batch_events, update,
+                                args.window_days*86400, args.request_frac)
+            result.update({"model_type": model_type, "mode": "online" if update else "static"})
+            results.append(result)
+            line = "[bench] {} {}: prequential hit rate {:.4f} over {} requests ({:.4f} for " \
+                   "warmup users), p50 {:.2f}ms p95 {:.2f}ms ({:.0%} cached, misses p50 " \
+                   "{:.2f}ms p95 {:.2f}ms), model lag p50 {:.1f}h".format(
+                       model_type, result["mode"], result["hit_rate"], result["requests"],
+                       result["warm_hit_rate"],
+                       result["request_latency"]["p50"]*1000,
+                       result["request_latency"]["p95"]*1000, result["cache_hit_rate"],
+                       result["miss_latency"].get("p50", np.nan)*1000,
+                       result["miss_latency"].get("p95", np.nan)*1000,
+                       result["model_lag_hours"]["p50"])
+            if update:
+                line += ", {:.0f} events/s updates, staleness p50 {:.3f}s p95 {:.3f}s".format(
+                    result["update_throughput"], result["staleness"]["p50"],
+                    result["staleness"]["p95"])
+            print(line)
+    Bench_util.write_json({"meta": Bench_util.meta(), "data_type": args.data_type,
+                           "n_warmup": n_warmup, "n_stream": len(stream),
+                           "batch_events": args.batch_events, "n": args.n,
+                           "results": results}, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""compare keras predict with the compiled serving signature
+
+run from the repository root:
+
+    python -m benchmarks.bench_serving --models LFM Wide&Deep --n-users 200
+
+every model is fitted (or loaded from the cache), then the same users
+are scored with predict_rank_items (keras predict loop) and rank_items
+(SavedModel signature), latencies and the largest score difference
+are reported
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import contextlib
+from benchmarks.Bench_util import Bench_util
+
+# run_model kwargs of the keras models
+MODEL_PARAMS = {
+    "LFM": {"n": 20, "neg_frac": 40},
+    "Wide&Deep": {"n": 20, "neg_frac": 40},
+}
+
+
+def time_ranking(rank, users_id):
+    latencies, scores = [], {}
+    for user_id in users_id:
+        start = time.perf_counter()
+        scores[user_id] = rank(user_id)
+        latencies.append(time.perf_counter()-start)
+    return Bench_util.latency_summary(latencies), scores
+
+
+def bench_serving(model_type, data_type, n_users, verbose):
+    from run_model import build
+    from utils.Serving import Serving
+    out = sys.stdout if verbose else open(os.devnull, "w")
+    with contextlib.redirect_stdout(out):
+        model, test_data = build(model_type, data_type, **MODEL_PARAMS[model_type])
+    users_id = [user_id for user_id in test_data["visitorid"].unique()
+                if user_id in model.users]
+    users_id = random.Random(100).sample(users_id, min(n_users, len(users_id)))
+    # warm up both paths, the first calls trace and build the graphs
+    model.predict_rank_items(users_id[0])
+    model.rank_items(users_id[0])
+    with contextlib.redirect_stdout(out):
+        predict_latency, predict_scores = time_ranking(model.predict_rank_items, users_id)
+    serving_latency, serving_scores = time_ranking(model.rank_items, users_id)
+    max_diff = max(abs(predict_scores[user_id][item_id]-score)
+                   for user_id in users_id
+                   for item_id, score in serving_scores[user_id].items())
+    return {"model_type": model_type, "data_type": data_type,
+            "n_users": len(users_id), "n_threads": Serving.n_threads,
+            "predict": predict_latency, "serving": serving_latency,
+            "speedup_p50": predict_latency["p50"]/serving_latency["p50"],
+            "max_score_diff": float(max_diff)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--models", nargs="+", default=list(MODEL_PARAMS))
+    parser.add_argument("--data-type", default="MovieLens_100K")
+    parser.add_argument("--n-users", type=int, default=200)
+    parser.add_argument("--output", default="benchmarks/results/serving.json")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    results = []
+    for model_type in args.models:
+        result = bench_serving(model_type, args.data_type, args.n_users, args.verbose)
+        results.append(result)
+        print("[bench] serving {}: predict p50 {:.2f}ms p95 {:.2f}ms, "
+              "signature p50 {:.2f}ms p95 {:.2f}ms, x{:.1f}, max score diff {:.2g}".format(
+                  model_type, result["predict"]["p50"]*1000, result["predict"]["p95"]*1000,
+                  result["serving"]["p50"]*1000, result["serving"]["p95"]*1000,
+                  result["speedup_p50"], result["max_score_diff"]))
+    Bench_util.write_json({"meta": Bench_util.meta(), "results": results}, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
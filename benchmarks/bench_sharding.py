@@ -0,0 +1,90 @@
+"""scaling of item sharded scatter-gather serving with the number of shards
+
+run from the repository root:
+
+    python -m benchmarks.bench_sharding --model ItemCF --shards 1 2 4 8 --n-users 300
+
+for every number of shards S the workers are started (the model is
+fitted or loaded once into the cache before), then the same users are
+ranked one request at a time (latency) and as batches of --batch-size
+users (throughput); rankings are checked against S=1
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import contextlib
+from benchmarks.Bench_util import Bench_util
+
+# run_model kwargs of the models
+MODEL_PARAMS = {
+    "ItemCF": {"k": 20, "timestamp": True},
+    "UserCF": {"k": 80, "timestamp": True},
+    "MostPopular": {},
+    "LFM": {"trainer": "als"},
+}
+
+
+def bench_shards(serving, users_id, n, batch_size):
+    latencies, rankings = [], {}
+    for user_id in users_id:
+        start = time.perf_counter()
+        rankings[user_id] = serving.make_ranking(user_id, n)
+        latencies.append(time.perf_counter()-start)
+    start = time.perf_counter()
+    for i in range(0, len(users_id), batch_size):
+        serving.make_rankings(users_id[i:i+batch_size], n)
+    elapsed = time.perf_counter()-start
+    return Bench_util.latency_summary(latencies), len(users_id)/elapsed, rankings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", default="ItemCF", choices=list(MODEL_PARAMS))
+    parser.add_argument("--data-type", default="MovieLens_100K")
+    parser.add_argument("--shards", nargs="+", type=int, default=[1, 2, 4, 8])
+    parser.add_argument("--n-users", type=int, default=300)
+    parser.add_argument("--n", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--output", default="benchmarks/results/sharding.json")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    from run_model import build
+    from utils.Shard_serving import Shard_serving
+    params = dict(MODEL_PARAMS[args.model], n=args.n)
+    out = sys.stdout if args.verbose else open(os.devnull, "w")
+    with contextlib.redirect_stdout(out):
+        # fit into the cache once, every worker loads it
+        model, test_data = build(args.model, args.data_type, **params)
+    users_id = [user_id for user_id in test_data["visitorid"].unique().tolist()
+                if user_id in model.users]
+    users_id = random.Random(100).sample(users_id, min(args.n_users, len(users_id)))
+    del model
+    results, reference = [], None
+    for n_shards in args.shards:
+        result = {"model_type": args.model, "n_shards": n_shards}
+        with Bench_util.timer(result, "startup"):
+            serving = Shard_serving(args.model, args.data_type, n_shards, **params)
+            with contextlib.redirect_stdout(out):
+                serving.start()
+        try:
+            latency, throughput, rankings = bench_shards(serving, users_id, args.n, args.batch_size)
+        finally:
+            serving.close()
+        reference = reference or rankings
+        result.update({"latency": latency, "throughput": throughput,
+                       "same_rankings": sum(rankings[user_id] == reference[user_id]
+                                            for user_id in users_id)/len(users_id)})
+        results.append(result)
+        print("[bench] {} shards {}: startup {:.1f}s, p50 {:.2f}ms p95 {:.2f}ms, "
+              "{:.0f} users/s, same rankings as 1 shard {:.1%}".format(
+                  args.model, n_shards, result["startup"], latency["p50"]*1000,
+                  latency["p95"]*1000, throughput, result["same_rankings"]))
+    Bench_util.write_json({"meta": Bench_util.meta(), "data_type": args.data_type,
+                           "n_users": len(users_id), "results": results}, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
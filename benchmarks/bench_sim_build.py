@@ -0,0 +1,89 @@
+"""similarity matrix builds of ItemCF and UserCF, measured vs planned
+
+run from the repository root:
+
+    python -m benchmarks.bench_sim_build --models ItemCF UserCF --data-type MovieLens_100K
+
+every build (dict, csr float32, csr float64) is fitted from scratch in
+a fresh process, its peak RSS above a process forming the histories
+only and its fit time above that process are compared with the
+estimates of utils/Sim_build.py, which are calibrated with this
+benchmark
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+from benchmarks.Bench_util import Bench_util
+
+BUILDS = [(None, None), ("dict", "float64"), ("csr", "float32"), ("csr", "float64")]
+
+
+def bench_build(args):
+    model_type, data_type, strategy, dtype, timestamp = args
+    from base.Model import Model
+    from utils.Data_util import Data_util
+    from models.Registry import Registry
+    train_data, _ = Data_util(data_type).read_event_data()
+    Model.saved_models_dir = tempfile.mkdtemp(prefix="bench_")
+    model = Registry.model_class(model_type)(n=10, k=20, data_type=data_type,
+                                             timestamp=timestamp, build=strategy or "dict",
+                                             dtype=dtype or "float32")
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        if strategy is None:
+            Model.fit(model, train_data)
+        else:
+            model.fit(train_data)
+    return time.perf_counter()-start, Bench_util.peak_rss()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--models", nargs="+", default=["ItemCF", "UserCF"])
+    parser.add_argument("--data-type", default="MovieLens_100K")
+    parser.add_argument("--timestamp", action="store_true")
+    parser.add_argument("--output", default="benchmarks/results/sim_build.json")
+    args = parser.parse_args(argv)
+    from base.Model import Model
+    from utils.Data_util import Data_util
+    from utils.Sim_build import Sim_build
+    train_data, _ = Data_util(args.data_type).read_event_data()
+    items, users = Model.init_item_and_user_objects(train_data)
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for model_type in args.models:
+        sim_build = (Sim_build(users, "covered_items") if model_type == "ItemCF" else
+                     Sim_build(items, "covered_users"))
+        estimates = {(estimate["strategy"], estimate["dtype"]): estimate
+                     for estimate in sim_build.estimates()}
+        baseline = None
+        for strategy, dtype in BUILDS:
+            # one fresh process per build, peak RSS is per process
+            with context.Pool(1) as pool:
+                seconds, peak_rss = pool.apply(bench_build, ((model_type, args.data_type, strategy,
+                                                              dtype, args.timestamp),))
+            if strategy is None:
+                baseline = seconds, peak_rss
+                continue
+            estimate = estimates[(strategy, dtype)]
+            result = {"model_type": model_type, "strategy": strategy, "dtype": dtype,
+                      "seconds": seconds-baseline[0], "peak_bytes": peak_rss-baseline[1],
+                      "estimated_seconds": estimate["seconds"],
+                      "estimated_peak_bytes": estimate["peak_bytes"]}
+            results.append(result)
+            print("[bench] {} {} {}: {:.2f}s (estimated {:.2f}s), peak {:.0f}MB (estimated "
+                  "{:.0f}MB)".format(model_type, strategy, dtype, result["seconds"],
+                                     estimate["seconds"], result["peak_bytes"]/1e6,
+                                     estimate["peak_bytes"]/1e6))
+        print("[bench] {} stats: {}".format(model_type, sim_build.stats))
+    Bench_util.write_json({"meta": Bench_util.meta(), "data_type": args.data_type,
+                           "timestamp": args.timestamp, "results": results}, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
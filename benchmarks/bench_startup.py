@@ -0,0 +1,72 @@
+"""time the startup of a fresh process running each model
+
+run from the repository root:
+
+    python -m benchmarks.bench_startup --repeats 5
+
+every case imports run_model and the model class from the registry
+in a new interpreter, the "all" case imports every model as
+run_model did before the registry
+"""
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+from benchmarks.Bench_util import Bench_util
+from models.Registry import Registry
+
+STARTUP_CODE = """
+import sys, time, json
+start = time.perf_counter()
+import run_model
+from models.Registry import Registry
+for model_type in sys.argv[1:]:
+    Registry.model_class(model_type)
+seconds = time.perf_counter()-start
+from benchmarks.Bench_util import Bench_util
+print(json.dumps({"seconds": seconds, "peak_rss_bytes": Bench_util.peak_rss(),
+                  "tensorflow": "tensorflow" in sys.modules}))
+"""
+
+
+def bench_startup(model_types, repeats):
+    runs = []
+    for _ in range(repeats):
+        process = subprocess.run([sys.executable, "-c", STARTUP_CODE]+model_types,
+                                 capture_output=True, text=True)
+        if process.returncode != 0:
+            return {"error": process.stderr.strip().split("\n")[-1]}
+        # libraries may print on import, the result is the last line
+        runs.append(json.loads(process.stdout.strip().split("\n")[-1]))
+    seconds = [r["seconds"] for r in runs]
+    return {"seconds_median": float(np.median(seconds)),
+            "seconds_min": float(np.min(seconds)),
+            "peak_rss_bytes": int(np.median([r["peak_rss_bytes"] for r in runs])),
+            "tensorflow": runs[-1]["tensorflow"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--models", nargs="+", default=Registry.names())
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default="benchmarks/results/startup.json")
+    args = parser.parse_args(argv)
+    cases = [[model_type] for model_type in args.models]+[Registry.names()]
+    results = []
+    for model_types in cases:
+        result = bench_startup(model_types, args.repeats)
+        result["model_type"] = model_types[0] if len(model_types) == 1 else "all"
+        results.append(result)
+        if "error" in result:
+            print("[bench] startup {}: failed {}".format(result["model_type"], result["error"]))
+            continue
+        print("[bench] startup {}: {:.3f}s, peak rss {:.1f}MB, tensorflow {}".format(
+            result["model_type"], result["seconds_median"],
+            result["peak_rss_bytes"]/2**20, "loaded" if result["tensorflow"] else "not loaded"))
+    Bench_util.write_json({"meta": Bench_util.meta(), "results": results}, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
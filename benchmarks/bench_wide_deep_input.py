@@ -0,0 +1,109 @@
+"""compare the epoch time of the Wide&Deep input pipelines
+
+run from the repository root:
+
+    python -m benchmarks.bench_wide_deep_input --batch-sizes 128 1024 4096 --epochs 3
+
+the baseline is the former pipeline, from_tensor_slices over the
+samples joined with their users and items features (one column per
+model input) batched by 128 without shuffle, cache or prefetch; the
+other runs use Wide_and_deep.df_to_dataset over (visitorid, itemid,
+event) samples, side features gathered from the feature tables. Every pipeline is
+timed by iterating epochs alone, then by training the same keras model
+on them, the memory of both training sets is reported too
+"""
+import os
+import sys
+import time
+import argparse
+import contextlib
+from benchmarks.Bench_util import Bench_util
+
+
+def baseline_dataset(dataframe, batch_size=128):
+    import tensorflow as tf
+    dataframe = dataframe.copy()
+    labels = dataframe.pop("event")
+    return tf.data.Dataset.from_tensor_slices((dict(dataframe), labels)).batch(batch_size)
+
+
+def time_epochs(run_epoch, epochs):
+    """wall time of every epoch, the first one includes tracing and
+       filling the cache
+    """
+    times = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        run_epoch()
+        times.append(time.perf_counter()-start)
+    return {"first": times[0], "rest_mean": sum(times[1:])/max(len(times)-1, 1), "all": times}
+
+
+def bench_pipeline(name, make_dataset, model, epochs, train):
+    result = {"pipeline": name}
+    with Bench_util.timer(result, "build"):
+        ds = make_dataset()
+    result["input_epoch"] = time_epochs(lambda: [None for _ in ds], epochs)
+    if train:
+        result["train_epoch"] = time_epochs(lambda: model.model.fit(ds, epochs=1, verbose=0),
+                                            epochs)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--data-type", default="MovieLens_100K")
+    parser.add_argument("--neg-frac", type=int, default=40)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[128, 1024, 4096])
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--no-train", action="store_true", help="time the input pipelines only")
+    parser.add_argument("--output", default="benchmarks/results/wide_deep_input.json")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    from models.Wide_and_deep import Wide_and_deep
+    import numpy as np
+    import pandas as pd
+    from utils.Data_util import Data_util
+    out = sys.stdout if args.verbose else open(os.devnull, "w")
+    with contextlib.redirect_stdout(out):
+        # same training data as run_model("Wide&Deep", ...)
+        DU = Data_util(args.data_type)
+        train_data, _ = DU.read_event_data()
+        train_data = DU.build_samples(args.neg_frac, train_data)
+        train_data = train_data[["visitorid", "itemid", "event"]]
+        model = Wide_and_deep(n=10, data_type=args.data_type, neg_frac_in_train=args.neg_frac)
+        model.read_feature_tables()
+        model.build_model()
+        # every sample joined with the feature table rows of its user and item
+        user_rows = model.user_index.get_indexer(train_data["visitorid"])
+        item_rows = model.item_index.get_indexer(train_data["itemid"])
+        joined_data = pd.DataFrame(
+            {name: np.asarray(values)[rows] for table, rows in ((model.users_table, user_rows),
+                                                                (model.items_table, item_rows))
+             for name, values in table.items()})
+        joined_data["event"] = train_data["event"].to_numpy()
+    memory = {"joined_bytes": int(joined_data.memory_usage(deep=True).sum()),
+              "samples_bytes": int(train_data.memory_usage(deep=True).sum())}
+    print("[bench] training set: joined {:.1f}MB, samples {:.1f}MB".format(
+        memory["joined_bytes"]/2**20, memory["samples_bytes"]/2**20))
+    pipelines = [("baseline_128", lambda: baseline_dataset(joined_data))]
+    for batch_size in args.batch_sizes:
+        pipelines.append(("encoded_{}".format(batch_size),
+                          lambda batch_size=batch_size: model.df_to_dataset(
+                              train_data, shuffle=True, batch_size=batch_size)))
+    results = []
+    for name, make_dataset in pipelines:
+        result = bench_pipeline(name, make_dataset, model, args.epochs, not args.no_train)
+        results.append(result)
+        line = "[bench] {}: build {:.2f}s, input epoch {:.2f}s".format(
+            name, result["build"], result["input_epoch"]["rest_mean"])
+        if "train_epoch" in result:
+            line += ", train epoch {:.2f}s".format(result["train_epoch"]["rest_mean"])
+        print(line)
+    Bench_util.write_json({"meta": Bench_util.meta(), "data_type": args.data_type,
+                           "n_samples": len(train_data), "memory": memory, "results": results}, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
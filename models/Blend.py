@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+from base.Model import Model
+from utils.Instrument import Instrument
+
+
+class Blend(Model):
+    """score level ensemble of fitted models
+
+       every component scores a batch of users over the catalog at
+       once (Model.score_users, sparse products for the CF models),
+       each component nominates its top candidates items per user,
+       the union is the shared candidate set; scores are normalized
+       per component over it then summed with the weights
+    """
+    normalizations = ("rank", "minmax")
+
+    def __init__(self, n, data_type, models, weights=None, normalization="rank",
+                 candidates=100, batch_size=256, ensure_new=True):
+        """
+        Parameters
+        ----------
+        models : [list]
+            [fitted component models, fitted on the same events]
+        weights : [list]
+            [weight of every component, equal weights by default]
+        normalization : [str]
+            [rank: scores become their rank percentile among the
+             scored candidates, minmax: scores rescaled to [0, 1],
+             candidates a component does not score count as 0]
+        candidates : [int]
+            [items each component nominates per user, None blends
+             every untouched item]
+        batch_size : [int]
+            [users scored together]
+        """
+        super().__init__(n, "Blend", data_type, ensure_new=ensure_new)
+        if normalization not in self.normalizations:
+            raise ValueError("Invalid blend normalization: {}, must be in {}".format(
+                normalization, self.normalizations))
+        weights = weights or [1.0]*len(models)
+        if len(weights) != len(models):
+            raise ValueError("Got {} weights for {} models".format(len(weights), len(models)))
+        self.models = models
+        self.weights = weights
+        self.normalization = normalization
+        self.candidates = candidates
+        self.batch_size = batch_size
+        self.name += "_{}_{}".format("_".join("{}_{}".format(model.model_type, weight)
+                                              for model, weight in zip(models, weights)),
+                                     normalization)
+        self.artifact_name = self.name
+        # (max_n, ranking) prepared in batches, by user id
+        self.rankings = {}
+
+    def fit(self, event_data):
+        """components are already fitted, only the shared histories
+           (candidates and touched items) are needed
+        """
+        if not super().fit(event_data):
+            self.save()
+        self.init_state()
+
+    def init_state(self):
+        self.items_id = np.fromiter(self.items, dtype=np.int64, count=len(self.items))
+
+    @staticmethod
+    def normalize(scores, normalization):
+        """normalized scores in [0, 1] along the last axis, NaN (not
+           scored) become 0
+        """
+        scored = ~np.isnan(scores)
+        n_scored = scored.sum(axis=-1, keepdims=True)
+        if normalization == "rank":
+            # not scored sort last, scored ones get ranks 1..n_scored
+            order = np.argsort(np.where(scored, scores, np.inf), axis=-1, kind="stable")
+            ranks = np.empty(scores.shape)
+            np.put_along_axis(ranks, order, np.broadcast_to(np.arange(1.0, scores.shape[-1]+1),
+                                                            scores.shape), axis=-1)
+            return np.where(scored, ranks/np.maximum(n_scored, 1), 0.0)
+        low = np.min(np.where(scored, scores, np.inf), axis=-1, keepdims=True)
+        high = np.max(np.where(scored, scores, -np.inf), axis=-1, keepdims=True)
+        spread = np.where(high > low, high-low, 1.0)
+        return np.where(scored, np.where(high > low, (scores-low)/spread, 1.0), 0.0)
+
+    def blend_scores(self, users_id):
+        """(candidates, blended) users x items arrays over
+           self.items_id, candidates is the shared candidate mask,
+           users no component scores have no candidates
+        """
+        scores = [model.score_users(users_id, self.items_id) for model in self.models]
+        if self.candidates is None:
+            # every untouched item, the components share the histories
+            users_index, history_items_id, history = self.history_matrix()
+            rows = users_index.get_indexer(users_id)
+            candidates = np.zeros((len(users_id), len(self.items_id)), dtype=bool)
+            candidates[rows >= 0] = True
+            touched = history[rows[rows >= 0]].tocoo()
+            columns = pd.Index(self.items_id).get_indexer(history_items_id[touched.col])
+            candidates[(rows >= 0).nonzero()[0][touched.row], columns] = False
+        else:
+            candidates = np.zeros((len(users_id), len(self.items_id)), dtype=bool)
+            n_candidates = min(self.candidates, len(self.items_id))
+            for model_scores in scores:
+                filled = np.where(np.isnan(model_scores), -np.inf, model_scores)
+                best = np.argpartition(-filled, n_candidates-1, axis=1)[:, :n_candidates]
+                np.put_along_axis(candidates, best,
+                                  np.take_along_axis(candidates, best, axis=1)
+                                  | np.isfinite(np.take_along_axis(filled, best, axis=1)), axis=1)
+        blended = np.zeros(candidates.shape)
+        n_scored = np.zeros(len(users_id), dtype=np.int64)
+        for model_scores, weight in zip(scores, self.weights):
+            model_scores = np.where(candidates, model_scores, np.nan)
+            blended += weight*self.normalize(model_scores, self.normalization)
+            n_scored += (~np.isnan(model_scores)).any(axis=1)
+        candidates[n_scored == 0] = False
+        for user_candidates, user_n_scored in zip(candidates.sum(axis=1).tolist(), n_scored.tolist()):
+            Instrument.observe("candidates_scored", user_candidates*user_n_scored,
+                               Instrument.size_buckets, model=self.model_type)
+        return candidates, blended
+
+    def prepare_users(self, users_id, max_n):
+        """blend the users of users_id batch_size at a time, the top
+           max_n of every user are kept for make_ranking
+        """
+        users_id = [user_id for user_id in users_id if user_id in self.users]
+        for start in range(0, len(users_id), self.batch_size):
+            batch = users_id[start:start+self.batch_size]
+            candidates, blended = self.blend_scores(batch)
+            for user_id, user_candidates, user_blended in zip(batch, candidates, blended):
+                self.rankings[user_id] = max_n, self.top(self.items_id[user_candidates],
+                                                         user_blended[user_candidates], max_n)
+
+    def partial_update(self, events):
+        self.rankings = {}
+
+    def shard_spec(self):
+        spec = super().shard_spec()
+        spec.models = [model.shard_spec() for model in self.models]
+        return spec
+
+    def load_shard(self, items_id):
+        """components keep all the items, candidates and normalization
+           are over the whole catalog, only the blend is sharded
+        """
+        for model in self.models:
+            model.load()
+            model.init_state()
+        super().load_shard(items_id)
+
+    def ranking(self, user_id, max_n):
+        prepared_n, ranking = self.rankings.get(user_id, (0, None))
+        if prepared_n < max_n:
+            if not self.valid_user(user_id):
+                return -1
+            self.prepare_users([user_id], max_n)
+            ranking = self.rankings[user_id][1]
+        if not ranking:
+            return -1
+        return ranking[:max_n]
+
+    def rank_items(self, user_id):
+        if not self.valid_user(user_id):
+            return -1
+        candidates, blended = self.blend_scores([user_id])
+        if not candidates[0].any():
+            return -1
+        return dict(zip(self.items_id[candidates[0]].tolist(), blended[0, candidates[0]].tolist()))
+
+    @staticmethod
+    def top(items_id, scores, n):
+        """n best items id, best first"""
+        if n < len(scores):
+            best = np.argpartition(-scores, n-1)[:n]
+        else:
+            best = np.arange(len(scores))
+        return items_id[best[np.argsort(-scores[best], kind="stable")]].tolist()
+
+    @Instrument.timed("make_ranking_seconds")
+    def make_ranking(self, user_id, max_n):
+        return self.ranking(user_id, max_n)
+
+    @Instrument.timed("make_recommendation_seconds")
+    def make_recommendation(self, user_id):
+        ranking = self.ranking(user_id, self.n)
+        if isinstance(ranking, int):
+            return ranking
+        return set(ranking)
+
+    def evaluate(self, test_data):
+        return super().evaluate_recommendation(test_data)
@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from base.Model import Model
+from utils.Instrument import Instrument
+
+
+class EASE(Model):
+    """closed form linear item-item model (Steck, 2019)
+
+       the item weights B minimize ||X-XB||^2 + reg*||B||^2 with a
+       zero diagonal, X the users x items 0/1 matrix, and have the
+       closed form
+
+           P = (X'X + reg*I)^-1,  B = -P/diag(P),  diag(B) = 0
+
+       one inversion of the items x items Gram matrix, no epochs; a
+       user's scores are X_u B, one sparse - dense product for a
+       batch of users. Memory is O(items^2), for catalogs up to tens
+       of thousands of items
+    """
+    dtypes = ("float32", "float64")
+
+    def __init__(self, n, data_type, reg=500.0, dtype="float32", block_size=4096,
+                 batch_size=256, ensure_new=True):
+        """
+        Parameters
+        ----------
+        reg : [float]
+            [L2 regularization added to the Gram matrix diagonal]
+        dtype : [str]
+            [float32 halves the memory of the Gram and weight matrices]
+        block_size : [int]
+            [users whose Gram contribution is computed at once, the
+             histories are read (memory mapped when loaded) one block
+             at a time]
+        batch_size : [int]
+            [users scored together with one matrix product]
+        """
+        super().__init__(n, "EASE", data_type, ensure_new=ensure_new)
+        if dtype not in self.dtypes:
+            raise ValueError("Invalid EASE dtype: {}, must be in {}".format(dtype, self.dtypes))
+        self.reg = reg
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.name += "_reg_{}_{}".format(reg, dtype)
+        self.artifact_name = self.name
+
+    def fit(self, event_data):
+        if not super().fit(event_data):
+            self.init_state()
+            with Instrument.stage("train"):
+                self.weights = self.solve(self.gram())
+            self.save()
+        self.init_state()
+
+    def init_state(self):
+        """users x items CSR matrix of the histories over the columns
+           of the weights, items unknown to the weights are dropped
+        """
+        self.users_id, items_id, indptr, indices = self.user_item_csr()
+        if not hasattr(self, "items_id"):
+            self.items_id = items_id
+        columns = pd.Index(self.items_id).get_indexer(items_id)[indices]
+        known = columns >= 0
+        rows = np.repeat(np.arange(len(self.users_id)), np.diff(indptr))
+        indptr = np.r_[0, np.cumsum(np.bincount(rows[known], minlength=len(self.users_id)))]
+        self.user_rows = dict(zip(self.users_id.tolist(), range(len(self.users_id))))
+        self.X = sparse.csr_matrix((np.ones(known.sum(), dtype=self.dtype), columns[known],
+                                    indptr), shape=(len(self.users_id), len(self.items_id)))
+        # columns of the rows of X changed by partial_update, by row
+        self.updated_columns = {}
+        # rankings prepared in batches, by user id
+        self.rankings = {}
+
+    def partial_update(self, events):
+        """the rows of X of the users of the batch are replaced, new
+           users get the next rows; the weights stay those of the fit,
+           new items are not scored and other users keep their rankings
+        """
+        items_index = pd.Index(self.items_id)
+        for user_id in pd.unique(events["visitorid"]).tolist():
+            row = self.user_rows.setdefault(user_id, len(self.user_rows))
+            columns = items_index.get_indexer(list(self.users[user_id].covered_items))
+            self.updated_columns[row] = np.sort(columns[columns >= 0])
+            self.rankings.pop(user_id, None)
+
+    def history_rows(self, user_rows):
+        """users x items CSR of the rows of X of user_rows, rows changed
+           by partial_update included
+        """
+        rows = [self.updated_columns[row] if row in self.updated_columns else
+                self.X.indices[self.X.indptr[row]:self.X.indptr[row+1]] for row in user_rows]
+        indptr = np.r_[0, np.cumsum([len(columns) for columns in rows])]
+        return sparse.csr_matrix((np.ones(indptr[-1], dtype=self.dtype), np.concatenate(rows), indptr),
+                                 shape=(len(user_rows), len(self.items_id)))
+
+    def gram(self):
+        """items x items X'X, summed over blocks of block_size users"""
+        n_items = len(self.items_id)
+        print("[{}] Building the {} x {} Gram matrix...".format(self.name, n_items, n_items))
+        G = np.zeros((n_items, n_items), dtype=self.dtype)
+        for start in range(0, self.X.shape[0], self.block_size):
+            block = self.X[start:start+self.block_size]
+            product = (block.T @ block).tocoo()
+            # a sparse product has no duplicate entries
+            G[product.row, product.col] += product.data
+        return G
+
+    def solve(self, G):
+        """item weights from the Gram matrix, in place"""
+        print("[{}] Solving EASE with reg {}...".format(self.name, self.reg))
+        G[np.diag_indices_from(G)] += self.reg
+        P = np.linalg.inv(G)
+        del G
+        P /= -np.diag(P)
+        P[np.diag_indices_from(P)] = 0
+        return P
+
+    def batch_scores(self, user_rows):
+        """users x items scores of the users of user_rows, touched
+           items are -inf
+        """
+        X = self.history_rows(user_rows)
+        scores = np.asarray(X @ self.weights)
+        touched = X.tocoo()
+        scores[touched.row, touched.col] = -np.inf
+        return scores
+
+    def prepare_users(self, users_id, max_n):
+        """rank the known users of users_id batch_size at a time, the
+           top max_n of every user are kept for make_ranking
+        """
+        users_id = [user_id for user_id in users_id if user_id in self.user_rows]
+        max_n = min(max_n, len(self.items_id))
+        for start in range(0, len(users_id), self.batch_size):
+            batch = users_id[start:start+self.batch_size]
+            scores = self.batch_scores([self.user_rows[user_id] for user_id in batch])
+            best = np.argpartition(-scores, max_n-1, axis=1)[:, :max_n]
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            best = np.take_along_axis(best, np.argsort(-best_scores, axis=1, kind="stable"), axis=1)
+            for i, user_id in enumerate(batch):
+                row = best[i]
+                row = row[np.isfinite(scores[i, row])]
+                self.rankings[user_id] = self.items_id[row].tolist()
+
+    def score_items(self, user_id, items_id):
+        if not self.valid_user(user_id):
+            return -1
+        scores = self.batch_scores([self.user_rows[user_id]])[0].astype(np.float64)
+        scores[np.isinf(scores)] = np.nan
+        rows = pd.Index(self.items_id).get_indexer(items_id)
+        aligned = np.full(len(items_id), np.nan)
+        aligned[rows >= 0] = scores[rows[rows >= 0]]
+        return aligned
+
+    def rank_items(self, user_id):
+        scores = self.score_items(user_id, self.items_id)
+        if isinstance(scores, int):
+            return scores
+        scored = ~np.isnan(scores)
+        return dict(zip(self.items_id[scored].tolist(), scores[scored].tolist()))
+
+    @Instrument.timed("make_ranking_seconds")
+    def make_ranking(self, user_id, max_n):
+        ranking = self.rankings.get(user_id)
+        if ranking is None or (len(ranking) < max_n and
+                               len(ranking) < len(self.items_id)-len(self.users[user_id].covered_items)):
+            if not self.valid_user(user_id):
+                return -1
+            self.prepare_users([user_id], max_n)
+            ranking = self.rankings[user_id]
+        return ranking[:max_n]
+
+    @Instrument.timed("make_recommendation_seconds")
+    def make_recommendation(self, user_id):
+        ranking = self.make_ranking(user_id, self.n)
+        if isinstance(ranking, int):
+            return ranking
+        return set(ranking)
+
+    def evaluate(self, test_data):
+        return super().evaluate_recommendation(test_data)
+
+    @Instrument.staged("save")
+    def save(self):
+        super().save()
+        self.cache.write(self.artifact_path("ease_weights"),
+                         {"items_id": self.items_id, "weights": self.weights})
+        print("[{}] Model saved".format(self.name))
+
+    @Instrument.staged("load")
+    def load(self):
+        super().load()
+        arrays, _ = self.cache.read(self.artifact_path("ease_weights"))
+        self.items_id, self.weights = arrays["items_id"], arrays["weights"]
+        print("[{}] Previous EASE weights found and loaded.".format(self.name))
@@ -1,19 +1,44 @@
-import os
 import pandas as pd
-import pickle
-from base.Model import Model
+import numpy as np
+from scipy import sparse
+from base.Model import Model, T_NOW
+from base.Artifact import Artifact
 from base.User import User
 from base.Item import Item
+from utils.Instrument import Instrument
+from utils.Sim_build import Sim_build
 from math import sqrt, log
 
 class ItemCF(Model):
-    def __init__(self, n, k, data_type, ensure_new=True, timestamp=False):
+    def __init__(self, n, k, data_type, ensure_new=True, timestamp=False, build="dict",
+                 dtype="float32", memory_budget=None, time_budget=None):
+        """
+        Parameters
+        ----------
+        build : [str]
+            [sim matrix build, dict, csr or auto (the fastest within
+             the budgets), see utils/Sim_build.py]
+        dtype : [str]
+            [values of the csr build]
+        memory_budget, time_budget : [float]
+            [bytes and seconds the build may take, the fit is refused
+             before building when the estimate exceeds them]
+        """
         super().__init__(n, "ItemCF", data_type, ensure_new=ensure_new)
         self.k = k
-        self.name += "_k_{}".format(k)
         if timestamp:
             self.name += "_TimeContext"
+        # k is only used when ranking, all k share one sim matrix
+        self.artifact_name = self.name
+        self.name += "_k_{}".format(k)
         self.timestamp = timestamp
+        # all builds save the same float32 sim matrix, they share it
+        self.build = build
+        self.dtype = dtype
+        self.memory_budget = memory_budget
+        self.time_budget = time_budget
+        # columns of item_sim_matrix, all items unless keep_items
+        self.kept_items = None
 
     def update_item_item_sim(self, item_A_info, item_B_info, user_frequency):
         item_A_id, item_A_time = item_A_info
@@ -40,6 +65,7 @@ class ItemCF(Model):
             user_freq = len(user.covered_items)
             # update each items pair for this user
             items = list(user.covered_items.items())
+            Instrument.count("sim_pairs", len(items)*(len(items)-1), model=self.model_type)
             for i in range(len(items)-1):
                 for j in range(i+1, len(items)):
                     item_A_info, item_B_info = items[i], items[j]
@@ -57,15 +83,33 @@ class ItemCF(Model):
     def fit(self, event_data):
         if super().fit(event_data):
             return
-        self.sim_matrix = {}
-        print("[{}] Building item-item similarity matrix, this may take some time...".format(self.name))  # noqa
-        self.compute_item_item_sim_based_on_common_users()
-        self.standardize_sim_values()
+        # cost of the build from the degrees, refused before building
+        sim_build = Sim_build(self.users, "covered_items")
+        plan = sim_build.plan(self.build, self.dtype, self.memory_budget, self.time_budget)
+        print("[{}] Building item-item similarity matrix ({} {}, estimated {:.2f} GB, {:.0f} s), "
+              "this may take some time...".format(self.name, plan["strategy"], plan["dtype"],
+                                                  plan["peak_bytes"]/1e9, plan["seconds"]))
+        with Instrument.stage("build_sim"):
+            if plan["strategy"] == "dict":
+                self.sim_matrix = {}
+                self.compute_item_item_sim_based_on_common_users()
+                self.standardize_sim_values()
+                self.sim_arrays = None
+            else:
+                # standardize_sim_values leaves the sums unchanged, so
+                # does the csr build
+                self.sim_arrays = sim_build.build_csr(self.timestamp, plan["dtype"])
+                self.sim_matrix = Artifact.rows(self.sim_arrays, "sim")
+        if Instrument.enabled:
+            nnz = (len(self.sim_arrays["sim_indices"]) if self.sim_arrays else
+                   sum(len(row) for row in self.sim_matrix.values()))
+            Instrument.count("sim_nnz", nnz, model=self.model_type)
         print("[{}] Build done!".format(self.name))
         self.save()
 
     def rank_potential_items(self, user_id, all_k_sim_items):
         items_rank = {}
+        n_excluded = 0
         history_items_id = all_k_sim_items.keys()
         user = self.users[user_id]
         for history_item_id, items_sim in all_k_sim_items.items():
@@ -74,12 +118,12 @@ class ItemCF(Model):
             t_history_item = user.covered_items[history_item_id]
             for item_id, sim in items_sim:
                 if self.ensure_new and (item_id in history_items_id):
+                    n_excluded += 1
                     continue
                 # compute score
                 if self.timestamp:
                     # user's interest for this history item
-                    t_now = 1146454548
-                    time_elapse = Model.time_elapse(t_now, t_history_item)
+                    time_elapse = Model.time_elapse(T_NOW, t_history_item)
                     score = time_elapse*sim
                 else:
                     # if not consider time context, for history touched items
@@ -90,6 +134,7 @@ class ItemCF(Model):
                 except KeyError:
                     items_rank[item_id] = score
         # assert len(items_rank) >= self.n
+        Instrument.count("items_excluded", n_excluded, model=self.model_type)
         return items_rank
 
     def normalize_k_items_sim(self, k_items):
@@ -109,7 +154,7 @@ class ItemCF(Model):
             # k_items = self.normalize_k_items_sim(k_items)  # never do this!
             history_items[item_id] = self.normalize_k_items_sim(k_items)
 
-    def make_recommendation(self, user_id):
+    def rank_items(self, user_id):
         if not super().valid_user(user_id):
             return -1
         # for each item in the user history, find its k most similar items
@@ -119,37 +164,101 @@ class ItemCF(Model):
         #                   second_similar_item: sim2, ...},
         #  history_item_B: {...}}
         for item_id in history_items_id:
+            # items added by partial_fit have no similar items until
+            # the model is refitted
+            if item_id not in self.sim_matrix:
+                continue
             # Because we need to iter through every history item,
             # for user with large amount of history items list,
             # this step can be SLOW.
-            sim_dict = self.sim_matrix[item_id]
-            # get this item's k most similar items
-            # sorted return list of tuples
-            sim_tuple = sorted(sim_dict.items(),
-                               key=lambda item: item[1],
-                               reverse=True)
-            try:
-                all_k_sim_items[item_id] = sim_tuple[:self.k]
-            except IndexError:
-                all_k_sim_items[item_id] = sim_tuple
+            # get this item's k most similar items, list of tuples
+            all_k_sim_items[item_id] = Model.most_similar(self.sim_matrix, item_id, self.k)
         self.normalize_sim(all_k_sim_items)
-        items_rank = self.rank_potential_items(user_id, all_k_sim_items)
-        items_id = super().get_top_n_items(items_rank)
-        return items_id
+        return self.rank_potential_items(user_id, all_k_sim_items)
+
+    def item_sim_matrix(self):
+        """items x items scipy CSR of the k most similar items of
+           every item, rows normalized to sum 1 as in rank_items, over
+           the items of history_matrix, built once per k, sim matrix
+           and histories, columns are restricted to the kept items
+        """
+        _, items_id, _ = self.history_matrix()
+        key = (self.k, id(self.sim_matrix), self.data_key)
+        cached = getattr(self, "item_sim_cache", None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        items_index = pd.Index(items_id)
+        rows, columns, values = [], [], []
+        for row, item_id in enumerate(items_id.tolist()):
+            if item_id not in self.sim_matrix:
+                continue
+            k_items = self.normalize_k_items_sim(Model.most_similar(self.sim_matrix, item_id, self.k))
+            if self.kept_items is not None:
+                k_items = [(item_id, sim) for item_id, sim in k_items if item_id in self.kept_items]
+            rows.extend([row]*len(k_items))
+            columns.extend(item_id for item_id, _ in k_items)
+            values.extend(sim for _, sim in k_items)
+        columns = items_index.get_indexer(columns)
+        known = columns >= 0
+        matrix = sparse.csr_matrix((np.asarray(values, dtype=np.float64)[known],
+                                    (np.asarray(rows, dtype=np.int64)[known], columns[known])),
+                                   shape=(len(items_id), len(items_id)))
+        self.item_sim_cache = key, matrix
+        return matrix
+
+    def score_users(self, users_id, items_id):
+        """history items weighted as in rank_potential_items times the
+           k most similar items matrix, one sparse product for all the
+           users, touched items are NaN
+        """
+        users_index, history_items_id, history = self.history_matrix()
+        rows = users_index.get_indexer(users_id)
+        known = rows >= 0
+        weights = history[rows[known]]
+        touched = weights.copy()
+        if self.timestamp:
+            weights.data = Model.time_elapse(T_NOW, weights.data)
+        else:
+            weights.data = np.ones(len(weights.data))
+        product = weights @ self.item_sim_matrix()
+        scores = np.full((len(users_id), len(items_id)), np.nan)
+        scores[known] = Model.sparse_scores(product, history_items_id, items_id,
+                                            touched if self.ensure_new else None)
+        return scores
+
+    def keep_items(self, items_id):
+        """score_users only scores the items of items_id, the k most
+           similar items matrix keeps their columns, normalized over
+           the whole rows as before; built here, not on the first
+           request
+        """
+        self.kept_items = set(np.asarray(items_id).tolist())
+        self.item_sim_cache = None
+        self.item_sim_matrix()
+
+    def score_items(self, user_id, items_id):
+        if not super().valid_user(user_id):
+            return -1
+        return self.score_users([user_id], items_id)[0]
 
     def evaluate(self, test_data):
         return super().evaluate_recommendation(test_data)
 
+    @Instrument.staged("save")
     def save(self):
         super().save()
-        sim_matrix = os.path.join('models/saved_models/sim_matrix_{}'.format(self.name + '.pickle'))
-        with open(sim_matrix, 'wb') as f:
-            f.write(pickle.dumps(self.sim_matrix))
+        # rows sorted by decreasing similarity, float32 is enough for ranking
+        # the csr build writes its arrays directly
+        arrays = getattr(self, "sim_arrays", None)
+        if arrays is None:
+            arrays = Artifact.pack_rows({}, "sim", self.sim_matrix,
+                                        value_dtype=np.float32, sort_desc=True)
+        self.cache.write(self.artifact_path("sim_matrix"), arrays)
         print("[{}] Model saved.".format(self.name))
 
+    @Instrument.staged("load")
     def load(self):
         super().load()
-        sim_matrix = os.path.join('models/saved_models/sim_matrix_{}'.format(self.name + '.pickle'))
-        with open(sim_matrix, 'rb') as f:
-            self.sim_matrix = pickle.loads(f.read())
+        arrays, _ = self.cache.read(self.artifact_path("sim_matrix"))
+        self.sim_matrix = Artifact.rows(arrays, "sim")
         print("[{}] Previous sim matrix found and loaded.".format(self.name))  # noqa
@@ -1,7 +1,7 @@
 import os
+import shutil
 import pandas as pd
 import numpy as np
-import pickle
 import keras
 from sklearn.model_selection import train_test_split
 from keras.layers import Input, Embedding, Flatten, dot, Dense, Concatenate, Add  # noqa
@@ -9,19 +9,96 @@ from keras.models import load_model
 from keras import optimizers
 import tensorflow as tf
 from base.Model import Model
+from utils.Instrument import Instrument
+from utils.Cache import Cache
+from utils.Serving import Serving
+from utils.ALS import ALS
+from utils.Negative_sequence import Negative_sequence
+from utils.Warm_start import Warm_start
+from utils.Train_config import Train_config
 from base.Item import Item
 from base.User import User
 
 EMBEDDING_DIM = 200
 
+
+class LFM_serving(tf.Module):
+    """traced serving signature of a LFM keras model"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    @tf.function(input_signature=[tf.TensorSpec([None], tf.int64, name="itemid"),
+                                  tf.TensorSpec([], tf.int64, name="visitorid")])
+    def serve(self, itemid, visitorid):
+        item_input, user_input = self.model.inputs
+        itemid = tf.reshape(tf.cast(itemid, item_input.dtype), (-1, 1))
+        visitorid = tf.fill(tf.shape(itemid), tf.cast(visitorid, user_input.dtype))
+        score = self.model([itemid, visitorid], training=False)
+        return {"score": tf.reshape(score, (-1,))}
+
+
 class LFM(Model):
-    def __init__(self, data_type, n, neg_frac_in_train, merge_type="dot", ensure_new=True):
+    # keras item embedding rows follow self.items_id, see keep_items
+    sliced_embedding = False
+
+    def __init__(self, data_type, n, neg_frac_in_train=None, merge_type="dot", ensure_new=True,
+                 trainer="keras", als_params=None, sampling="stream", batch_size=256,
+                 workers=None, train_config=None):
+        """
+        Parameters
+        ----------
+        trainer : [str]
+            [keras: embedding model trained on negative samples,
+             als: implicit feedback ALS (utils/ALS.py), trained on the
+             events only, neg_frac_in_train and merge_type are unused]
+        als_params : [dict]
+            [kwargs of ALS, e.g. dim, alpha, reg, iterations]
+        sampling : [str]
+            [keras trainer only, stream: fit on the events, fresh
+             negatives are drawn per batch (utils/Negative_sequence.py),
+             static: fit on samples from Data_util.build_samples]
+        batch_size : [int]
+            [positives per batch when streaming]
+        workers : [int]
+            [threads building batches when streaming, default all cores]
+        train_config : [Train_config, dict or str]
+            [keras trainer only, CPU training settings (threads, XLA,
+             batch size), "tuned" for the config persisted by
+             Train_config.autotune, see utils/Train_config.py]
+        """
         super().__init__(n, "LFM", data_type, ensure_new)
-        self.name += "_neg_{}_{}".format(neg_frac_in_train, merge_type)
+        if trainer == "keras":
+            if sampling not in ("stream", "static"):
+                raise ValueError("Invalid LFM sampling: {}, must be stream or static".format(sampling))  # noqa
+            self.name += "_neg_{}_{}".format(neg_frac_in_train, merge_type)
+            if sampling == "stream":
+                self.name += "_stream"
+        elif trainer == "als":
+            self.als = ALS(**(als_params or {}))
+            self.name += "_als_dim_{}_alpha_{}_reg_{}_iter_{}".format(
+                self.als.dim, self.als.alpha, self.als.reg, self.als.iterations)
+        else:
+            raise ValueError("Invalid LFM trainer: {}, must be keras or als".format(trainer))
+        self.trainer = trainer
+        self.sampling = sampling
+        self.neg_frac = neg_frac_in_train
+        self.batch_size = batch_size
+        self.train_config = Train_config.create(train_config, data_type, "LFM")
+        if trainer == "keras":
+            self.name += self.train_config.name_suffix(self.base_batch_size())
+        self.workers = workers or os.cpu_count() or 1
+        self.artifact_name = self.name
         self.n = n
         self.ensure_new = ensure_new
         self.merge_type = merge_type
 
+    def base_batch_size(self):
+        """batch size the learning rate is tuned for, static samples
+           use the keras fit default
+        """
+        return self.batch_size if self.sampling == "stream" else 32
+
     def dot_structure(self, item_vec, user_vec):
         # dot product of user vec and item vec
         dot_product = dot([item_vec, user_vec],
@@ -85,7 +162,7 @@ class LFM(Model):
                         name='output')(dense_4)
         return out_put
 
-    def construct_model(self):
+    def construct_model(self, verbose=True):
         """
             input_dim for embedding layer
             should larger than the maximum possible id number
@@ -96,6 +173,8 @@ class LFM(Model):
 
             using (max_id+1) as input dim will be all good,
             except that may cause some waste of memory
+
+            verbose: plot the model structure and print its summary
         """
         # struct for item, input for embedding layer must be int
         item_input = Input(shape=[1], name='Item')
@@ -121,40 +200,143 @@ class LFM(Model):
         else:
             raise ValueError('Invalid embeds merge type provided!')
         self.model = keras.Model([item_input, user_input], out_put)
-        optimizer = optimizers.Adam(lr=0.0001)
+        optimizer = optimizers.Adam(learning_rate=self.train_config.learning_rate(0.0001, self.base_batch_size()))
         self.model.compile(optimizer,
                            loss="binary_crossentropy",
-                           metrics=["accuracy"])
+                           metrics=["accuracy"],
+                           **self.train_config.compile_kwargs())
+        if not verbose:
+            return
         keras.utils.plot_model(self.model,
                                to_file='models/model_struc/model_{}.png'.format(self.merge_type),
                                show_shapes=True, show_layer_names=True)
         self.model.summary()
 
     def fit(self, samples):
+        if self.trainer == "als":
+            return self.fit_als(samples)
         # record user's history items in the training data
-        assert len(pd.unique(samples['event'])) == 2
-        events = samples.loc[samples['event'] == 1, :]
+        if self.sampling == "stream":
+            # only events, negatives are drawn while training
+            events = samples
+        else:
+            assert len(pd.unique(samples['event'])) == 2
+            events = samples.loc[samples['event'] == 1, :]
+        # the keras model also depends on the negative samples
+        self.samples_key = Cache.fingerprint(samples)
         if super().fit(events):
             return
         del events
         # try to load previous trained model
         try:
-            self.model = load_model("models/saved_models/{}.h5".format(self.name))
+            self.load_keras_model()
+            self.load_serving()
             return
         except OSError:
             print("[{}] Previous model not found, train a new model".format(self.name))
-        # convert id to int for embedding layers
-        self.max_user_id = max(samples['visitorid'])
-        self.max_item_id = max(samples['itemid'])
+        if self.sampling == "stream":
+            positives = self.user_item_csr()
+            users_id, items_id = positives[:2]
+            self.max_user_id, self.max_item_id = int(users_id.max()), int(items_id.max())
+        else:
+            # convert id to int for embedding layers
+            self.max_user_id = max(samples['visitorid'])
+            self.max_item_id = max(samples['itemid'])
+        # thread pools before the first tensorflow op
+        self.train_config.apply()
         self.construct_model()
-        self.train(samples)
+        with Instrument.stage("train"):
+            if self.sampling == "stream":
+                self.train_stream(*positives)
+            else:
+                self.train(samples)
         self.save()
+        self.load_serving()
+
+    def fit_als(self, events):
+        """events are the positive training events only, ALS needs no
+           negative samples
+        """
+        if super().fit(events):
+            return
+        users_id, items_id, indptr, indices = self.user_item_csr()
+        print("[{}] Training implicit ALS...".format(self.name))
+        with Instrument.stage("train"):
+            self.als.fit(indptr, indices, len(items_id))
+        self.set_factors(users_id, items_id, self.als.user_factors, self.als.item_factors)
+        self.save()
+
+    def set_factors(self, users_id, items_id, user_factors, item_factors):
+        self.users_id, self.items_id = users_id, items_id
+        self.user_factors, self.item_factors = user_factors, item_factors
+        self.user_rows = {user_id: row for row, user_id in enumerate(users_id.tolist())}
+
+    def train_stream(self, users_id, items_id, indptr, indices):
+        """negatives are drawn per batch and epoch by parallel workers,
+           memory stays O(positives)
+        """
+        batch_size = self.train_config.training_batch_size(self.batch_size)
+        sequence = Negative_sequence(users_id, items_id, indptr, indices,
+                                     self.neg_frac, batch_size=batch_size,
+                                     workers=self.workers, max_queue_size=2*self.workers)
+        self.model.fit(sequence, **self.train_config.fit_kwargs(30))
+
+    def update(self, events, epochs=3, replay_frac=1.0):
+        """warm start: fold new events into the fitted keras model,
+           embedding tables grow for unseen user and item ids (old rows
+           kept), then the model trains a few epochs on the new events
+           plus a replay sample of old ones, negatives drawn per batch;
+           epochs are checkpointed so an interrupted update resumes
+
+        Parameters
+        ----------
+        events : [pd.DataFrame]
+            [new positive events, visitorid, itemid and timestamp]
+        epochs : [int]
+            [training epochs of the update]
+        replay_frac : [float]
+            [old events replayed per new event]
+        """
+        if self.trainer != "keras":
+            raise ValueError("LFM update needs the keras trainer, refit the {} trainer instead".format(self.trainer))  # noqa
+        update_key = Cache.key(self.samples_key, Cache.fingerprint(events), epochs, replay_frac)
+        old_users_id, old_items_id, old_indptr, old_indices = self.user_item_csr()
+        replay_rows, replay_cols = Warm_start.replay_sample(
+            old_indptr, old_indices, int(replay_frac*len(events)), Warm_start.seed(update_key))
+        self.update_history(events)
+        users_id, items_id, indptr, indices = self.user_item_csr()
+        # new and replayed positives over the updated histories
+        users_index, items_index = pd.Index(users_id), pd.Index(items_id)
+        rows = np.r_[users_index.get_indexer(events["visitorid"]),
+                     users_index.get_indexer(old_users_id[replay_rows])]
+        cols = np.r_[items_index.get_indexer(events["itemid"]),
+                     items_index.get_indexer(old_items_id[replay_cols])]
+        train_indptr, train_indices = Warm_start.csr(rows, cols, len(users_id), len(items_id))
+        # grow the embedding tables, layers keep their names
+        old_model = self.model
+        self.max_user_id = int(max(old_model.get_layer("user_embedding").input_dim-1, users_id.max()))
+        self.max_item_id = int(max(old_model.get_layer("item_embedding").input_dim-1, items_id.max()))
+        self.construct_model()
+        Warm_start.grow_weights(old_model, self.model)
+        sequence = Negative_sequence(users_id, items_id, train_indptr, train_indices,
+                                     self.neg_frac, batch_size=self.batch_size,
+                                     touched=(indptr, indices), workers=self.workers,
+                                     max_queue_size=2*self.workers)
+        checkpoint_path = self.cache.path("update_checkpoint", update_key)
+        print("[{}] Updating with {} new and {} replayed events...".format(
+            self.name, len(events), len(replay_rows)))
+        self.model = Warm_start.train(self.model, sequence, epochs, checkpoint_path, load_model)
+        self.samples_key = update_key
+        self.save()
+        self.load_serving()
+        shutil.rmtree(checkpoint_path, ignore_errors=True)
 
     def train(self, train_data):
         self.model.fit([train_data['itemid'],
                         train_data['visitorid']],
                        train_data['event'],
-                       epochs=30)
+                       batch_size=self.train_config.training_batch_size(self.base_batch_size()),
+                       **self.train_config.fit_kwargs(30))
 
     def evaluate_prediction(self, test_data):
         # input order must corresponding to the model input building order
@@ -163,10 +345,9 @@ class LFM(Model):
                                      y=np.array([1 for _ in range(len(test_data))]).reshape(len(test_data), 1))
         print(result)
 
-    def make_recommendation(self, user_id):
-        """
-            use batches to predict user's interest to all items
-            much faster than predict one sample at a time
+    def candidates(self, user_id):
+        """mask of the items not touched by the user over self.items_id,
+           -1 if the user is unknown
         """
         try:
             user = self.users[user_id]
@@ -174,37 +355,187 @@ class LFM(Model):
             print('User {} not shown in the training set.'.format(user_id))
             return -1
         history_items = user.covered_items
-        samples = []
-        for item_id, item in self.items.items():
-            if item_id in history_items:
-                continue
-            samples.append([item_id, user_id])
+        Instrument.count("items_excluded", len(history_items), model=self.model_type)
+        if not hasattr(self, "items_id"):
+            self.items_id = np.fromiter(self.items, dtype=np.int64, count=len(self.items))
+        return ~np.isin(self.items_id, list(history_items))
+
+    def rank_items(self, user_id):
+        """
+            score all candidate items, ALS factors with one matrix
+            vector product, keras models with the compiled serving
+            signature, batches run in parallel over the cores
+        """
+        candidates = self.candidates(user_id)
+        if isinstance(candidates, int):
+            return candidates
+        items_id = self.items_id[candidates]
+        if self.trainer == "als":
+            interests = self.item_factors[candidates] @ self.user_factors[self.user_rows[user_id]]
+        else:
+            inputs = np.flatnonzero(candidates) if self.sliced_embedding else items_id
+            interests = Serving.predict(self.serving, {"itemid": inputs},
+                                        {"visitorid": np.int64(user_id)})
+        return dict(zip(items_id.tolist(), interests.tolist()))
+
+    def score_items(self, user_id, items_id):
+        """score the given items directly, touched and unknown items
+           are NaN
+        """
+        candidates = self.candidates(user_id)
+        if isinstance(candidates, int):
+            return candidates
+        rows = pd.Index(self.items_id).get_indexer(items_id)
+        known = rows >= 0
+        known[known] = candidates[rows[known]]
+        scores = np.full(len(items_id), np.nan)
+        if self.trainer == "als":
+            scores[known] = self.item_factors[rows[known]] @ self.user_factors[self.user_rows[user_id]]
+        elif known.any():
+            inputs = rows[known] if self.sliced_embedding else np.asarray(items_id)[known]
+            scores[known] = Serving.predict(self.serving, {"itemid": inputs.astype(np.int64)},
+                                            {"visitorid": np.int64(user_id)})
+        return scores
+
+    def keep_items(self, items_id):
+        """keep the factors or item embedding rows of the items of
+           items_id only
+        """
+        items_id = np.asarray(items_id)
+        if self.trainer == "als":
+            rows = pd.Index(self.items_id).get_indexer(items_id)
+            assert (rows >= 0).all(), "unknown items to keep"
+            self.item_factors = np.ascontiguousarray(self.item_factors[rows])
+            self.items_id = items_id
+            return
+        weights = {layer.name: layer.get_weights() for layer in self.model.layers}
+        weights["item_embedding"] = [weights["item_embedding"][0][items_id]]
+        self.shard_model(items_id, weights)
+
+    def shard_model(self, items_id, weights):
+        """in memory model whose item embedding rows are the items of
+           items_id, served without export
+
+        Parameters
+        ----------
+        weights : [dict]
+            [layer name -> weights, item embedding rows of items_id]
+        """
+        self.max_user_id = len(weights["user_embedding"][0])-1
+        self.max_item_id = len(items_id)-1
+        self.construct_model(verbose=False)
+        for layer in self.model.layers:
+            if weights.get(layer.name):
+                layer.set_weights(weights[layer.name])
+        self.serving = Serving.wrap(LFM_serving(self.model))
+        self.items_id = items_id
+        self.sliced_embedding = True
+
+    def load_shard(self, items_id):
+        """keras models read their weights from the saved h5 file, of
+           the item embedding only the rows of items_id are read, for
+           any item -> shard assignment, neither the full model nor its
+           serving signature is loaded
+        """
+        if self.trainer == "als":
+            return super().load_shard(items_id)
+        # installed with keras
+        import h5py
+        Model.load(self)
+        items_id = np.asarray(items_id)
+        path = self.keras_model_path()
+        weights = {}
+        with h5py.File(os.path.join(path, "model.h5"), "r") as f:
+            for name, group in f["model_weights"].items():
+                names = [weight_name.decode() if isinstance(weight_name, bytes) else weight_name
+                         for weight_name in group.attrs.get("weight_names", [])]
+                if name == "item_embedding":
+                    # h5py reads the rows of increasing indices only
+                    order = np.argsort(items_id)
+                    rows = np.empty((len(items_id),)+group[names[0]].shape[1:],
+                                    dtype=group[names[0]].dtype)
+                    rows[order] = group[names[0]][items_id[order]]
+                    weights[name] = [rows]
+                else:
+                    weights[name] = [group[weight_name][()] for weight_name in names]
+        self.cache.touch(path)
+        self.shard_model(items_id, weights)
+
+    def shard_spec(self):
+        spec = super().shard_spec()
+        spec.train_config = Train_config(**self.train_config.to_dict())
+        return spec
+
+    def predict_rank_items(self, user_id):
+        """
+            use batches to predict user's interest to all items
+            much faster than predict one sample at a time,
+            keras predict loop, kept for comparison with rank_items
+        """
+        candidates = self.candidates(user_id)
+        if isinstance(candidates, int):
+            return candidates
+        items_id = self.items_id[candidates]
         # prepare inputs (list of itemid array and userid array) to predict
         # array's shape is (n_samples * n_values_persample)
-        itemid_input = np.array([sample[0] for sample in samples]).reshape(len(samples), 1)
-        userid_input = np.array([sample[1] for sample in samples]).reshape(len(samples), 1)
+        itemid_input = items_id.reshape(len(items_id), 1)
+        userid_input = np.full((len(items_id), 1), user_id, dtype=np.int64)
         inputs = [itemid_input, userid_input]
         # make prediction
         interests = self.model.predict(inputs, batch_size=128)
-        items_rank = {}
-        for item_id, interest in zip(itemid_input, interests):
-            items_rank[item_id[0]] = interest[0]
-        reco_items = super().get_top_n_items(items_rank)
-        return reco_items
+        return dict(zip(items_id.tolist(), interests[:, 0].tolist()))
 
     def evaluate(self, test_data):
         # convert id to int
         # self.evaluate_prediction(test_data)
         return super().evaluate_recommendation(test_data)
 
+    def keras_model_path(self):
+        return self.artifact_path("keras_model", self.samples_key, self.artifact_name)
+
+    def load_keras_model(self):
+        path = self.keras_model_path()
+        self.model = load_model(os.path.join(path, "model.h5"))
+        self.cache.touch(path)
+
+    def serving_path(self):
+        return self.artifact_path("serving_model", self.samples_key, self.artifact_name)
+
+    def export_serving(self):
+        self.cache.write_with(self.serving_path(),
+                              lambda path: Serving.export(LFM_serving(self.model), path))
+
+    def load_serving(self):
+        """load the SavedModel serving signature, export it if missing"""
+        self.export_serving()
+        path = self.serving_path()
+        self.serving = Serving.load(path)
+        self.cache.touch(path)
+
+    @Instrument.staged("save")
     def save(self):
         super().save()
-        keras_model = os.path.join('models/saved_models/keras_model_{}'.format(self.name + '.h5'))
-        self.model.save(keras_model)
+        if self.trainer == "als":
+            self.cache.write(self.artifact_path("als_factors"),
+                             {"users_id": self.users_id, "items_id": self.items_id,
+                              "user_factors": self.user_factors,
+                              "item_factors": self.item_factors})
+            print("[{}] Model saved".format(self.name))
+            return
+        self.cache.write_with(self.keras_model_path(),
+                              lambda path: self.model.save(os.path.join(path, "model.h5")))
+        self.export_serving()
         print("[{}] Model saved".format(self.name))
 
+    @Instrument.staged("load")
     def load(self):
         super().load()
-        keras_model = os.path.join('models/saved_models/keras_model_{}'.format(self.name + '.h5'))
-        self.model = load_model(keras_model)
-        print("[{}] Previous keras model found and loaded.".format(self.name))
\ No newline at end of file
+        if self.trainer == "als":
+            arrays, _ = self.cache.read(self.artifact_path("als_factors"))
+            self.set_factors(arrays["users_id"], arrays["items_id"],
+                             arrays["user_factors"], arrays["item_factors"])
+            print("[{}] Previous ALS factors found and loaded.".format(self.name))
+            return
+        self.load_keras_model()
+        self.load_serving()
+        print("[{}] Previous keras model found and loaded.".format(self.name))
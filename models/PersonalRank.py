@@ -0,0 +1,241 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from base.Model import Model
+from utils.Instrument import Instrument
+
+
+class PersonalRank(Model):
+    """random walk with restart on the users - items bipartite graph
+       (personalized PageRank)
+
+       from a user the walker goes to one of its items, from an item
+       to one of its users, both uniformly, and with probability
+       1-alpha jumps back to the user; the stationary probability of
+       the items is their score. It is computed by power iteration
+       with the degree normalized adjacency matrices
+
+           items = alpha*P_ui'users,  users = alpha*P_iu'items + (1-alpha)*e_u
+
+       for batch_size users at once as dense (nodes x users) score
+       blocks, one sparse matrix - dense block product per side and
+       iteration (the error shrinks by alpha**2 per iteration), until
+       every column moved less than tol (L1) or max_iter iterations
+
+       partial_update corrects the columns of the matrices whose
+       degrees changed with sparse deltas, the matrices of init_state
+       are kept
+    """
+    def __init__(self, n, data_type, alpha=0.8, max_iter=30, tol=1e-4, batch_size=256,
+                 ensure_new=True):
+        """
+        Parameters
+        ----------
+        alpha : [float]
+            [probability of walking on, 1-alpha is the restart
+             probability]
+        max_iter : [int]
+            [maximum number of power iterations]
+        tol : [float]
+            [stop when the L1 change of every user's scores is below]
+        batch_size : [int]
+            [users iterated together as one dense block]
+        """
+        super().__init__(n, "PersonalRank", data_type, ensure_new=ensure_new)
+        if not 0 < alpha < 1:
+            raise ValueError("Invalid PersonalRank alpha: {}, must be in (0, 1)".format(alpha))
+        self.alpha = alpha
+        self.max_iter = max_iter
+        self.tol = tol
+        self.batch_size = batch_size
+        # only the histories are saved, the graph is built from them
+        self.artifact_name = self.name
+        self.name += "_alpha_{}".format(alpha)
+
+    def fit(self, event_data):
+        if not super().fit(event_data):
+            self.save()
+        self.init_state()
+
+    def init_state(self):
+        """degree normalized transition matrices of the graph, float32"""
+        self.users_id, self.items_id, indptr, indices = self.user_item_csr()
+        self.user_rows = dict(zip(self.users_id.tolist(), range(len(self.users_id))))
+        self.item_rows = dict(zip(self.items_id.tolist(), range(len(self.items_id))))
+        self.indptr, self.indices = indptr, indices
+        shape = (len(self.users_id), len(self.items_id))
+        R = sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                              shape=shape)
+        users_degree = np.maximum(np.diff(indptr), 1).astype(np.float32)
+        items_degree = np.maximum(np.bincount(indices, minlength=shape[1]), 1).astype(np.float32)
+        # items x users: item scores from the users ones, and back
+        self.to_items = sparse.csr_matrix(R.T.multiply(1/users_degree[None, :]))
+        self.to_users = sparse.csr_matrix(R.multiply(1/items_degree[None, :]))
+        # users of every item, the columns of to_users
+        R = R.tocsc()
+        self.item_indptr, self.item_indices = R.indptr, R.indices
+        # rows (items of a user, users of an item) changed by
+        # partial_update, by column of to_items and to_users, and the
+        # corrections of the matrices
+        self.user_items, self.item_users = {}, {}
+        self.items_delta = sparse.csr_matrix(self.to_items.shape, dtype=np.float32)
+        self.users_delta = sparse.csr_matrix(self.to_users.shape, dtype=np.float32)
+        # rankings prepared in batches, by user id
+        self.rankings = {}
+
+    def partial_update(self, events):
+        """new users and items get the next rows, the columns of the
+           users and items of the batch are normalized with their new
+           degrees: the deltas get the new columns minus the previous
+           ones, O(edges of the batch users and items)
+        """
+        users_id = pd.unique(events["visitorid"]).tolist()
+        items_id = pd.unique(events["itemid"]).tolist()
+        for user_id in users_id:
+            self.user_rows.setdefault(user_id, len(self.user_rows))
+        new_items_id = [item_id for item_id in items_id if item_id not in self.item_rows]
+        for item_id in new_items_id:
+            self.item_rows[item_id] = len(self.item_rows)
+        if new_items_id:
+            self.items_id = np.r_[self.items_id, np.array(new_items_id, dtype=self.items_id.dtype)]
+        user_items = {self.user_rows[user_id]: np.array(
+            [self.item_rows[item_id] for item_id in self.users[user_id].covered_items], dtype=np.int64)
+            for user_id in users_id}
+        item_users = {self.item_rows[item_id]: np.array(
+            [self.user_rows[user_id] for user_id in self.items[item_id].covered_users], dtype=np.int64)
+            for item_id in items_id}
+        shape = (len(self.item_rows), len(self.user_rows))
+        self.items_delta = self.column_delta(self.items_delta, user_items, [
+            self.history(row) for row in user_items], shape)
+        self.users_delta = self.column_delta(self.users_delta, item_users, [
+            self.column_rows(self.item_users, self.item_indptr, self.item_indices, row)
+            for row in item_users], shape[::-1])
+        self.user_items.update(user_items)
+        self.item_users.update(item_users)
+        # every score depends on the whole graph
+        self.rankings = {}
+
+    @staticmethod
+    def column_delta(delta, changed_rows, previous_rows, shape):
+        """delta resized to shape plus, for every column j of
+           changed_rows, its normalized column of the rows
+           changed_rows[j] minus the previous one
+        """
+        columns = np.fromiter(changed_rows, dtype=np.int64, count=len(changed_rows))
+        rows = list(changed_rows.values())+previous_rows
+        lengths = np.array([len(column_rows) for column_rows in rows], dtype=np.int64)
+        signs = np.r_[np.ones(len(columns)), -np.ones(len(columns))]
+        values = np.repeat(signs/np.maximum(lengths, 1), lengths).astype(np.float32)
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        delta = delta.copy()
+        delta.resize(shape)
+        delta = delta+sparse.csr_matrix((values, (rows, np.repeat(np.r_[columns, columns], lengths))),
+                                        shape=shape)
+        # columns changed back and forth cancel out exactly
+        delta.eliminate_zeros()
+        return delta
+
+    @staticmethod
+    def column_rows(changed_rows, indptr, indices, column):
+        """rows of a column: changed by partial_update, of init_state
+           or none for the columns added since
+        """
+        try:
+            return changed_rows[column]
+        except KeyError:
+            pass
+        if column < len(indptr)-1:
+            return indices[indptr[column]:indptr[column+1]]
+        return np.zeros(0, dtype=np.int64)
+
+    @staticmethod
+    def propagate(matrix, delta, block):
+        """(matrix + delta) @ block, matrix covers the first rows and
+           columns of delta
+        """
+        product = delta @ block
+        product[:matrix.shape[0]] += matrix @ block[:matrix.shape[1]]
+        return product
+
+    def history(self, user_row):
+        """items rows of a user's history"""
+        return self.column_rows(self.user_items, self.indptr, self.indices, user_row)
+
+    def walk(self, user_rows):
+        """items x users score block of the users of user_rows"""
+        n_users = len(user_rows)
+        restart = np.zeros((len(self.user_rows), n_users), dtype=np.float32)
+        restart[user_rows, np.arange(n_users)] = 1-self.alpha
+        users = restart.copy()
+        items = np.zeros((len(self.items_id), n_users), dtype=np.float32)
+        for iteration in range(self.max_iter):
+            # users are updated from the new items: in the synchronous
+            # update the odd and even steps are two independent walks
+            new_items = self.alpha*self.propagate(self.to_items, self.items_delta, users)
+            new_users = self.alpha*self.propagate(self.to_users, self.users_delta, new_items)+restart
+            change = np.abs(new_items-items).sum(axis=0)+np.abs(new_users-users).sum(axis=0)
+            users, items = new_users, new_items
+            if change.max() < self.tol:
+                break
+        Instrument.observe("power_iterations", iteration+1, Instrument.size_buckets,
+                           model=self.model_type)
+        # history exclusion
+        histories = [self.history(row) for row in user_rows]
+        lengths = [len(history) for history in histories]
+        items[np.concatenate(histories), np.repeat(np.arange(n_users), lengths)] = -np.inf
+        return items
+
+    def prepare_users(self, users_id, max_n):
+        """rank the known users of users_id batch_size at a time, the
+           top max_n of every user are kept for make_ranking
+        """
+        users_id = [user_id for user_id in users_id if user_id in self.user_rows]
+        max_n = min(max_n, len(self.items_id))
+        for start in range(0, len(users_id), self.batch_size):
+            batch = users_id[start:start+self.batch_size]
+            scores = self.walk([self.user_rows[user_id] for user_id in batch])
+            best = np.argpartition(-scores, max_n-1, axis=0)[:max_n]
+            best_scores = np.take_along_axis(scores, best, axis=0)
+            best = np.take_along_axis(best, np.argsort(-best_scores, axis=0, kind="stable"), axis=0)
+            for j, user_id in enumerate(batch):
+                column = best[:, j]
+                column = column[np.isfinite(scores[column, j])]
+                self.rankings[user_id] = self.items_id[column].tolist()
+
+    def score_items(self, user_id, items_id):
+        if not self.valid_user(user_id):
+            return -1
+        scores = self.walk([self.user_rows[user_id]])[:, 0].astype(np.float64)
+        scores[np.isinf(scores)] = np.nan
+        rows = pd.Index(self.items_id).get_indexer(items_id)
+        aligned = np.full(len(items_id), np.nan)
+        aligned[rows >= 0] = scores[rows[rows >= 0]]
+        return aligned
+
+    def rank_items(self, user_id):
+        scores = self.score_items(user_id, self.items_id)
+        if isinstance(scores, int):
+            return scores
+        scored = ~np.isnan(scores)
+        return dict(zip(self.items_id[scored].tolist(), scores[scored].tolist()))
+
+    @Instrument.timed("make_ranking_seconds")
+    def make_ranking(self, user_id, max_n):
+        ranking = self.rankings.get(user_id)
+        if ranking is None or (len(ranking) < max_n and
+                               len(ranking) < len(self.items_id)-len(self.users[user_id].covered_items)):
+            if not self.valid_user(user_id):
+                return -1
+            self.prepare_users([user_id], max_n)
+            ranking = self.rankings[user_id]
+        return ranking[:max_n]
+
+    @Instrument.timed("make_recommendation_seconds")
+    def make_recommendation(self, user_id):
+        ranking = self.make_ranking(user_id, self.n)
+        if isinstance(ranking, int):
+            return ranking
+        return set(ranking)
+
+    def evaluate(self, test_data):
+        return super().evaluate_recommendation(test_data)
@@ -1,4 +1,7 @@
+import numpy as np
+import pandas as pd
 from base.Model import Model
+from utils.Instrument import Instrument
 
 
 class Popular(Model):
@@ -6,25 +9,75 @@ class Popular(Model):
         super().__init__(n, "MostPopular", data_type, ensure_new=ensure_new)
 
     def fit(self, event_data):
-        super().fit(event_data)
-        # sort items by popularity, return a sorted list of tuples
-        self.items = sorted(self.items.items(),
-                            key=lambda item: len(item[1].covered_users),
-                            reverse=True)
-        self.items = dict(self.items)
-        self.save()
+        if not super().fit(event_data):
+            self.save()
+        self.init_state()
 
-    def make_recommendation(self, user_id):
+    def init_state(self):
+        # histories are shared with other models, keep the items
+        # popularity aside, sorted on first use
+        self.popularity = self.items_popularity()
+        self.popular_items = self.popularity_series = None
+
+    def partial_update(self, events):
+        for item_id in pd.unique(events["itemid"]).tolist():
+            self.popularity[int(item_id)] = len(self.items[int(item_id)].covered_users)
+        self.popular_items = self.popularity_series = None
+
+    def sorted_items(self):
+        """items by decreasing popularity, ties by increasing id as in
+           Shard_serving.local_top, whatever the order items were added
+        """
+        if self.popular_items is None:
+            self.popular_items = sorted(self.popularity,
+                                        key=lambda item_id: (-self.popularity[item_id], item_id))
+        return self.popular_items
+
+    def rank_items(self, user_id):
+        history_items = self.users[user_id].covered_items
+        return {item_id: pop for item_id, pop in self.popularity.items()
+                if item_id not in history_items}
+
+    def score_items(self, user_id, items_id):
+        if self.popularity_series is None:
+            self.popularity_series = pd.Series(self.popularity, dtype=np.float64)
+        scores = self.popularity_series.reindex(items_id).to_numpy(copy=True)
+        scores[np.isin(items_id, list(self.users[user_id].covered_items))] = np.nan
+        return scores
+
+    def score_users(self, users_id, items_id):
+        if self.popularity_series is None:
+            self.popularity_series = pd.Series(self.popularity, dtype=np.float64)
+        users_index, history_items_id, history = self.history_matrix()
+        rows = users_index.get_indexer(users_id)
+        known = rows >= 0
+        scores = np.full((len(users_id), len(items_id)), np.nan)
+        scores[known] = self.popularity_series.reindex(items_id).to_numpy()
+        # touched items
+        touched = history[rows[known]].tocoo()
+        columns = pd.Index(items_id).get_indexer(history_items_id[touched.col])
+        found = columns >= 0
+        scores[known.nonzero()[0][touched.row[found]], columns[found]] = np.nan
+        return scores
+
+    @Instrument.timed("make_ranking_seconds")
+    def make_ranking(self, user_id, max_n):
+        # items are sorted by popularity, stop at the first max_n new ones
         user = self.users[user_id]
         history_items = user.covered_items
-        items_rank = set()
-        for item_id, item in self.items.items():
+        items_rank = []
+        for item_id in self.sorted_items():
             if item_id in history_items:
                 continue
-            items_rank.add(item_id)
-            if len(items_rank) == self.n:
+            items_rank.append(item_id)
+            if len(items_rank) == max_n:
                 break
-        else:
+        return items_rank
+
+    @Instrument.timed("make_recommendation_seconds")
+    def make_recommendation(self, user_id):
+        items_rank = set(self.make_ranking(user_id, self.n))
+        if len(items_rank) < self.n:
             print("[{}] Not enough n untouched items for user {}".format(self.name, user_id))  # noqa
             print("[{}] Recommend {} items instead".format(self.name, len(items_rank)))  # noqa
         return items_rank
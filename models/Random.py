@@ -1,5 +1,7 @@
 from base.Model import Model
+from utils.Instrument import Instrument
 import random
+import pandas as pd
 
 
 class Random(Model):
@@ -7,22 +9,44 @@ class Random(Model):
         super().__init__(n, "random", data_type, ensure_new=ensure_new)
 
     def fit(self, event_data):
-        super().fit(event_data)
-        self.save()
+        if not super().fit(event_data):
+            self.save()
+        self.init_state()
 
-    def make_recommendation(self, user_id):
+    def init_state(self):
+        self.items_pool = list(self.items)
+        self.pool_items = set(self.items_pool)
+
+    def partial_update(self, events):
+        for item_id in pd.unique(events["itemid"]).tolist():
+            if int(item_id) not in self.pool_items:
+                self.items_pool.append(int(item_id))
+                self.pool_items.add(int(item_id))
+
+    def rank_items(self, user_id):
+        history_items = self.users[user_id].covered_items
+        return {item_id: random.random() for item_id in self.items
+                if item_id not in history_items}
+
+    @Instrument.timed("make_ranking_seconds")
+    def make_ranking(self, user_id, max_n):
         user = self.users[user_id]
         history_items = user.covered_items
-        items_rank = set()
-        items_pool = list(self.items.keys())
-        while len(items_rank) < self.n and items_pool:
+        items_rank = []
+        items_pool = list(self.items_pool)
+        while len(items_rank) < max_n and items_pool:
             # random choose an new item for this user
             rand_index = random.randint(0, len(items_pool)-1)
             item_id = items_pool.pop(rand_index)
             if item_id in history_items:
                 continue
-            items_rank.add(item_id)
-        if not items_pool and (len(items_rank) < self.n):
+            items_rank.append(item_id)
+        return items_rank
+
+    @Instrument.timed("make_recommendation_seconds")
+    def make_recommendation(self, user_id):
+        items_rank = set(self.make_ranking(user_id, self.n))
+        if len(items_rank) < self.n:
             print("[{}] Not enough n untouched items for user {}".format(self.name, user_id))
             print("[{}] Recommend {} items instead".format(self.name, len(items_rank)))
         return items_rank
@@ -0,0 +1,164 @@
+import importlib
+
+
+class Registry:
+    """model name -> factory preparing the training data and fitting
+       (or loading) the model
+
+       model modules are only imported when their model is created,
+       so running a CF model never imports tensorflow
+    """
+    # name -> ("module:class", factory, serving params)
+    factories = {}
+
+    @classmethod
+    def register(cls, model_type, class_path, serving_params=("n",)):
+        """decorator registering factory(model_cls, data_type, DU,
+           train_data, **kwargs) for model_type, the class at
+           class_path ("module:class") is imported on first use;
+           serving_params are the kwargs only used when ranking, they
+           never change the fitted state (see utils/Sweep.py)
+        """
+        def decorator(factory):
+            cls.factories[model_type] = (class_path, factory, tuple(serving_params))
+            return factory
+        return decorator
+
+    @classmethod
+    def names(cls):
+        return list(cls.factories)
+
+    @classmethod
+    def model_class(cls, model_type):
+        try:
+            class_path = cls.factories[model_type][0]
+        except KeyError:
+            raise ValueError("Invalid model type: {}, must be in {}".format(
+                model_type, cls.names()))
+        module_name, class_name = class_path.split(":")
+        return getattr(importlib.import_module(module_name), class_name)
+
+    @classmethod
+    def serving_params(cls, model_type):
+        try:
+            return cls.factories[model_type][2]
+        except KeyError:
+            raise ValueError("Invalid model type: {}, must be in {}".format(
+                model_type, cls.names()))
+
+    @classmethod
+    def create(cls, model_type, data_type, DU, train_data, **kwargs):
+        model_cls = cls.model_class(model_type)
+        factory = cls.factories[model_type][1]
+        return factory(model_cls, data_type, DU, train_data, **kwargs)
+
+
+@Registry.register("UserCF", "models.UserCF:UserCF", serving_params=("n", "k"))
+def user_cf(model_cls, data_type, DU, train_data, **kwargs):
+    model = model_cls(data_type=data_type, n=kwargs['n'], k=kwargs['k'],
+                      timestamp=kwargs['timestamp'], build=kwargs.get('build', 'dict'),
+                      dtype=kwargs.get('dtype', 'float32'),
+                      memory_budget=kwargs.get('memory_budget'),
+                      time_budget=kwargs.get('time_budget'))
+    model.fit(train_data)
+    return model
+
+
+@Registry.register("ItemCF", "models.ItemCF:ItemCF", serving_params=("n", "k"))
+def item_cf(model_cls, data_type, DU, train_data, **kwargs):
+    model = model_cls(data_type=data_type, n=kwargs['n'], k=kwargs['k'],
+                      timestamp=kwargs['timestamp'], build=kwargs.get('build', 'dict'),
+                      dtype=kwargs.get('dtype', 'float32'),
+                      memory_budget=kwargs.get('memory_budget'),
+                      time_budget=kwargs.get('time_budget'))
+    model.fit(train_data)
+    return model
+
+
+@Registry.register("LFM", "models.LFM:LFM")
+def lfm(model_cls, data_type, DU, train_data, **kwargs):
+    trainer = kwargs.get('trainer', 'keras')
+    sampling = kwargs.get('sampling', 'stream')
+    if trainer == 'keras' and sampling == 'static':
+        train_data = DU.build_samples(kwargs['neg_frac'], train_data)
+    model = model_cls(data_type=data_type, n=kwargs['n'],
+                      neg_frac_in_train=kwargs.get('neg_frac'), trainer=trainer,
+                      als_params=kwargs.get('als_params'), sampling=sampling,
+                      batch_size=kwargs.get('batch_size', 256),
+                      train_config=kwargs.get('train_config'))
+    model.fit(train_data)
+    return model
+
+
+@Registry.register("Random", "models.Random:Random")
+def random(model_cls, data_type, DU, train_data, **kwargs):
+    model = model_cls(data_type=data_type, n=kwargs['n'])
+    model.fit(train_data)
+    return model
+
+
+@Registry.register("MostPopular", "models.Popular:Popular")
+def most_popular(model_cls, data_type, DU, train_data, **kwargs):
+    model = model_cls(data_type=data_type, n=kwargs['n'])
+    model.fit(train_data)
+    return model
+
+
+@Registry.register("TagBasic", "models.TagBasic:TagBasic", serving_params=("n", "k"))
+def tag_basic(model_cls, data_type, DU, train_data, **kwargs):
+    model = model_cls(data_type=data_type, n=kwargs['n'], k=kwargs['k'])
+    model.fit(train_data)
+    return model
+
+
+@Registry.register("Wide&Deep", "models.Wide_and_deep:Wide_and_deep")
+def wide_and_deep(model_cls, data_type, DU, train_data, **kwargs):
+    # create negative samples (only for training set)
+    train_data = DU.build_samples(kwargs['neg_frac'], train_data)
+    # user, item features are read from the feature store by the model,
+    # looked up by id while training, not joined
+    model = model_cls(data_type=data_type, neg_frac_in_train=kwargs["neg_frac"], n=kwargs["n"],
+                      batch_size=kwargs.get("batch_size", 1024),
+                      train_config=kwargs.get("train_config"))
+    model.fit(train_data)
+    return model
+
+
+@Registry.register("Blend", "models.Blend:Blend",
+                   serving_params=("n", "candidates", "batch_size"))
+def blend(model_cls, data_type, DU, train_data, **kwargs):
+    """components: list of (model_type, weight, kwargs of that model),
+       every component is fitted (or loaded) on the same events
+    """
+    models, weights = [], []
+    for model_type, weight, params in kwargs["components"]:
+        params = dict(params, n=params.get("n", kwargs["n"]))
+        models.append(Registry.create(model_type, data_type, DU, train_data, **params))
+        weights.append(weight)
+    model = model_cls(data_type=data_type, n=kwargs["n"], models=models, weights=weights,
+                      normalization=kwargs.get("normalization", "rank"),
+                      candidates=kwargs.get("candidates", 100),
+                      batch_size=kwargs.get("batch_size", 256))
+    model.fit(train_data)
+    return model
+
+
+@Registry.register("PersonalRank", "models.PersonalRank:PersonalRank",
+                   serving_params=("n", "batch_size"))
+def personal_rank(model_cls, data_type, DU, train_data, **kwargs):
+    model = model_cls(data_type=data_type, n=kwargs['n'], alpha=kwargs.get('alpha', 0.8),
+                      max_iter=kwargs.get('max_iter', 30), tol=kwargs.get('tol', 1e-4),
+                      batch_size=kwargs.get('batch_size', 256))
+    model.fit(train_data)
+    return model
+
+
+@Registry.register("EASE", "models.EASE:EASE",
+                   serving_params=("n", "batch_size"))
+def ease(model_cls, data_type, DU, train_data, **kwargs):
+    model = model_cls(data_type=data_type, n=kwargs['n'], reg=kwargs.get('reg', 500.0),
+                      dtype=kwargs.get('dtype', 'float32'),
+                      block_size=kwargs.get('block_size', 4096),
+                      batch_size=kwargs.get('batch_size', 256))
+    model.fit(train_data)
+    return model
@@ -1,6 +1,8 @@
 from base.Model import Model
+from base.Artifact import Object_rows, Edited_rows
 from math import log
 import pandas as pd
+from utils.Instrument import Instrument
 
 class TagBasic(Model):
     def __init__(self, n, k, data_type, ensure_new=True):
@@ -9,9 +11,21 @@ class TagBasic(Model):
         self.name += "_{}".format(k)
 
     def fit(self, train_data):
-        super().fit(train_data, tag=True)
+        if super().fit(train_data, tag=True):
+            return
         self.save()
 
+    def partial_update(self, events):
+        # tag counts of the tags, users and items of the new events,
+        # only the tags of the batch are built from loaded histories
+        if isinstance(self.tags, Object_rows):
+            self.tags = Edited_rows(self.tags)
+        for row in events.itertuples(index=False):
+            if row.tagid in self.tags:
+                self.edit_obj(self.tags, row.tagid)
+            Model.update_tag(row.tagid, self.tags, self.edit_obj(self.users, int(row.visitorid)),
+                             self.edit_obj(self.items, int(row.itemid)))
+
     def find_k_most_used_tag(self, user):
         tags_count_sorted = sorted(user.tags_count.items(),
                                    key=lambda item: item[1],
@@ -37,11 +51,12 @@ class TagBasic(Model):
                     items_rank[item_id] = score
         return items_rank
 
-    def make_recommendation(self, user_id):
+    def rank_items(self, user_id):
         try:
             user = self.users[user_id]
         except KeyError:
-            print("[{}] User {} not seen in training set".format(user_id))
+            print("[{}] User {} not seen in training set".format(self.name, user_id))
+            return -1
         # find user's k most used tag
         most_used_tag = self.find_k_most_used_tag(user)
         if len(most_used_tag) < self.k:
@@ -50,7 +65,13 @@ class TagBasic(Model):
         k_tags = []
         for tag_id in [x[0] for x in most_used_tag]:
             k_tags.append(self.tags[tag_id])
-        items_rank = self.rank_potential_items(user, k_tags)
+        return self.rank_potential_items(user, k_tags)
+
+    @Instrument.timed("make_recommendation_seconds")
+    def make_recommendation(self, user_id):
+        items_rank = self.rank_items(user_id)
+        if isinstance(items_rank, int):
+            return items_rank
         if len(items_rank) >= self.n:
             return self.get_top_n_items(items_rank)
         else:
@@ -1,20 +1,45 @@
-import os
 import pandas as pd
-import pickle
+import numpy as np
+from scipy import sparse
 from math import sqrt, log
-from base.Model import Model
+from base.Model import Model, T_NOW
+from base.Artifact import Artifact
 from base.User import User
 from base.Item import Item
+from utils.Instrument import Instrument
+from utils.Sim_build import Sim_build
 
 
 class UserCF(Model):
-    def __init__(self, n, k, data_type, ensure_new=True, timestamp=False):
+    def __init__(self, n, k, data_type, ensure_new=True, timestamp=False, build="dict",
+                 dtype="float32", memory_budget=None, time_budget=None):
+        """
+        Parameters
+        ----------
+        build : [str]
+            [sim matrix build, dict, csr or auto (the fastest within
+             the budgets), see utils/Sim_build.py]
+        dtype : [str]
+            [values of the csr build]
+        memory_budget, time_budget : [float]
+            [bytes and seconds the build may take, the fit is refused
+             before building when the estimate exceeds them]
+        """
         super().__init__(n, "UserCF", data_type, ensure_new=ensure_new)
         self.k = k
-        self.name += "_k_{}".format(k)
         if timestamp:
             self.name += "_TimeContext"
+        # k is only used when ranking, all k share one sim matrix
+        self.artifact_name = self.name
+        self.name += "_k_{}".format(k)
         self.timestamp = timestamp
+        # all builds save the same float32 sim matrix, they share it
+        self.build = build
+        self.dtype = dtype
+        self.memory_budget = memory_budget
+        self.time_budget = time_budget
+        # columns of history_weights, all items unless keep_items
+        self.kept_items = None
 
     def update_user_user_sim(self, user_A_info, user_B_info, item_popularity):
         """when find the user_A and user_B have common item with popularity
@@ -49,6 +74,7 @@ class UserCF(Model):
             # convert to list of tuples for indexing
             users = list(item.covered_users.items())
             item_popularity = len(users)
+            Instrument.count("sim_pairs", len(users)*(len(users)-1), model=self.model_type)
             # iter through all user pairs
             for i in range(len(users)-1):
                 for j in range(i+1, len(users)):
@@ -87,29 +113,44 @@ class UserCF(Model):
         #  'userB':{.....}, ...}
         if super().fit(event_data):
             return
-        print("[{}] Building user-user similarity matrix, this may take some time...".format(self.name))  # noqa
-        self.build_user_user_similarity_matrix(event_data)
+        # cost of the build from the degrees, refused before building
+        sim_build = Sim_build(self.items, "covered_users")
+        plan = sim_build.plan(self.build, self.dtype, self.memory_budget, self.time_budget)
+        print("[{}] Building user-user similarity matrix ({} {}, estimated {:.2f} GB, {:.0f} s), "
+              "this may take some time...".format(self.name, plan["strategy"], plan["dtype"],
+                                                  plan["peak_bytes"]/1e9, plan["seconds"]))
+        with Instrument.stage("build_sim"):
+            if plan["strategy"] == "dict":
+                self.build_user_user_similarity_matrix(event_data)
+                self.sim_arrays = None
+            else:
+                self.sim_arrays = sim_build.build_csr(self.timestamp, plan["dtype"], normalize=True)
+                self.sim_matrix = Artifact.rows(self.sim_arrays, "sim")
+        if Instrument.enabled:
+            nnz = (len(self.sim_arrays["sim_indices"]) if self.sim_arrays else
+                   sum(len(row) for row in self.sim_matrix.values()))
+            Instrument.count("sim_nnz", nnz, model=self.model_type)
         print("[{}] Build done!".format(self.name))
         self.save()
 
     def rank_potential_items(self, target_user_id, top_k_users):
-        """for k similar users, rank common items
+        """for k similar (user_id, sim), rank common items
            rank score's range is (0, +inf)
         """
         items_rank = {}
+        n_excluded = 0
         target_user = self.users[target_user_id]
-        for user_id in top_k_users:
+        for user_id, sim in top_k_users:
             sim_user = self.users[user_id]
-            sim = self.sim_matrix[target_user_id][user_id]
             for item_id, item_time in sim_user.covered_items.items():
                 if self.ensure_new and (item_id in target_user.covered_items):
+                    n_excluded += 1
                     continue  # skip item that already been bought
                 if self.timestamp:
                     # note that time context model cannot be evaluated
                     # properly using offline data, this is just a demon
                     # user's interest for this history item
-                    t_now = 1146454548
-                    time_elapse = Model.time_elapse(item_time, t_now)
+                    time_elapse = Model.time_elapse(item_time, T_NOW)
                     score = time_elapse*sim
                 else:
                     score = sim
@@ -118,41 +159,108 @@ class UserCF(Model):
                 except KeyError:
                     items_rank[item_id] = score
         # assert len(items_rank) >= self.n
+        Instrument.count("items_excluded", n_excluded, model=self.model_type)
         return items_rank
 
-    def make_recommendation(self, user_id):
+    def rank_items(self, user_id):
         if not super().valid_user(user_id):
             return -1
-        # get all related users
-        related_users = self.sim_matrix[user_id]
-        if len(related_users) == 0:
-            print('[{}] User {} didn\'t has any common item with other users'.format(self.name))  # noqa
+        # get all related users, users added by partial_fit have none
+        # until the model is refitted
+        if user_id not in self.sim_matrix:
+            top_k_users = []
+        else:
+            top_k_users = Model.most_similar(self.sim_matrix, user_id, self.k)
+        if len(top_k_users) == 0:
+            print('[{}] User {} didn\'t has any common item with other users'.format(self.name, user_id))  # noqa
             return -2
-        related_users = sorted(related_users.items(),
-                               key=lambda item: item[1],
-                               reverse=True)  # return a list of tuples
-        top_k_users = [x[0] for x in related_users][:self.k]
         assert len(top_k_users) == self.k
         items_rank = self.rank_potential_items(user_id, top_k_users)
         if self.ensure_new and len(items_rank) == 0:
             print('[{}] All recommend items has already been touched by user {}.'.format(self.name, user_id))  # noqa
             return -3
-        return super().get_top_n_items(items_rank)
+        return items_rank
+
+    def history_weights(self):
+        """(items id, weights) histories weighted as in
+           rank_potential_items, users x items scipy CSR over the rows
+           of history_matrix and its columns of the kept items
+        """
+        cached = getattr(self, "weights_cache", None)
+        if cached is None or cached[0] != (self.data_key, self.timestamp):
+            _, items_id, weights = self.history_matrix()
+            if self.kept_items is not None:
+                columns = np.flatnonzero(np.isin(items_id, self.kept_items))
+                items_id, weights = items_id[columns], weights[:, columns]
+            weights = weights.copy()
+            if self.timestamp:
+                weights.data = Model.time_elapse(weights.data, T_NOW)
+            else:
+                weights.data = np.ones(len(weights.data))
+            self.weights_cache = cached = (self.data_key, self.timestamp), items_id, weights
+        return cached[1:]
+
+    def keep_items(self, items_id):
+        """score_users only scores the items of items_id, the weighted
+           histories keep their columns; built here, not on the first
+           request
+        """
+        self.kept_items = np.asarray(items_id)
+        self.weights_cache = None
+        self.history_weights()
+
+    def score_users(self, users_id, items_id):
+        """k most similar users of every user times the weighted
+           histories, one sparse product for all the users, touched
+           items are NaN
+        """
+        users_index = self.history_matrix()[0]
+        weights_items_id, weights = self.history_weights()
+        rows = users_index.get_indexer(users_id)
+        known = rows >= 0
+        neighbour_rows, neighbour_columns, sims = [], [], []
+        for row, user_id in enumerate(np.asarray(users_id)[known].tolist()):
+            if user_id not in self.sim_matrix:
+                continue
+            top_k_users = Model.most_similar(self.sim_matrix, user_id, self.k)
+            neighbour_rows.extend([row]*len(top_k_users))
+            neighbour_columns.extend(user_id for user_id, _ in top_k_users)
+            sims.extend(sim for _, sim in top_k_users)
+        neighbour_columns = users_index.get_indexer(neighbour_columns)
+        found = neighbour_columns >= 0
+        neighbours = sparse.csr_matrix((np.asarray(sims, dtype=np.float64)[found],
+                                        (np.asarray(neighbour_rows, dtype=np.int64)[found],
+                                         neighbour_columns[found])),
+                                       shape=(known.sum(), len(users_index)))
+        scores = np.full((len(users_id), len(items_id)), np.nan)
+        # the weights have the structure of the histories
+        scores[known] = Model.sparse_scores(neighbours @ weights, weights_items_id, items_id,
+                                            weights[rows[known]] if self.ensure_new else None)
+        return scores
+
+    def score_items(self, user_id, items_id):
+        if not super().valid_user(user_id):
+            return -1
+        return self.score_users([user_id], items_id)[0]
 
     def evaluate(self, test_data):
         return super().evaluate_recommendation(test_data)
 
+    @Instrument.staged("save")
     def save(self):
         super().save()
-        sim_matrix = os.path.join('models/saved_models/sim_matrix_{}'.format(self.name + '.pickle'))
-        with open(sim_matrix, 'wb') as f:
-            print(sim_matrix)
-            f.write(pickle.dumps(self.sim_matrix))
-        print("[{}] Model saved".format(self.name))
+        # rows sorted by decreasing similarity, float32 is enough for ranking
+        # the csr build writes its arrays directly
+        arrays = getattr(self, "sim_arrays", None)
+        if arrays is None:
+            arrays = Artifact.pack_rows({}, "sim", self.sim_matrix,
+                                        value_dtype=np.float32, sort_desc=True)
+        self.cache.write(self.artifact_path("sim_matrix"), arrays)
+        print("[{}] Model saved.".format(self.name))
 
+    @Instrument.staged("load")
     def load(self):
         super().load()
-        sim_matrix = os.path.join('models/saved_models/sim_matrix_{}'.format(self.name + '.pickle'))
-        with open(sim_matrix, 'rb') as f:
-            self.sim_matrix = pickle.loads(f.read())
-        print("[{}] Previous sim matrix found and loaded.".format(self.name))  # noqa
\ No newline at end of file
+        arrays, _ = self.cache.read(self.artifact_path("sim_matrix"))
+        self.sim_matrix = Artifact.rows(arrays, "sim")
+        print("[{}] Previous sim matrix found and loaded.".format(self.name))  # noqa
@@ -1,5 +1,5 @@
 import os
-import pickle
+import shutil
 import pandas as pd
 import numpy as np
 import tensorflow as tf
@@ -7,41 +7,142 @@ from tensorflow.keras import layers
 from tensorflow.keras.models import load_model
 from utils.Feature_util import Feature_util
 from base.Model import Model
+from utils.Instrument import Instrument
+from utils.Cache import Cache
+from utils.Serving import Serving
+from utils.Negative_sequence import Negative_sequence
+from utils.Warm_start import Warm_start
+from utils.Train_config import Train_config
+
+
+class Wide_and_deep_serving(tf.Module):
+    """traced serving signature of a Wide&Deep keras model, users and
+       items features are constant numeric tables (the codes of the
+       feature store) gathered by row inside the graph, a request only
+       passes the user row and the item rows
+    """
+    def __init__(self, model, users_table, items_table):
+        super().__init__()
+        self.model = model
+        self.user_table, self.item_table = self.tables(model, users_table, items_table)
+
+    @classmethod
+    def tables(cls, model, users_table, items_table):
+        """users and items feature tables, one constant per model input,
+           see Feature_util.read_feature_tables
+        """
+        # model inputs are the user columns then the item columns
+        n_user_inputs = len(users_table)
+        return (cls.table(users_table, model.inputs[:n_user_inputs]),
+                cls.table(items_table, model.inputs[n_user_inputs:]))
+
+    @staticmethod
+    def table(columns, inputs):
+        # converted once to the input dtype, batches only gather rows
+        return [tf.constant(np.asarray(values, dtype=tf.as_dtype(input_layer.dtype).as_numpy_dtype))
+                for values, input_layer in zip(columns.values(), inputs)]
+
+    @tf.function(input_signature=[tf.TensorSpec([], tf.int32, name="user_row"),
+                                  tf.TensorSpec([None], tf.int32, name="item_rows")])
+    def serve(self, user_row, item_rows):
+        n_samples = tf.shape(item_rows)
+        user_inputs = [tf.reshape(tf.fill(n_samples, column[user_row]), (-1, 1))
+                       for column in self.user_table]
+        item_inputs = [tf.reshape(tf.gather(column, item_rows), (-1, 1))
+                       for column in self.item_table]
+        score = self.model(user_inputs+item_inputs, training=False)
+        return {"score": tf.reshape(score, (-1,))}
 
 
 class Wide_and_deep(Model):
-    def __init__(self, n, data_type, neg_frac_in_train, ensure_new=True):
+    def __init__(self, n, data_type, neg_frac_in_train, ensure_new=True, batch_size=1024,
+                 train_config=None):
+        """
+        Parameters
+        ----------
+        batch_size : [int]
+            [training batch size]
+        train_config : [Train_config, dict or str]
+            [CPU training settings (threads, XLA, batch size), "tuned"
+             for the config persisted by Train_config.autotune, see
+             utils/Train_config.py]
+        """
         super().__init__(n, "Wide&Deep", data_type, ensure_new=ensure_new)
+        self.batch_size = batch_size
+        self.neg_frac = neg_frac_in_train
         self.name += "_neg_{}".format(neg_frac_in_train)
+        self.train_config = Train_config.create(train_config, data_type, "Wide&Deep")
+        self.name += self.train_config.name_suffix(self.base_batch_size())
+        self.artifact_name = self.name
         # keys to get input layers in all input layers dict
         self.deep_inputs = ["visitorid", "age", "zip_code", "gender", "occupation", "itemid", "release_date"]
-        self.wide_inputs = ["gender", "occupation", "unknown", "action", "adventure", "animation",
-                            "child", "comedy", "crime", "docu", "drama", "fantasy", "noir", "horror",
-                            "musical", "mystery", "romance", "sci", "thrill", "war", "western"]
+        self.wide_inputs = ["gender", "occupation", "category_set"]
         # keys to get feature columns in all feature columns dict
         self.deep_features = ["visitorid", "age", "zip_code", "gender", "occupation", "itemid", "release_date"]
         self.wide_features = ["gender_x_occupation", "cate_x_cate"]
-        self.item_info_map = {}
-        self.user_info_map = {}
+        # {input name: array} of users and items, see read_feature_tables
+        self.users_table = {}
+        self.items_table = {}
 
-    @staticmethod
-    def df_to_dataset(dataframe, shuffle=False, batch_size=128):
-        assert type(dataframe) == pd.DataFrame
-        dataframe = dataframe.copy()
-        labels = dataframe.pop('event')
-        ds = tf.data.Dataset.from_tensor_slices((dict(dataframe), labels))
+    def base_batch_size(self):
+        """batch size the learning rate is tuned for"""
+        return self.batch_size
+
+    def read_feature_tables(self):
+        """users and items inputs memory mapped from the feature store,
+           training, updates and serving all read these codes; raise
+           OSError if the store was encoded again since feature_key,
+           the codes of the model's embeddings would not match
+        """
+        FU = Feature_util(self.data_type)
+        feature_key = FU.feature_store_key()
+        if getattr(self, "feature_key", feature_key) != feature_key:
+            raise OSError("[{}] Users or items info changed since training, feature codes differ".format(
+                self.name))
+        self.feature_key = feature_key
+        users_id, self.users_table, items_id, self.items_table = FU.read_feature_tables()
+        self.user_index, self.item_index = pd.Index(users_id), pd.Index(items_id)
+
+    def df_to_dataset(self, samples, shuffle=False, batch_size=None, seed=100):
+        """tf.data pipeline over (visitorid, itemid, event) samples only,
+           side features are gathered by user and item row from the
+           numeric feature tables for a whole batch in parallel map
+           calls, so no sample carries its users/items info columns;
+           row arrays are cached, reshuffled every epoch and batches
+           are prefetched while the model trains on the previous one
+        """
+        assert type(samples) == pd.DataFrame
+        user_rows = self.user_index.get_indexer(samples["visitorid"])
+        item_rows = self.item_index.get_indexer(samples["itemid"])
+        assert (user_rows >= 0).all() and (item_rows >= 0).all(), "samples without side info"
+        labels = samples["event"].to_numpy(dtype=np.float32)
+        user_table, item_table = Wide_and_deep_serving.tables(self.model, self.users_table,
+                                                              self.items_table)
+        input_names = list(self.users_table)+list(self.items_table)
+
+        def lookup(rows, labels):
+            user_rows, item_rows = rows
+            inputs = ([tf.gather(column, user_rows) for column in user_table] +
+                      [tf.gather(column, item_rows) for column in item_table])
+            return ({name: tf.reshape(values, (-1, 1)) for name, values in zip(input_names, inputs)},
+                    tf.reshape(labels, (-1, 1)))
+
+        rows = (user_rows.astype(np.int32), item_rows.astype(np.int32))
+        ds = tf.data.Dataset.from_tensor_slices((rows, labels)).cache()
         if shuffle:
-            ds = ds.shuffle(buffer_size=len(dataframe))
-        ds = ds.batch(batch_size)
-        return ds
+            ds = ds.shuffle(buffer_size=len(labels), seed=seed, reshuffle_each_iteration=True)
+        # batch before map, so lookups are vectorized over a whole batch
+        ds = ds.batch(batch_size or self.batch_size)
+        ds = ds.map(lookup, num_parallel_calls=tf.data.AUTOTUNE)
+        return ds.prefetch(tf.data.AUTOTUNE)
 
-    def build_model(self, users_info, items_info):
+    def build_model(self):
         FU = Feature_util(self.data_type)
         # 1. define input layer
         input_layer = FU.create_movie_lens_input_layer()
         # 2. prepare feature columns (list of feature column objects)
-        FU.create_movie_lens_user_feature_columns(users_info)
-        FU.create_movie_lens_item_feature_columns(items_info)
+        FU.create_movie_lens_user_feature_columns()
+        FU.create_movie_lens_item_feature_columns()
         all_fc = FU.data_map["MovieLens_100K"]["feature_columns"]
         # 3. select wide features and deep features, convert feature columns to feature layer
         deep_fc = [all_fc[fc_name] for fc_name in self.deep_features]
@@ -65,9 +166,13 @@ class Wide_and_deep(Model):
         output = layers.Dense(1, activation="sigmoid", name="output")(concat)
         # 8. build and compile model
         self.model = tf.keras.Model(inputs=[v for v in input_layer.values()], outputs=output)
-        self.model.compile(optimizer="adam",
+        # adam's default learning rate, scaled with the batch size
+        optimizer = tf.keras.optimizers.Adam(
+            learning_rate=self.train_config.learning_rate(0.001, self.base_batch_size()))
+        self.model.compile(optimizer=optimizer,
                            loss='binary_crossentropy',
-                           metrics=["accuracy"])
+                           metrics=["accuracy"],
+                           **self.train_config.compile_kwargs())
         tf.keras.utils.plot_model(self.model,
                                   to_file='models/model_struc/wide&deep.png',
                                   show_shapes=True, show_layer_names=True)
@@ -77,71 +182,126 @@ class Wide_and_deep(Model):
     def input_check(train_data):
         assert not train_data.isnull().values.any()
 
-    def init_info_map(self, users_info, items_info):
-        """
-            init user and item info map for prediction
-        """
-        user_info_seq = Feature_util.data_map["MovieLens_100K"]["user_info_seq"]
-        item_info_seq = Feature_util.data_map["MovieLens_100K"]["item_info_seq"]
-        for index, row in users_info.iterrows():
-            # make sure order of row's values correspond to input values
-            self.user_info_map[row["visitorid"]] = list(row[user_info_seq])
-        for index, row in items_info.iterrows():
-            self.item_info_map[row["itemid"]] = list(row[item_info_seq])
-
-    def fit(self, train_data, users_info, items_info):
+    def fit(self, train_data):
         # user positive samples to generate history records
         positive_samples = train_data.loc[train_data["event"] == 1, ("visitorid", "itemid", "timestamp")]
+        # side features are the codes of the feature store, the model
+        # is bound to their encoding
+        self.feature_key = Feature_util(self.data_type).feature_store_key()
+        self.read_feature_tables()
+        # the keras model also depends on the negative samples and side info
+        self.samples_key = Cache.key(Cache.fingerprint(train_data), self.feature_key)
         if super().fit(positive_samples):
             return
         del positive_samples
-        self.init_info_map(users_info, items_info)
+        # thread pools before the first tensorflow op
+        self.train_config.apply()
         # build model
-        self.build_model(users_info, items_info)
-        del train_data["rating"], train_data["timestamp"]
-        # MAKE SURE col values' type identity with input layer
-        # MAKE SURE columns' order identity with input order, label comes last
-        train_data = train_data[Feature_util.data_map["MovieLens_100K"]["input_values_seq"]]
+        self.build_model()
+        # samples keep (visitorid, itemid, event), side features are
+        # looked up from the feature tables by df_to_dataset
+        train_data = train_data[["visitorid", "itemid", "event"]]
         self.input_check(train_data)
-        # TODO: not convert to dataset?
-        train_data = self.df_to_dataset(train_data)
-        self.model.fit(train_data, epochs=30)
+        train_data = self.df_to_dataset(
+            train_data, shuffle=True,
+            batch_size=self.train_config.training_batch_size(self.base_batch_size()))
+        with Instrument.stage("train"):
+            self.model.fit(train_data, **self.train_config.fit_kwargs(30))
         self.save()
+        self.load_serving()
+
+    def update(self, train_data, epochs=3, replay_frac=1.0):
+        """warm start: fold new samples into the fitted keras model,
+           trained a few epochs on them plus a replay sample of old
+           events (with negatives drawn as Negative_sequence does);
+           codes of users and items appended to the info files since
+           the model was built share one extra embedding bucket, so
+           they need no growth, only their side info; epochs are
+           checkpointed so an interrupted update resumes
 
-    def make_recommendation(self, user_id):
+        Parameters
+        ----------
+        train_data : [pd.DataFrame]
+            [new samples with negatives, see Data_util.build_samples]
+        epochs : [int]
+            [training epochs of the update]
+        replay_frac : [float]
+            [old events replayed per new positive sample]
+        """
+        feature_key = Feature_util(self.data_type).feature_store_key()
+        update_key = Cache.key(self.samples_key, Cache.fingerprint(train_data), feature_key,
+                               epochs, replay_frac)
+        positive_samples = train_data.loc[train_data["event"] == 1, ("visitorid", "itemid", "timestamp")]
+        users_id, items_id, indptr, indices = self.user_item_csr()
+        replay_rows, replay_cols = Warm_start.replay_sample(
+            indptr, indices, int(replay_frac*len(positive_samples)), Warm_start.seed(update_key))
+        replay_indptr, replay_indices = Warm_start.csr(replay_rows, replay_cols,
+                                                       len(users_id), len(items_id))
+        sequence = Negative_sequence(users_id, items_id, replay_indptr, replay_indices,
+                                     self.neg_frac, batch_size=max(len(replay_rows), 1),
+                                     seed=Warm_start.seed(update_key), touched=(indptr, indices))
+        (itemid, visitorid), labels = sequence[0]
+        replay = pd.DataFrame({"visitorid": visitorid[:, 0], "itemid": itemid[:, 0],
+                               "event": labels[:, 0].astype(np.int64)})
+        self.update_history(positive_samples)
+        del positive_samples
+        # side info of the new users and items, the codes of the others
+        # are kept as long as the info files were only appended to
+        self.feature_key = feature_key
+        self.read_feature_tables()
+        train_data = pd.concat([train_data[["visitorid", "itemid", "event"]], replay],
+                               ignore_index=True)
+        self.input_check(train_data)
+        checkpoint_path = self.cache.path("update_checkpoint", update_key)
+        print("[{}] Updating with {} new and {} replayed samples...".format(
+            self.name, len(train_data)-len(replay), len(replay)))
+        self.model = Warm_start.train(self.model, self.df_to_dataset(train_data, shuffle=True),
+                                      epochs, checkpoint_path, load_model)
+        self.samples_key = update_key
+        self.save()
+        self.load_serving()
+        shutil.rmtree(checkpoint_path, ignore_errors=True)
+
+    def rank_items(self, user_id):
+        """
+            score all untouched items with the compiled serving
+            signature, batches run in parallel over the cores
+        """
+        if not super().valid_user(user_id):
+            return -1
+        history_items = self.users[user_id].covered_items
+        Instrument.count("items_excluded", len(history_items), model=self.model_type)
+        candidates = ~np.isin(self.items_id, list(history_items))
+        if not candidates.any():  # all items have been touched
+            return -1
+        interests = Serving.predict(self.serving, {"item_rows": self.items_row[candidates]},
+                                    {"user_row": np.int32(self.user_index.get_loc(user_id))})
+        return dict(zip(self.items_id[candidates].tolist(), interests.tolist()))
+
+    def predict_rank_items(self, user_id):
         """
             use batches to predict user's interest to all items
-            much faster than predict one sample at a time
+            much faster than predict one sample at a time,
+            keras predict loop, kept for comparison with rank_items
         """
-        # get user info
-        user_info = self.user_info_map[user_id]
+        if not super().valid_user(user_id):
+            return -1
+        user_row = self.user_index.get_loc(user_id)
         history_items = self.users[user_id].covered_items
-        # prepare all samples to predict
-        samples = []
-        for item_id, item in self.items.items():
-            if item_id in history_items:
-                continue
-            # get item info
-            item_info = self.item_info_map[item_id]
-            # input values order is guaranteed in self.init_info_map()
-            sample = user_info + item_info
-            samples.append(sample)
-        if len(samples) == 0:  # all items have been touched
+        Instrument.count("items_excluded", len(history_items), model=self.model_type)
+        candidates = ~np.isin(self.items_id, list(history_items))
+        if not candidates.any():  # all items have been touched
             return -1
-        # convert input samples to list of arrays (n_inputs * (n_samples * n_values_per_sample))
-        n_inputs, n_samples, n_values = len(sample), len(samples), 1
-        inputs = []
-        for i in range(len(sample)):
-            input_array = np.array([sample[i] for sample in samples]).reshape(n_samples, n_values)
-            inputs.append(input_array)
+        # input arrays (n_inputs * (n_samples * n_values_per_sample)),
+        # in the model inputs order: user columns then item columns
+        item_rows = self.items_row[candidates]
+        n_samples, n_values = len(item_rows), 1
+        inputs = ([np.full((n_samples, n_values), values[user_row]) for values in self.users_table.values()] +
+                  [np.asarray(values)[item_rows].reshape(n_samples, n_values)
+                   for values in self.items_table.values()])
         # make prediction
         interests = self.model.predict(inputs, batch_size=128)
-        # get items id's input array
-        items_id = inputs[5]
-        items_rank = {}
-        for item_id, interest in zip(items_id, interests):
-            items_rank[item_id[0]] = interest[0]
-        return super().get_top_n_items(items_rank)
+        return dict(zip(self.items_id[candidates].tolist(), interests[:, 0].tolist()))
 
     def evaluate(self, test_data):
         # make sure test_data row values order correct
@@ -152,34 +312,81 @@ class Wide_and_deep(Model):
         test_data = self.df_to_dataset(test_data)
         print(self.model.evaluate(test_data))
 
+    def keras_model_path(self):
+        return self.artifact_path("keras_model", self.samples_key, self.artifact_name)
+
     def load_keras_model(self):
         try:
-            self.model = load_model("models/saved_models/{}.h5".format(self.name))
+            self.model = load_model(os.path.join(self.keras_model_path(), "model.h5"))
             print("[{}] Previous trained model loaded.".format(self.name))
             return 0
         except OSError:
             return -1
 
+    def write_keras_model(self, path):
+        self.model.save(os.path.join(path, "model.h5"))
+
+    def serving_path(self):
+        return self.artifact_path("serving_model", self.samples_key, self.artifact_name)
+
+    def export_serving(self):
+        self.cache.write_with(self.serving_path(), lambda path: Serving.export(
+            Wide_and_deep_serving(self.model, self.users_table, self.items_table), path))
+
+    def load_serving(self):
+        """load the SavedModel serving signature, export it if missing,
+           rows of the feature tables are the feature store rows
+        """
+        self.export_serving()
+        path = self.serving_path()
+        self.serving = Serving.load(path)
+        self.cache.touch(path)
+        self.items_id = np.fromiter(self.items, dtype=np.int64, count=len(self.items))
+        self.items_row = self.item_index.get_indexer(self.items_id).astype(np.int32)
+        assert (self.items_row >= 0).all(), "items without side info"
+
+    @Instrument.staged("save")
     def save(self):
         super().save()
-        keras_model = os.path.join('models/saved_models/keras_model_{}'.format(self.name + '.h5'))
-        self.model.save(keras_model)
-        user_info_map = os.path.join("models/saved_models/user_info_{}".format(self.name + ".pickle"))
-        with open(user_info_map, "wb") as f:
-            f.write(pickle.dumps(self.user_info_map))
-        item_info_map = os.path.join("models/saved_models/item_info_{}".format(self.name + ".pickle"))
-        with open(item_info_map, "wb") as f:
-            f.write(pickle.dumps(self.item_info_map))
+        self.cache.write_with(self.keras_model_path(), self.write_keras_model)
+        self.export_serving()
         print("[{}] Model saved".format(self.name))
 
+    def read_keras_model(self):
+        """keras model written by write_keras_model and the feature
+           tables it was trained on
+        """
+        path = self.keras_model_path()
+        self.model = load_model(os.path.join(path, "model.h5"))
+        self.read_feature_tables()
+        self.cache.touch(path)
+
+    def keep_items(self, items_id):
+        """keep the feature rows of the items of items_id only, served
+           by an in memory signature over them instead of the exported
+           one holding the rows of all items
+        """
+        items_id = np.asarray(items_id)
+        rows = self.item_index.get_indexer(items_id)
+        # rows keep their codes, e.g. the itemid embedding row
+        self.items_table = {name: np.asarray(values)[rows] for name, values in self.items_table.items()}
+        self.item_index = pd.Index(items_id)
+        self.serving = Serving.wrap(Wide_and_deep_serving(self.model, self.users_table,
+                                                          self.items_table))
+        self.items_id = items_id
+        self.items_row = np.arange(len(items_id), dtype=np.int32)
+
+    def load_shard(self, items_id):
+        """the keras model and feature tables, the exported serving
+           signature is not loaded
+        """
+        Model.load(self)
+        self.read_keras_model()
+        self.keep_items(items_id)
+
+    @Instrument.staged("load")
     def load(self):
         super().load()
-        user_info_map = os.path.join("models/saved_models/user_info_{}".format(self.name + ".pickle"))
-        with open(user_info_map, "rb") as f:
-            self.user_info_map = pickle.loads(f.read())
-        item_info_map = os.path.join("models/saved_models/item_info_{}".format(self.name + ".pickle"))
-        with open(item_info_map, "rb") as f:
-            self.item_info_map = pickle.loads(f.read())
-        keras_model = os.path.join('models/saved_models/keras_model_{}'.format(self.name + '.h5'))
-        self.model = load_model(keras_model)
-        print("[{}] Previous keras model found and loaded.".format(self.name))
\ No newline at end of file
+        self.read_keras_model()
+        self.load_serving()
+        print("[{}] Previous keras model found and loaded.".format(self.name))
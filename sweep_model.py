@@ -0,0 +1,8 @@
+from utils.Sweep import Sweep
+
+if __name__ == "__main__":
+    configs = Sweep.grid("ItemCF", "MovieLens_100K", n=[10, 20, 50],
+                         k=[10, 20, 40, 80], timestamp=[True, False])
+    configs += Sweep.grid("MostPopular", "MovieLens_100K", n=[10, 20, 50])
+    result = Sweep(configs).run("evaluation_results/sweep.csv")
+    print(result)
@@ -0,0 +1,26 @@
+import numpy as np
+from utils.ALS import ALS
+
+
+def loss(als, R):
+    """confidence weighted squared error plus L2 penalty, the objective
+       ALS minimizes
+    """
+    confidence = 1+als.alpha*R
+    error = R-als.user_factors.astype(np.float64) @ als.item_factors.T.astype(np.float64)
+    return float((confidence*error**2).sum()+als.reg*((als.user_factors**2).sum()+
+                                                      (als.item_factors**2).sum()))
+
+
+def test_als_lowers_its_loss():
+    rng = np.random.default_rng(100)
+    R = (rng.random((30, 40)) < 0.15).astype(np.float64)
+    indptr = np.r_[0, np.cumsum(R.sum(axis=1))].astype(np.int64)
+    indices = np.nonzero(R)[1]
+    losses = [loss(ALS(dim=8, reg=0.1, alpha=10.0, iterations=iterations, chunk_size=7)
+                   .fit(indptr, indices, R.shape[1]), R)
+              for iterations in (1, 2, 5, 20)]
+    # every half step solves its side exactly, the loss never rises
+    assert all(later < earlier for earlier, later in zip(losses, losses[1:]))
+    # well below the loss of zero factors, (1+alpha) per touched entry
+    assert losses[-1] < 0.5*(1+10.0)*R.sum()
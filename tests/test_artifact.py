@@ -0,0 +1,20 @@
+import numpy as np
+from base.Artifact import Artifact
+
+
+def test_loaded_rows_behave_as_dicts(tmp_path):
+    rows = {3: {1: 0.5, 2: 0.25}, 1: {3: 1.0}}
+    path = str(tmp_path / "sim_matrix")
+    Artifact.write(path, Artifact.pack_rows({}, "sim", rows, np.float32, sort_desc=True))
+    loaded = Artifact.rows(Artifact.read(path)[0], "sim")
+    assert dict(loaded.items()) == rows
+    assert sum(len(row) for row in loaded.values()) == 3
+    assert loaded.top(3, 1) == [(1, 0.5)]
+
+
+def test_write_keeps_existing_artifact(tmp_path):
+    path = str(tmp_path / "entry")
+    Artifact.write(path, {"a": np.arange(3)})
+    Artifact.write(path, {"a": np.arange(5)})
+    assert len(Artifact.read(path)[0]["a"]) == 3
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["entry"]
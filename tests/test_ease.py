@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+from base.Model import Model
+from models.EASE import EASE
+
+
+def test_ease_matches_dense_closed_form(tmp_path, monkeypatch):
+    monkeypatch.setattr(Model, "saved_models_dir", str(tmp_path / "saved_models"))
+    rng = np.random.default_rng(100)
+    n_events = 400
+    events = pd.DataFrame({"visitorid": rng.integers(0, 30, n_events),
+                           "itemid": rng.integers(0, 40, n_events),
+                           "rating": np.ones(n_events, dtype=np.int64),
+                           "timestamp": rng.integers(0, 10**6, n_events)})
+    reg = 10.0
+    model = EASE(5, "Test", reg=reg, dtype="float64", block_size=7, batch_size=4)
+    model.fit(events)
+    # dense users x items X and B = -P/diag(P), P = (X'X + reg*I)^-1
+    users_index, items_index = pd.Index(model.users_id), pd.Index(model.items_id)
+    X = np.zeros((len(users_index), len(items_index)))
+    X[users_index.get_indexer(events["visitorid"]), items_index.get_indexer(events["itemid"])] = 1
+    P = np.linalg.inv(X.T @ X+reg*np.eye(len(items_index)))
+    B = -P/np.diag(P)
+    np.fill_diagonal(B, 0)
+    np.testing.assert_allclose(model.weights, B, atol=1e-10)
+    scores = X @ B
+    scores[X > 0] = -np.inf
+    for row, user_id in enumerate(model.users_id.tolist()):
+        ranking = model.make_ranking(user_id, 10)
+        # tie proof: the ranked items have the 10 best reference scores
+        best = np.sort(scores[row])[::-1][:len(ranking)]
+        np.testing.assert_allclose(scores[row, items_index.get_indexer(ranking)], best)
+        ranked = model.rank_items(user_id)
+        np.testing.assert_allclose(list(ranked.values()),
+                                   scores[row, items_index.get_indexer(list(ranked))])
+        assert len(ranked) == np.isfinite(scores[row]).sum()
@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+from base.Model import Model
+from models.Popular import Popular
+
+
+def test_sampled_evaluation_counts_scored_users_only(tmp_path, monkeypatch):
+    monkeypatch.setattr(Model, "saved_models_dir", str(tmp_path / "saved_models"))
+    rng = np.random.default_rng(100)
+    n_events = 2000
+    events = pd.DataFrame({"visitorid": rng.integers(0, 100, n_events),
+                           "itemid": rng.integers(0, 200, n_events),
+                           "rating": np.ones(n_events, dtype=np.int64),
+                           "timestamp": rng.integers(0, 10**6, n_events)})
+    model = Popular(10, "Test")
+    model.fit(events)
+    # every other user only has test items out of the catalog, skipped
+    users_id = np.arange(100)
+    test_data = pd.DataFrame({"visitorid": users_id,
+                              "itemid": np.where(users_id % 2 == 0, users_id, 10**6+users_id)})
+    result = model.evaluate_sampled(test_data, 10, n_negatives=50, max_users=30,
+                                    batch_size=10, tolerance=-1)
+    assert result.attrs["n_users"] == 30
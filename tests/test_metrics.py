@@ -0,0 +1,59 @@
+import numpy as np
+from utils.Metrics import Metrics
+
+# 3 users, top 3 rankings over 10 items:
+# A hits at ranks 1 and 3 of 2 real items, B no hit with only 2
+# ranked items of 1 real item, C hits at rank 2 of 1 real item
+HITS = np.array([[True, False, True],
+                 [False, False, False],
+                 [False, True, False]])
+N_REAL = np.array([2, 1, 1])
+N_RECO = np.array([3, 2, 3])
+N_ITEMS = 10
+
+
+def test_user_metrics_match_hand_computed_values():
+    metrics = Metrics.user_metrics(HITS, N_REAL, N_RECO, N_ITEMS)
+    log3 = np.log2(3)
+    np.testing.assert_allclose(metrics["recall"], [[1/2, 1/2, 1], [0, 0, 0], [0, 1, 1]])
+    np.testing.assert_allclose(metrics["precision"], [[1, 1/2, 2/3], [0, 0, 0], [0, 1/2, 1/3]])
+    # B ranked 2 items only, its false positives stop at 2
+    np.testing.assert_allclose(metrics["fallout"], [[0, 1/8, 1/8], [1/9, 2/9, 2/9],
+                                                    [1/9, 1/9, 2/9]])
+    np.testing.assert_allclose(metrics["ndcg"], [[1, 1/(1+1/log3), 1.5/(1+1/log3)], [0, 0, 0],
+                                                 [0, 1/log3, 1/log3]])
+    np.testing.assert_allclose(metrics["map"], [[1, 1/2, 5/6], [0, 0, 0], [0, 1/2, 1/2]])
+    np.testing.assert_allclose(metrics["mrr"], [[1, 1, 1], [0, 0, 0], [0, 1/2, 1/2]])
+    np.testing.assert_allclose(metrics["hit_rate"], [[1, 1, 1], [0, 0, 0], [0, 1, 1]])
+
+
+def test_rank_hit_metrics_average_users_per_cutoff():
+    result = Metrics.rank_hit_metrics(HITS, N_REAL, N_RECO, N_ITEMS)
+    assert list(result.index) == [1, 2, 3] and result.index.name == "n"
+    np.testing.assert_allclose(result["recall"], [1/6, 1/2, 2/3])
+    np.testing.assert_allclose(result["precision"], [1/3, 1/3, 1/3])
+    np.testing.assert_allclose(result["hit_rate"], [1/3, 2/3, 2/3])
+
+
+def test_partial_auc():
+    # perfect ranking, random ranking, one hit then one miss
+    assert Metrics.partial_auc([0, 0, 1], [0, 1, 1]) == 1.0
+    assert Metrics.partial_auc([0, 0.5, 1], [0, 0.5, 1]) == 0.5
+    assert Metrics.partial_auc([0, 0.5, 1], [0, 1, 1]) == 0.75
+    # partial curve, up to fallout 0.5
+    assert Metrics.partial_auc([0, 0.25, 0.5], [0, 0.5, 0.5]) == 0.1875
+
+
+def test_stratified_bootstrap_weights_strata():
+    values = [np.full((4, 2), 2.0), np.empty((0, 2)), np.full((3, 2), 6.0)]
+    estimate, low, high = Metrics.stratified_bootstrap(values, [1, 2, 3], n_bootstrap=50,
+                                                       rng=np.random.default_rng(0))
+    # the empty stratum is dropped, the others weigh 1/4 and 3/4
+    np.testing.assert_allclose(estimate, [5, 5])
+    np.testing.assert_allclose(low, [5, 5])
+    np.testing.assert_allclose(high, [5, 5])
+    rng = np.random.default_rng(0)
+    values = [rng.random((200, 1)), rng.random((200, 1))+1]
+    estimate, low, high = Metrics.stratified_bootstrap(values, [1, 1], rng=rng)
+    assert low[0] < estimate[0] < high[0]
+    np.testing.assert_allclose(estimate, [(values[0].mean()+values[1].mean())/2])
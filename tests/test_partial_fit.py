@@ -0,0 +1,176 @@
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+from base.Model import Model
+from base.Artifact import Edited_rows
+from models.ItemCF import ItemCF
+from models.UserCF import UserCF
+from models.Popular import Popular
+from models.Random import Random
+from models.TagBasic import TagBasic
+
+NEW_USER, NEW_ITEM = 99999, 77777
+
+
+@pytest.fixture
+def events(tmp_path, monkeypatch):
+    monkeypatch.setattr(Model, "saved_models_dir", str(tmp_path / "saved_models"))
+    monkeypatch.setattr(Model, "event_logs_dir", str(tmp_path / "event_logs"))
+    rng = np.random.default_rng(100)
+    n_events = 400
+    return pd.DataFrame({"visitorid": rng.integers(0, 30, n_events),
+                         "itemid": rng.integers(0, 40, n_events),
+                         "rating": np.ones(n_events, dtype=np.int64),
+                         "timestamp": rng.integers(0, 10**6, n_events),
+                         "tagid": rng.integers(0, 8, n_events)})
+
+
+def new_ids_batch(events):
+    """an existing user touching a new item, a new user touching a new
+       and an existing item
+    """
+    user_id, item_id = int(events["visitorid"][0]), int(events["itemid"][0])
+    return user_id, pd.DataFrame({"visitorid": [user_id, NEW_USER, NEW_USER],
+                                  "itemid": [NEW_ITEM, NEW_ITEM, item_id],
+                                  "rating": [1, 1, 1],
+                                  "timestamp": [10**6]*3,
+                                  "tagid": [0, 0, 1]})
+
+
+@pytest.mark.parametrize("timestamp", [False, True])
+@pytest.mark.parametrize("build", ["dict", "csr"])
+def test_item_cf_skips_items_added_by_partial_fit(events, timestamp, build):
+    model = ItemCF(5, 5, "Test", timestamp=timestamp, build=build)
+    model.fit(events)
+    user_id, batch = new_ids_batch(events)
+    before = model.make_ranking(user_id, 10)
+    model.partial_fit(batch)
+    # the new item has no similar items until the model is refitted
+    assert model.make_ranking(user_id, 10) == before
+    assert NEW_ITEM not in model.make_recommendation(NEW_USER)
+    scores = model.score_items(NEW_USER, np.array([NEW_ITEM, user_id]))
+    assert np.isnan(scores[0])
+
+
+@pytest.mark.parametrize("build", ["dict", "csr"])
+def test_user_cf_skips_users_added_by_partial_fit(events, build):
+    model = UserCF(5, 5, "Test", build=build)
+    model.fit(events)
+    user_id, batch = new_ids_batch(events)
+    model.partial_fit(batch)
+    # the new user has no similar users until the model is refitted
+    assert model.make_recommendation(NEW_USER) == -2
+    assert np.isnan(model.score_items(NEW_USER, np.arange(40))).all()
+    assert isinstance(model.make_recommendation(user_id), set)
+
+
+def popular_item_batch(events, item_id, n_users, timestamp):
+    """n_users existing users touching item_id"""
+    users_id = pd.unique(events["visitorid"])[:n_users]
+    return pd.DataFrame({"visitorid": users_id,
+                         "itemid": [item_id]*len(users_id),
+                         "rating": [1]*len(users_id),
+                         "timestamp": [timestamp]*len(users_id),
+                         "tagid": [2]*len(users_id)})
+
+
+def test_popular_partial_fit_counts_new_events(events):
+    model = Popular(5, "Test")
+    model.fit(events)
+    model.partial_fit(popular_item_batch(events, NEW_ITEM, 25, 10**6))
+    assert model.popularity[NEW_ITEM] == 25
+    untouched_user = int(pd.unique(events["visitorid"])[-1])
+    assert model.make_ranking(untouched_user, 1) == [NEW_ITEM]
+
+
+def test_random_partial_fit_adds_new_items(events):
+    model = Random(5, "Test")
+    model.fit(events)
+    model.partial_fit(new_ids_batch(events)[1])
+    assert NEW_ITEM in model.pool_items
+    assert sorted(model.items_pool) == sorted(model.items)
+
+
+def test_tag_basic_partial_fit_counts_new_tags(events):
+    model = TagBasic(5, 3, "Test")
+    model.fit(events)
+    user_id, batch = new_ids_batch(events)
+    n_used = model.tags[0].n_used
+    model.partial_fit(batch)
+    assert model.tags[0].n_used == n_used+2
+    assert model.tags[0].items_count[NEW_ITEM] == 2
+    assert model.users[NEW_USER].tags_count == {0: 1, 1: 1}
+
+
+def make_model(model_type):
+    return {"MostPopular": lambda: Popular(5, "Test"),
+            "TagBasic": lambda: TagBasic(5, 3, "Test"),
+            "ItemCF": lambda: ItemCF(5, 5, "Test"),
+            "UserCF": lambda: UserCF(5, 5, "Test")}[model_type]()
+
+
+def rankings(model, users_id):
+    return {user_id: model.make_ranking(user_id, 10) for user_id in users_id}
+
+
+@pytest.mark.parametrize("snapshot", [False, True])
+@pytest.mark.parametrize("model_type", ["MostPopular", "TagBasic", "ItemCF", "UserCF"])
+def test_restore_matches_live_model(events, model_type, snapshot):
+    live = make_model(model_type)
+    live.fit(events)
+    user_id, batch = new_ids_batch(events)
+    batches = [batch, popular_item_batch(events, NEW_ITEM+1, 20, 2*10**6),
+               popular_item_batch(events, NEW_ITEM+2, 10, 3*10**6)]
+    for seq, batch in enumerate(batches):
+        live.partial_fit(batch, snapshot=snapshot and seq == 1)
+    # a fresh process: fit finds the saved model, restore catches up
+    restored = make_model(model_type)
+    restored.fit(events)
+    assert restored.restore() == (1 if snapshot else 3)
+    assert restored.log_seq == live.log_seq == 3
+    users_id = sorted(live.users)
+    assert len(restored.users) == len(live.users)
+    assert rankings(restored, users_id) == rankings(live, users_id)
+
+
+def test_random_restore_matches_live_items(events):
+    live = Random(5, "Test")
+    live.fit(events)
+    live.partial_fit(new_ids_batch(events)[1], snapshot=True)
+    live.partial_fit(popular_item_batch(events, NEW_ITEM+1, 5, 2*10**6))
+    restored = Random(5, "Test")
+    restored.fit(events)
+    assert restored.restore() == 1
+    assert sorted(restored.items_pool) == sorted(live.items_pool)
+
+
+def test_partial_fit_builds_only_the_batch_objects(events):
+    # the first fit saves the histories, the second one loads them
+    Popular(5, "Test").fit(events)
+    model = Popular(5, "Test")
+    model.fit(events)
+    n_users, n_items = len(model.users), len(model.items)
+    user_id, batch = new_ids_batch(events)
+    model.partial_fit(batch)
+    assert isinstance(model.users, Edited_rows) and isinstance(model.items, Edited_rows)
+    assert set(model.users.edited) == {user_id, NEW_USER}
+    assert set(model.items.edited) == {NEW_ITEM, int(events["itemid"][0])}
+    assert len(model.users) == n_users+1 and len(model.items) == n_items+1
+    assert NEW_ITEM in model.users[user_id].covered_items
+
+
+@pytest.mark.parametrize("model_type", ["MostPopular", "ItemCF"])
+def test_restore_replays_whole_log_when_snapshot_evicted(events, model_type):
+    live = make_model(model_type)
+    live.fit(events)
+    live.partial_fit(new_ids_batch(events)[1])
+    live.partial_fit(popular_item_batch(events, NEW_ITEM+1, 20, 2*10**6), snapshot=True)
+    snapshot_path = live.artifact_path("history", live.tag)
+    live.partial_fit(popular_item_batch(events, NEW_ITEM+2, 10, 3*10**6))
+    shutil.rmtree(snapshot_path)
+    restored = make_model(model_type)
+    restored.fit(events)
+    assert restored.restore() == 3
+    users_id = sorted(live.users)
+    assert rankings(restored, users_id) == rankings(live, users_id)
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+from base.Model import Model
+from models.PersonalRank import PersonalRank
+
+
+def test_personal_rank_matches_dense_power_iteration(tmp_path, monkeypatch):
+    monkeypatch.setattr(Model, "saved_models_dir", str(tmp_path / "saved_models"))
+    rng = np.random.default_rng(100)
+    n_events = 400
+    events = pd.DataFrame({"visitorid": rng.integers(0, 30, n_events),
+                           "itemid": rng.integers(0, 40, n_events),
+                           "rating": np.ones(n_events, dtype=np.int64),
+                           "timestamp": rng.integers(0, 10**6, n_events)})
+    alpha = 0.8
+    model = PersonalRank(5, "Test", alpha=alpha, max_iter=200, tol=1e-7, batch_size=8)
+    model.fit(events)
+    users_index, items_index = pd.Index(model.users_id), pd.Index(model.items_id)
+    R = np.zeros((len(users_index), len(items_index)))
+    R[users_index.get_indexer(events["visitorid"]), items_index.get_indexer(events["itemid"])] = 1
+    # a walker at a user goes to one of its items, at an item to one
+    # of its users, and restarts with probability 1-alpha
+    to_items = (R/R.sum(axis=1, keepdims=True)).T
+    to_users = R/R.sum(axis=0, keepdims=True)
+    restart = (1-alpha)*np.eye(len(users_index))
+    users = restart.copy()
+    for _ in range(500):
+        items = alpha*to_items @ users
+        users = alpha*to_users @ items+restart
+    scores = items.T
+    scores[R > 0] = -np.inf
+    for row, user_id in enumerate(model.users_id.tolist()):
+        ranking = model.make_ranking(user_id, 10)
+        # tie proof: the ranked items have the 10 best reference scores
+        best = np.sort(scores[row])[::-1][:len(ranking)]
+        np.testing.assert_allclose(scores[row, items_index.get_indexer(ranking)], best, rtol=1e-4)
+        ranked = model.rank_items(user_id)
+        np.testing.assert_allclose(list(ranked.values()),
+                                   scores[row, items_index.get_indexer(list(ranked))], rtol=1e-4)
+        assert len(ranked) == np.isfinite(scores[row]).sum()
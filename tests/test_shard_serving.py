@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+from base.Model import Model
+from models.Popular import Popular
+from utils.Shard_serving import Shard_serving
+
+
+def test_sharded_most_popular_matches_single_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(Model, "saved_models_dir", str(tmp_path / "saved_models"))
+    rng = np.random.default_rng(100)
+    n_events = 300
+    # few users, many items of equal popularity
+    events = pd.DataFrame({"visitorid": rng.integers(0, 30, n_events),
+                           "itemid": rng.permutation(np.repeat(np.arange(60), 5)),
+                           "rating": np.ones(n_events, dtype=np.int64),
+                           "timestamp": rng.integers(0, 10**6, n_events)})
+    model = Popular(10, "Test")
+    model.fit(events)
+    items_id = np.fromiter(model.items, dtype=np.int64, count=len(model.items))
+    shards = Shard_serving.assign(items_id, 3)
+    for user_id in range(30):
+        tops = [Shard_serving.local_top(model, user_id, shard_items_id, 10)
+                for shard_items_id in shards]
+        assert Shard_serving.merge(tops, 10) == model.make_ranking(user_id, 10)
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+from base.Model import Model
+from models.ItemCF import ItemCF
+from models.UserCF import UserCF
+
+
+@pytest.fixture
+def events():
+    rng = np.random.default_rng(100)
+    n_events = 400
+    return pd.DataFrame({"visitorid": rng.integers(0, 30, n_events),
+                         "itemid": rng.integers(0, 40, n_events),
+                         "rating": np.ones(n_events, dtype=np.int64),
+                         "timestamp": rng.integers(0, 10**6, n_events)})
+
+
+def fit_both_builds(model_cls, k, events, tmp_path, monkeypatch, **kwargs):
+    """models fitted with the dict and the csr build, each in its own
+       cache since all builds share one sim matrix entry
+    """
+    models = {}
+    for build in ("dict", "csr"):
+        monkeypatch.setattr(Model, "saved_models_dir", str(tmp_path / build))
+        models[build] = model_cls(5, k, "Test", build=build, **kwargs)
+        models[build].fit(events)
+    return models["dict"], models["csr"]
+
+
+def assert_same_neighbors(dict_model, csr_model):
+    assert sorted(dict_model.sim_matrix) == sorted(csr_model.sim_matrix)
+    for obj_id in dict_model.sim_matrix:
+        dict_row, csr_row = dict_model.sim_matrix[obj_id], csr_model.sim_matrix[obj_id]
+        assert sorted(dict_row) == sorted(csr_row)
+        np.testing.assert_allclose([csr_row[i] for i in dict_row], list(dict_row.values()),
+                                   rtol=1e-5)
+
+
+@pytest.mark.parametrize("timestamp", [False, True])
+def test_item_cf_builds_agree(events, tmp_path, monkeypatch, timestamp):
+    dict_model, csr_model = fit_both_builds(ItemCF, 20, events, tmp_path, monkeypatch,
+                                            timestamp=timestamp, dtype="float64")
+    assert_same_neighbors(dict_model, csr_model)
+    for user_id in pd.unique(events["visitorid"]):
+        assert dict_model.make_ranking(user_id, 10) == csr_model.make_ranking(user_id, 10)
+
+
+@pytest.mark.parametrize("timestamp", [False, True])
+def test_user_cf_builds_agree(events, tmp_path, monkeypatch, timestamp):
+    dict_model, csr_model = fit_both_builds(UserCF, 10, events, tmp_path, monkeypatch,
+                                            timestamp=timestamp, dtype="float64")
+    assert_same_neighbors(dict_model, csr_model)
+    for user_id in pd.unique(events["visitorid"]):
+        assert dict_model.make_ranking(user_id, 10) == csr_model.make_ranking(user_id, 10)
@@ -0,0 +1,11 @@
+from utils.Sweep import Sweep
+
+
+def test_blend_configs_group_by_training_params():
+    components = [["ItemCF", 0.5, {"k": 10}], ["MostPopular", 0.5, {}]]
+    configs = Sweep.grid("Blend", "MovieLens_100K", components=[components],
+                         normalization=["rank", "minmax"], n=[10, 20], candidates=[50, 100])
+    groups = Sweep(configs).group_configs()
+    # n and candidates are serving params of Blend
+    assert sorted(len(group) for group in groups) == [4, 4]
+    assert {group[0]["normalization"] for group in groups} == {"rank", "minmax"}
@@ -0,0 +1,20 @@
+import os
+from utils.Data_util import Data_util
+from utils.Synthetic_data import Synthetic_data
+
+
+def test_write_keeps_data_set_written_meanwhile(tmp_path):
+    data_dir = str(tmp_path)
+    folder = Synthetic_data(2000).write("Synthetic_2K", data_dir=data_dir)
+    mtime = os.path.getmtime(os.path.join(folder, "ratings.dat"))
+    # a second process finishing after the first one keeps its data set
+    assert Synthetic_data(2000).write("Synthetic_2K", data_dir=data_dir, replace=False) == folder
+    assert os.path.getmtime(os.path.join(folder, "ratings.dat")) == mtime
+    assert sorted(os.listdir(data_dir)) == ["Synthetic_2K"]
+
+
+def test_data_util_keeps_synthetic_paths_per_instance(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    DU = Data_util("Synthetic_2K")
+    assert DU.data_paths["Synthetic_2K"] == "data/Synthetic_2K/ratings.dat"
+    assert "Synthetic_2K" not in Data_util.data_paths
@@ -0,0 +1,48 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("keras")
+pytest.importorskip("h5py")
+
+from base.Model import Model  # noqa: E402
+from models.LFM import LFM  # noqa: E402
+
+NEW_USER, NEW_ITEM = 60, 70
+
+
+@pytest.fixture
+def events(tmp_path, monkeypatch):
+    monkeypatch.setattr(Model, "saved_models_dir", str(tmp_path / "saved_models"))
+    monkeypatch.setattr(Model, "event_logs_dir", str(tmp_path / "event_logs"))
+    rng = np.random.default_rng(100)
+    n_events = 300
+    events = pd.DataFrame({"visitorid": rng.integers(0, 30, n_events),
+                           "itemid": rng.integers(0, 40, n_events),
+                           "timestamp": np.arange(n_events)})
+    return events.drop_duplicates(["visitorid", "itemid"], ignore_index=True)
+
+
+def test_lfm_update_grows_embeddings(events):
+    model = LFM("Test", 5, neg_frac_in_train=2, batch_size=64, workers=1)
+    model.train_config.epochs = 1
+    model.fit(events)
+    old_item_rows = model.model.get_layer("item_embedding").get_weights()[0]
+    user_id = int(events["visitorid"][0])
+    batch = pd.DataFrame({"visitorid": [user_id, NEW_USER, NEW_USER],
+                          "itemid": [NEW_ITEM, NEW_ITEM, int(events["itemid"][0])],
+                          "timestamp": [10**6]*3})
+    model.update(batch, epochs=1)
+    # tables grow up to the new ids, old rows are kept then trained
+    assert model.model.get_layer("user_embedding").input_dim == NEW_USER+1
+    item_rows = model.model.get_layer("item_embedding").get_weights()[0]
+    assert item_rows.shape == (NEW_ITEM+1, old_item_rows.shape[1])
+    assert NEW_USER in model.users and NEW_ITEM in model.items
+    ranking = model.rank_items(NEW_USER)
+    assert NEW_ITEM not in ranking and len(ranking) == len(model.items)-2
+    other_user = next(i for i in pd.unique(events["visitorid"]) if i != user_id)
+    assert NEW_ITEM in model.rank_items(int(other_user))
+    # finished updates leave no checkpoint behind
+    assert not any(name.startswith("update_checkpoint-")
+                   for name in os.listdir(Model.saved_models_dir))
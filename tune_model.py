@@ -0,0 +1,7 @@
+from utils.Train_config import Train_config
+
+if __name__ == "__main__":
+    # the fastest stable config is saved to models/train_configs, models
+    # created with train_config="tuned" train with it
+    Train_config.autotune("LFM", "MovieLens_100K", n=100, neg_frac=40)
+    Train_config.autotune("Wide&Deep", "MovieLens_100K", n=20, neg_frac=40)
@@ -0,0 +1,96 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .Instrument import Instrument
+
+
+class ALS:
+    """confidence weighted implicit feedback matrix factorization
+       (Hu, Koren and Volinsky, 2008) with alternating least squares
+
+       every touched (user, item) has preference 1 and confidence
+       1+alpha, every untouched one preference 0 and confidence 1,
+       so no negative samples are needed, the solve of one side only
+       costs the touched entries of each row thanks to
+
+           A_u = Y'Y + alpha*Y_u'Y_u + reg*I,  b_u = (1+alpha)*sum(Y_u)
+
+       rows are solved in chunks with one batched np.linalg.solve,
+       chunks run on a thread pool (numpy releases the GIL)
+    """
+    def __init__(self, dim=32, reg=0.1, alpha=10.0, iterations=10,
+                 chunk_size=256, n_threads=None, seed=100):
+        """
+        Parameters
+        ----------
+        dim : [int]
+            [number of latent factors]
+        reg : [float]
+            [L2 regularization of the factors]
+        alpha : [float]
+            [confidence added to touched items]
+        iterations : [int]
+            [number of (users, items) alternations]
+        """
+        self.dim = dim
+        self.reg = reg
+        self.alpha = alpha
+        self.iterations = iterations
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.seed = seed
+
+    @staticmethod
+    def transpose(indptr, indices, n_cols):
+        """CSR arrays of the transposed 0/1 matrix"""
+        rows = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+        order = np.argsort(indices, kind="stable")
+        t_indptr = np.r_[0, np.cumsum(np.bincount(indices, minlength=n_cols))]
+        return t_indptr, rows[order]
+
+    def solve_chunk(self, indptr, indices, Y, YtY, start, end):
+        n_rows = end-start
+        A = np.broadcast_to(YtY+self.reg*np.eye(self.dim, dtype=Y.dtype),
+                            (n_rows, self.dim, self.dim)).copy()
+        b = np.zeros((n_rows, self.dim), dtype=Y.dtype)
+        for i in range(n_rows):
+            Y_u = Y[indices[indptr[start+i]:indptr[start+i+1]]]
+            A[i] += self.alpha*(Y_u.T @ Y_u)
+            b[i] = (1+self.alpha)*Y_u.sum(axis=0)
+        return np.linalg.solve(A, b[:, :, None])[:, :, 0]
+
+    def solve(self, indptr, indices, Y, pool):
+        """least squares factors of every row given the other side Y"""
+        YtY = Y.T @ Y
+        starts = range(0, len(indptr)-1, self.chunk_size)
+        chunks = pool.map(lambda start: self.solve_chunk(
+            indptr, indices, Y, YtY, start, min(start+self.chunk_size, len(indptr)-1)), starts)
+        return np.concatenate(list(chunks)) if len(starts) else np.zeros((0, self.dim), Y.dtype)
+
+    def fit(self, indptr, indices, n_items):
+        """
+        Parameters
+        ----------
+        indptr, indices : [np array]
+            [users x items 0/1 matrix in CSR, indices are item positions]
+        n_items : [int]
+            [number of columns]
+
+        Returns
+        -------
+        [ALS]
+            [self, with user_factors (n_users x dim) and
+             item_factors (n_items x dim) as float32]
+        """
+        t_indptr, t_indices = self.transpose(indptr, indices, n_items)
+        rng = np.random.default_rng(self.seed)
+        self.user_factors = np.zeros((len(indptr)-1, self.dim))
+        self.item_factors = rng.normal(0, 0.01, (n_items, self.dim))
+        with ThreadPoolExecutor(self.n_threads) as pool:
+            for iteration in range(self.iterations):
+                with Instrument.stage("als_iteration"):
+                    self.user_factors = self.solve(indptr, indices, self.item_factors, pool)
+                    self.item_factors = self.solve(t_indptr, t_indices, self.user_factors, pool)
+        self.user_factors = self.user_factors.astype(np.float32)
+        self.item_factors = self.item_factors.astype(np.float32)
+        return self
@@ -0,0 +1,132 @@
+import os
+import json
+import shutil
+import hashlib
+import pandas as pd
+from base.Artifact import Artifact
+
+
+class Cache:
+    """content addressed store of the training stage outputs
+
+       every entry is a directory root/<stage>-<key>, the key hashes
+       the fingerprint of the data the stage was computed from and
+       the parameters it depends on, so changed data or parameters
+       never hit a stale entry and models trained on the same data
+       share their common stages (e.g. users and items histories)
+
+       entries are used as a LRU: reading one touches it, writing one
+       evicts the least recently used entries above max_bytes, an
+       entry already in the cache is not written again
+    """
+    # total size of the entries, RECSYS_CACHE_BYTES overrides
+    max_bytes = int(os.environ.get("RECSYS_CACHE_BYTES", 20*2**30))
+    # (path, size, mtime) -> file fingerprint, files are hashed once
+    file_fingerprints = {}
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()[:20]
+
+    @staticmethod
+    def fingerprint(data, columns=None):
+        """hash of a DataFrame's content, restricted to columns if given
+        """
+        if columns is not None:
+            data = data[[col for col in columns if col in data]]
+        h = hashlib.sha1(",".join(map(str, data.columns)).encode())
+        h.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def fingerprint_file(cls, path):
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        try:
+            return cls.file_fingerprints[memo_key]
+        except KeyError:
+            pass
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                h.update(chunk)
+        cls.file_fingerprints[memo_key] = h.hexdigest()
+        return cls.file_fingerprints[memo_key]
+
+    def path(self, stage, key):
+        return os.path.join(self.root, "{}-{}".format(stage, key))
+
+    @staticmethod
+    def touch(path):
+        """mark an entry as recently used"""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def read(self, path):
+        """read an Artifact entry, raise FileNotFoundError if missing"""
+        arrays, meta = Artifact.read(path)
+        self.touch(path)
+        return arrays, meta
+
+    def write(self, path, arrays, meta=None):
+        # an existing entry has the same content by construction
+        if os.path.isdir(path):
+            self.touch(path)
+            return
+        # an entry written meanwhile by another process is kept
+        Artifact.write(path, arrays, meta)
+        self.evict(keep=path)
+
+    def write_with(self, path, writer):
+        """write an entry of other files, writer(tmp_dir) writes them
+           into a temporary directory which is renamed into place
+        """
+        if os.path.isdir(path):
+            self.touch(path)
+            return
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = "{}.tmp-{}".format(path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        writer(tmp_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # written meanwhile by another process
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=path)
+
+    @staticmethod
+    def dir_size(path):
+        return sum(os.path.getsize(os.path.join(root, file_name))
+                   for root, _, files in os.walk(path) for file_name in files)
+
+    def entries(self):
+        """[(last used time, size, path)] of all complete entries"""
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if ".tmp-" in name or not os.path.isdir(path):
+                continue
+            entries.append((os.path.getmtime(path), self.dir_size(path), path))
+        return entries
+
+    def evict(self, keep=None):
+        """remove least recently used entries until the cache fits in
+           max_bytes, the entry keep is never removed
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            print("[Cache] Evicting {} ({} bytes)".format(path, size))
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,83 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from .Data_util import Data_util
+
+
+class Cross_validation:
+    """fit and evaluate one model configuration on every fold of a
+       cross validation in parallel worker processes
+
+       the folds are parsed once into the cache by the parent, every
+       worker memory maps them and fits (or loads) the model of its
+       fold, so the wall time is close to the one of a single fold when
+       there are enough cores
+    """
+    def __init__(self, model_type, data_type, scheme="u", k=5, n_workers=None, **kwargs):
+        """
+        Parameters
+        ----------
+        scheme, k : [str, int]
+            [folds, see Data_util.read_folds]
+        n_workers : [int]
+            [size of the process pool, default one per fold up to the
+             number of cpus]
+        kwargs : [dict]
+            [run_model kwargs of the model, metrics are reported at n]
+        """
+        self.model_type = model_type
+        self.data_type = data_type
+        self.scheme = scheme
+        self.k = k
+        self.n_workers = n_workers
+        self.kwargs = kwargs
+
+    @staticmethod
+    def run_fold(model_type, data_type, scheme, k, fold, kwargs):
+        from run_model import fit_model
+        DU = Data_util(data_type)
+        train_data, test_data = DU.read_folds(scheme, k, fold=fold)[0]
+        start = time.time()
+        model = fit_model(model_type, data_type, DU, train_data, **kwargs)
+        fit_time = time.time()-start
+        start = time.time()
+        result = model.evaluate_ranking(test_data, kwargs["n"])
+        row = {"fold": fold}
+        row.update(result.loc[kwargs["n"]].to_dict())
+        row["auc"] = result.attrs["AUC"]
+        row["fit_time"], row["eval_time"] = fit_time, time.time()-start
+        return row
+
+    def run(self, result_path=None):
+        """
+        Returns
+        -------
+        [tuple]
+            [(folds, summary), one row of metrics per fold and their
+             mean and variance over the folds]
+        """
+        # parse once in the parent, workers only read the cached folds
+        n_folds = len(Data_util(self.data_type).read_folds(self.scheme, self.k))
+        n_workers = self.n_workers or min(n_folds, os.cpu_count() or 1)
+        print("[Cross_validation] {} {} folds of {} on {} workers".format(
+            n_folds, self.scheme, self.data_type, n_workers))
+        start = time.time()
+        # spawn, keras/tensorflow state is not fork safe
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=context) as executor:
+            rows = list(executor.map(Cross_validation.run_fold,
+                                     *zip(*[(self.model_type, self.data_type, self.scheme,
+                                             self.k, fold, self.kwargs)
+                                            for fold in range(n_folds)])))
+        folds = pd.DataFrame(rows).set_index("fold")
+        summary = pd.DataFrame({"mean": folds.mean(), "var": folds.var(ddof=1)})
+        summary.attrs["wall_time"] = time.time()-start
+        print("[Cross_validation] done in {:.1f}s, recall@{} {:.4f} (var {:.2g})".format(
+            summary.attrs["wall_time"], self.kwargs["n"], summary.loc["recall", "mean"],
+            summary.loc["recall", "var"]))
+        if result_path is not None:
+            os.makedirs(os.path.dirname(result_path) or ".", exist_ok=True)
+            folds.to_csv(result_path)
+        return folds, summary
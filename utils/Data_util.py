@@ -1,8 +1,12 @@
 from itertools import islice
 import pandas as pd
+import numpy as np
 import os
 from glob import glob
 from base.Model import Model
+from .Synthetic_data import Synthetic_data
+from .Instrument import Instrument
+from .Cache import Cache
 
 
 class Data_util:
@@ -13,6 +17,13 @@ class Data_util:
     }
 
     def __init__(self, data_type):
+        # per instance, synthetic entries are not shared
+        self.data_paths = dict(self.data_paths)
+        if data_type.startswith("Synthetic_"):
+            # generated on first use, e.g. Synthetic_100K, Synthetic_10M
+            if not os.path.exists(os.path.join("data", data_type)):
+                Synthetic_data.from_data_type(data_type).write(data_type, replace=False)
+            self.data_paths[data_type] = "data/{}/ratings.dat".format(data_type)
         # get available data folder names
         data_types = [dir_name.split("/")[1] for dir_name in glob("data/*")]
         if data_type not in data_types:
@@ -28,20 +39,143 @@ class Data_util:
         return row
 
     @staticmethod
+    @Instrument.staged("split")
     def sort_user_actions(event_data, test_size):
-        train, test = pd.DataFrame(), pd.DataFrame()
-        users_id = pd.unique(event_data['visitorid'])
-        for user_id in users_id:
-            user_actions = event_data.loc[event_data['visitorid']== user_id, :]
-            user_actions = user_actions.sort_values(by=["timestamp"])
-            split = int(test_size*len(user_actions))
-            test = pd.concat([test, user_actions.iloc[:split]],
-                             ignore_index=True)
-            train = pd.concat([train, user_actions.iloc[split:]],
-                              ignore_index=True)
+        """sort each user's actions by timestamp, the first test_size
+           fraction of every user goes to the test set, users keep
+           their order of first appearance
+
+           the sort is stable, actions with the same timestamp keep
+           their order in event_data; the per user quicksort this
+           replaced ordered them arbitrarily, so the splits differ
+           from it on ties (317 test pairs of MovieLens_100K)
+        """
+        user_order = pd.factorize(event_data['visitorid'])[0]
+        order = np.lexsort((event_data['timestamp'].values, user_order))
+        event_data = event_data.iloc[order]
+        user_order = user_order[order]
+        # position of each action inside its user's sorted actions
+        user_start = np.r_[0, np.flatnonzero(np.diff(user_order)) + 1]
+        user_size = np.diff(np.r_[user_start, len(user_order)])
+        position = np.arange(len(user_order)) - np.repeat(user_start, user_size)
+        split = (test_size*user_size).astype(np.int64)
+        is_test = position < np.repeat(split, user_size)
+        train, test = event_data.loc[~is_test, :], event_data.loc[is_test, :]
         return train.reset_index(drop=True), test.reset_index(drop=True)
 
+    @staticmethod
+    def frame_to_arrays(data, prefix):
+        arrays = {}
+        for col in data.columns:
+            values = data[col].to_numpy()
+            # np.save cannot store object arrays without pickle
+            arrays["{}_{}".format(prefix, col)] = values.astype(str) if values.dtype == object else values  # noqa
+        return arrays
+
+    @staticmethod
+    def frame_from_arrays(arrays, prefix, columns):
+        data = pd.DataFrame({col: np.array(arrays["{}_{}".format(prefix, col)]) for col in columns})
+        for col in columns:
+            if data[col].dtype.kind == "U":
+                data[col] = data[col].astype(object)
+        return data
+
     def read_event_data(self, test_size=0.25):
+        """parsed and split events are cached, keyed by the content
+           of the data file
+        """
+        cache = Cache(Model.saved_models_dir)
+        path = cache.path("event_data", Cache.key(
+            Cache.fingerprint_file(self.data_paths[self.data_type]), self.data_type, test_size))
+        try:
+            arrays, meta = cache.read(path)
+            return (self.frame_from_arrays(arrays, "train", meta["columns"]),
+                    self.frame_from_arrays(arrays, "test", meta["columns"]))
+        except OSError:
+            pass
+        data = self.read_raw_event_data()
+        train, test = self.sort_user_actions(data, test_size)
+        arrays = dict(self.frame_to_arrays(train, "train"), **self.frame_to_arrays(test, "test"))
+        cache.write(path, arrays, {"columns": list(train.columns)})
+        return train, test
+
+    # predefined MovieLens_100K splits, <name>.base and <name>.test
+    fold_files = {"u": ["u1", "u2", "u3", "u4", "u5"], "ua": ["ua"], "ub": ["ub"]}
+
+    def read_folds(self, scheme="u", k=5, fold=None):
+        """cross validation folds, parsed once and cached, workers read
+           them memory mapped
+
+        Parameters
+        ----------
+        scheme : [str]
+            [u, ua, ub: predefined MovieLens_100K splits (u1..u5, ua,
+             ub), time: k time aware folds, fold i trains on the events
+             before the (i+1)/(k+1) timestamp quantile and tests on the
+             events up to the next one]
+        fold : [int]
+            [index of the only fold to return, all folds by default]
+
+        Returns
+        -------
+        [list]
+            [(train, test) event frames of the folds]
+        """
+        cache = Cache(Model.saved_models_dir)
+        if scheme == "time":
+            source = [self.data_paths[self.data_type]]
+        elif scheme in self.fold_files:
+            folder = os.path.dirname(self.data_paths[self.data_type])
+            source = [os.path.join(folder, "{}.{}".format(name, part))
+                      for name in self.fold_files[scheme] for part in ("base", "test")]
+            if not all(os.path.exists(path) for path in source):
+                raise ValueError("No predefined {} folds for data type {}".format(scheme, self.data_type))  # noqa
+        else:
+            raise ValueError("Invalid fold scheme: {}, must be time or in {}".format(
+                scheme, list(self.fold_files)))
+        path = cache.path("folds", Cache.key(*[Cache.fingerprint_file(file_path) for file_path in source],
+                                             self.data_type, scheme, k))
+        try:
+            arrays, meta = cache.read(path)
+        except OSError:
+            if scheme == "time":
+                folds = self.time_folds(self.read_raw_event_data(), k)
+            else:
+                data = [self.read_raw_event_data(file_path) for file_path in source]
+                folds = list(zip(data[0::2], data[1::2]))
+            arrays = {}
+            for i, (train, test) in enumerate(folds):
+                arrays.update(self.frame_to_arrays(train, "train{}".format(i)))
+                arrays.update(self.frame_to_arrays(test, "test{}".format(i)))
+            cache.write(path, arrays, {"columns": list(folds[0][0].columns), "n_folds": len(folds)})
+            arrays, meta = cache.read(path)
+        indexes = range(meta["n_folds"]) if fold is None else [fold]
+        return [(self.frame_from_arrays(arrays, "train{}".format(i), meta["columns"]),
+                 self.frame_from_arrays(arrays, "test{}".format(i), meta["columns"]))
+                for i in indexes]
+
+    @staticmethod
+    def time_folds(data, k):
+        """k rolling origin folds over the timestamp quantiles, test
+           events of users without training events are dropped, no
+           model can rank items for them
+        """
+        cuts = np.quantile(data["timestamp"], np.arange(1, k+2)/(k+1))
+        cuts[-1] = np.inf
+        folds = []
+        for i in range(k):
+            is_train = data["timestamp"] < cuts[i]
+            is_test = ~is_train & (data["timestamp"] < cuts[i+1])
+            is_test &= data["visitorid"].isin(data.loc[is_train, "visitorid"])
+            folds.append((data.loc[is_train, :].reset_index(drop=True),
+                          data.loc[is_test, :].reset_index(drop=True)))
+        return folds
+
+    @Instrument.staged("read_event_data")
+    def read_raw_event_data(self, path=None):
+        """parse the whole event file, before train/test split, or
+           another file of the data set in the same format
+        """
         skip_first_row = False
         if self.data_type[-1] == 'K':
             sep = "\t"
@@ -52,21 +186,23 @@ class Data_util:
             sep = "::"
         else:
             raise ValueError("[data_util] Invalid data type name.")
-        with open(self.data_paths[self.data_type], 'r') as f:
+        with open(path or self.data_paths[self.data_type], 'r') as f:
             if skip_first_row:
                 f.readline()  # make the generator one step forward
             data = [self.parse_line(row, sep) for row in islice(f, None)]
         if self.data_type == "Hetrec-2k":
             cols = ["visitorid", "itemid", "tagid", "timestamp"]
+        elif data and len(data[0]) == 5:
+            # synthetic data generated with tags
+            cols = ["visitorid", "itemid", "rating", "timestamp", "tagid"]
         else:
             cols = ["visitorid", "itemid", "rating", "timestamp"]
         data = pd.DataFrame(data, columns=cols)
         # data type convert
-        data["timestamp"] = data["timestamp"].apply(lambda x: int(x))
-        data["visitorid"] = data["visitorid"].apply(lambda x: int(x))
-        data["itemid"] = data["itemid"].apply(lambda x: int(x))
-        train, test = self.sort_user_actions(data, test_size)
-        return train, test
+        data["timestamp"] = data["timestamp"].astype(np.int64)
+        data["visitorid"] = data["visitorid"].astype(np.int64)
+        data["itemid"] = data["itemid"].astype(np.int64)
+        return data
 
     @staticmethod
     def join_movie_lens_event_data(event_data, users_info, items_info):
@@ -95,15 +231,28 @@ class Data_util:
             if n_created == n_neg:
                 break
         else:
+            Instrument.count("users_short_of_negatives")
             print("""Not enough untouched items for user {} to create {} negative samples, create {} instead.""".format(user.id, n_neg, n_created))  # noqa
 
+    @Instrument.staged("negative_samples")
     def create_negative_samples(self, pos_samples, neg_frac):
         """
         create negative samples for each user
         if the item is not touched by the user
         and its popularity is high, then mark
         this item as user's negative sample
+
+        negative samples are cached, keyed by the positive samples
+        and neg_frac
         """
+        cache = Cache(Model.saved_models_dir)
+        path = cache.path("negative_samples", Cache.key(
+            Cache.fingerprint(pos_samples, Model.history_columns), neg_frac))
+        try:
+            arrays, _ = cache.read(path)
+            return self.frame_from_arrays(arrays, "neg", ['visitorid', 'itemid', 'event'])
+        except OSError:
+            pass
         self.items, self.users = Model.init_item_and_user_objects(pos_samples)  # noqa
         # sort items by popularity
         item_pop = {}
@@ -118,8 +267,10 @@ class Data_util:
             self.create_negative_samples_for_single_user(user, items_pop,
                                                          negative_samples,
                                                          neg_frac)
-        return pd.DataFrame(negative_samples,
-                            columns=['visitorid', 'itemid', 'event'])
+        negative_samples = pd.DataFrame(negative_samples,
+                                        columns=['visitorid', 'itemid', 'event'])
+        cache.write(path, self.frame_to_arrays(negative_samples, "neg"))
+        return negative_samples
 
     def build_samples(self, neg_frac, train_event_data):
         """ return all samples
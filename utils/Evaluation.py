@@ -1,7 +1,7 @@
-import numpy as np
+import os
 import pandas as pd
 from run_model import run
-"https://docs.scipy.org/doc/numpy/reference/generated/numpy.trapz.html"
+from utils.Metrics import Metrics
 
 
 class Evaluation:
@@ -18,17 +18,20 @@ class Evaluation:
             self.model_kwargs = {}
     
     def compute_recall_precision_pairs(self):
-        pairs = []
-        for n_reco in range(self.min_n, self.max_n+1, 5):
-            self.model_kwargs["n"] = n_reco
-            result = run(self.model_type, self.data_type, **self.model_kwargs)
-            print("*"*10, " ", n_reco, " ", "*"*10)
-            print(result)
-            pairs.append((n_reco, result["recall"], result["fallout"]))
-        df = pd.DataFrame(pairs, columns=["n", "recall", "fallout"])
+        # one pipeline ranks up to max_n items per user,
+        # metrics at every cutoff come from the same rankings
+        self.model_kwargs["n"] = self.max_n
+        self.model_kwargs["max_n"] = self.max_n
+        result = run(self.model_type, self.data_type, **self.model_kwargs)
+        print(self.model_type, " partial AUC over all cutoffs: ", result.attrs["AUC"])
+        df = result.loc[range(self.min_n, self.max_n+1, 5), :].reset_index()
+        print(df)
+        os.makedirs("evaluation_results", exist_ok=True)
         df.to_csv("evaluation_results/{}.csv".format(self.model_type), index=False)
+        return df
     
     def compute_AUC(self):
         df = pd.read_csv("evaluation_results/{}.csv".format(self.model_type))
-        AUC = np.trapz(y=df["recall"], x=df["fallout"])
-        print(self.model_type, " AUC: ", AUC)
\ No newline at end of file
+        AUC = Metrics.partial_auc(df["fallout"], df["recall"])
+        print(self.model_type, " AUC: ", AUC)
+        return AUC
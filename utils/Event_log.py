@@ -0,0 +1,63 @@
+import os
+import json
+from glob import glob
+import numpy as np
+from .Data_util import Data_util
+
+
+class Event_log:
+    """append-only on-disk log of event batches
+
+       every batch is one .npz file named by its sequence number,
+       written aside and renamed into place, so a crash never leaves a
+       partial batch; snapshot.json records the last batch included in
+       a saved model state, a fresh process loads that state and
+       replays the batches after it
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def batch_path(self, seq):
+        return os.path.join(self.path, "batch-{:012d}.npz".format(seq))
+
+    def last_seq(self):
+        paths = sorted(glob(os.path.join(self.path, "batch-*.npz")))
+        return int(os.path.basename(paths[-1])[6:-4]) if paths else 0
+
+    def append(self, events):
+        """write one batch, return its sequence number"""
+        seq = self.last_seq()+1
+        arrays = Data_util.frame_to_arrays(events, "events")
+        arrays["columns"] = np.array(list(events.columns), dtype=str)
+        tmp_path = self.batch_path(seq)+".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.batch_path(seq))
+        return seq
+
+    def batches(self, after=0):
+        """(seq, events) of every batch after seq after, in order"""
+        for path in sorted(glob(os.path.join(self.path, "batch-*.npz"))):
+            seq = int(os.path.basename(path)[6:-4])
+            if seq <= after:
+                continue
+            with np.load(path) as arrays:
+                columns = arrays["columns"].tolist()
+                yield seq, Data_util.frame_from_arrays(arrays, "events", columns)
+
+    def write_snapshot(self, seq, data_key):
+        tmp_path = os.path.join(self.path, "snapshot.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"seq": seq, "data_key": data_key}, f)
+        os.replace(tmp_path, os.path.join(self.path, "snapshot.json"))
+
+    def read_snapshot(self):
+        """{"seq", "data_key"} of the last snapshot, None if none"""
+        try:
+            with open(os.path.join(self.path, "snapshot.json")) as f:
+                return json.load(f)
+        except OSError:
+            return None
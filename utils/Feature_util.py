@@ -1,12 +1,19 @@
 import time
+import copy
+import numpy as np
 import pandas as pd
 import tensorflow as tf
 from datetime import datetime
 from tensorflow.keras import layers
 from itertools import islice
 from .Data_util import Data_util
+from .Cache import Cache
+from .Instrument import Instrument
+from base.Model import Model
 
 EMBEDDING_DIM = 200
+# bumped when encode_user_item_info changes, older stores are encoded again
+FEATURE_STORE_VERSION = 2
 
 class Feature_util:
     data_map = {
@@ -23,16 +30,11 @@ class Feature_util:
                                "musical", "mystery", "romance", "sci", "thrill", "war", "western"],
             # input user and item values order for test data
             "user_info_seq": ["visitorid", "age", "zip_code", "gender", "occupation"],
-            "item_info_seq": ["itemid", "release_date", "unknown", "action", "adventure",
-                              "animation", "child", "comedy", "crime", "docu", "drama",
-                              "fantasy", "noir", "horror", "musical", "mystery", "romance",
-                              "sci", "thrill", "war", "western"],
+            # category_set is the code of the combination of the 19 categories
+            "item_info_seq": ["itemid", "release_date", "category_set"],
             # input values order for train data
             "input_values_seq": ["visitorid", "age", "zip_code", "gender", "occupation",
-                                  "itemid", "release_date", "unknown", "action", "adventure",
-                                  "animation", "child", "comedy", "crime", "docu", "drama",
-                                  "fantasy", "noir", "horror", "musical", "mystery", "romance",
-                                  "sci", "thrill", "war", "western", "event"],
+                                  "itemid", "release_date", "category_set", "event"],
             "feature_columns": {"visitorid": None, "age":None, "zip_code":None, "gender": None,
                                 "occupation": None, "gender_x_occupation":None, "itemid": None,
                                 "release_date": None, "cate_x_cate": None}
@@ -41,6 +43,17 @@ class Feature_util:
 
     def __init__(self, data_type):
         self.data_type = data_type
+        # per instance, synthetic entries and built feature columns
+        # are not shared with other instances
+        self.data_map = copy.deepcopy(self.data_map)
+        if data_type.startswith("Synthetic_"):
+            # synthetic side info files follow the MovieLens_100K layout
+            Data_util(data_type)
+            folder = "data/{}/".format(data_type)
+            self.data_map[data_type] = dict(self.data_map["MovieLens_100K"],
+                                            user_info=folder+"u.user",
+                                            item_info=folder+"u.item",
+                                            event_data=folder+"ratings.dat")
 
     def read_info_file(self, info_type):
         info_path = self.data_map[self.data_type][info_type+"_info"]
@@ -53,23 +66,112 @@ class Feature_util:
             lines = [Data_util.parse_line(line, sep) for line in islice(f, None)]
         return pd.DataFrame(lines, columns=columns)
    
-    def read_user_item_info(self):
+    def feature_store_key(self):
+        """key of the encoded side info, hashes the content of the user
+           and item info files and the encoding version
+        """
+        return Cache.key(
+            Cache.fingerprint_file(self.data_map[self.data_type]["user_info"]),
+            Cache.fingerprint_file(self.data_map[self.data_type]["item_info"]),
+            self.data_type, FEATURE_STORE_VERSION)
+
+    def feature_store_path(self):
+        """cache entry of the encoded side info"""
+        cache = Cache(Model.saved_models_dir)
+        return cache, cache.path("feature_store", self.feature_store_key())
+
+    @Instrument.staged("encode_side_info")
+    def encode_user_item_info(self):
+        """parse the info files once into typed arrays: categories are
+           int32 codes into persisted vocabularies, release dates are
+           normalized timestamps (missing ones at the mean), the 19
+           0/1 categories of an item are packed into one uint32 mask and
+           every distinct mask gets an int32 category_set code
+
+        Returns
+        -------
+        [tuple]
+            [(arrays, meta), see read_feature_store]
+        """
         users_info = self.read_info_file("user")
         items_info = self.read_info_file("item")
-        # convert data type
-        users_info["age"] = users_info["age"].apply(lambda x : int(x))
-        users_info["visitorid"] = users_info["visitorid"].apply(lambda x : int(x))
-        items_info["itemid"] = items_info["itemid"].apply(lambda x : int(x))
-        # release time to timestamp normalized
-        items_info.loc[:, "release_date"] = items_info["release_date"].apply(Feature_util.datetime_parser)
-        # repalce except value with average timestamp
-        avg_timestamp = items_info["release_date"].mean(skipna=True)
-        items_info.loc[pd.isnull(items_info["release_date"]), "release_date"] = avg_timestamp
-        assert sum(pd.isnull(items_info["release_date"])) == 0
-        # normalize timestamp
-        std_timestamp = items_info["release_date"].std()
-        items_info.loc[:, "release_date"] = (items_info["release_date"]-avg_timestamp)/std_timestamp
-        return users_info, items_info
+        arrays, meta = {}, {"vocabularies": [], "categories": self.categories()}
+        arrays["users_visitorid"] = users_info["visitorid"].to_numpy(dtype=np.int32)
+        arrays["users_age"] = users_info["age"].to_numpy(dtype=np.int32)
+        for col in ["gender", "occupation", "zip_code"]:
+            codes, vocabulary = pd.factorize(users_info[col])
+            arrays["users_"+col] = codes.astype(np.int32)
+            arrays["vocab_"+col] = vocabulary.to_numpy(dtype=str)
+            meta["vocabularies"].append(col)
+        arrays["items_itemid"] = items_info["itemid"].to_numpy(dtype=np.int32)
+        # release time to timestamp, vectorized instead of datetime_parser per row
+        release_date = pd.to_datetime(items_info["release_date"], format="%d-%b-%Y", errors="coerce")
+        timestamp = (release_date - pd.Timestamp(0)).dt.total_seconds()
+        # repalce except value with average timestamp, then normalize
+        avg_timestamp, std_timestamp = timestamp.mean(skipna=True), timestamp.std()
+        timestamp = timestamp.fillna(avg_timestamp)
+        arrays["items_release_date"] = ((timestamp-avg_timestamp)/std_timestamp).to_numpy(np.float64)
+        flags = items_info[meta["categories"]].to_numpy(dtype=np.uint32)
+        arrays["items_categories"] = (flags << np.arange(len(meta["categories"]), dtype=np.uint32)).sum(axis=1, dtype=np.uint32)  # noqa
+        # codes of the full cross of the categories, only the combinations
+        # seen are kept instead of the 2^19 possible ones
+        codes, vocabulary = pd.factorize(arrays["items_categories"])
+        arrays["items_category_set"] = codes.astype(np.int32)
+        arrays["vocab_category_set"] = vocabulary.astype(np.uint32)
+        return arrays, meta
+
+    def read_feature_store(self):
+        """encoded users and items side info, memory mapped from the
+           cache, encoded again only when the info files change
+
+        Returns
+        -------
+        [tuple]
+            [(arrays, meta), arrays "users_<col>", "items_<col>" and
+             "vocab_<col>", meta lists the vocabularies and categories]
+        """
+        cache, path = self.feature_store_path()
+        try:
+            return cache.read(path)
+        except OSError:
+            pass
+        cache.write(path, *self.encode_user_item_info())
+        return cache.read(path)
+
+    def categories(self):
+        """names of the 0/1 item categories, bit i of the mask is
+           categories[i]
+        """
+        return self.data_map[self.data_type]["item_col_names"][5:]
+
+    def vocabulary(self, col):
+        """persisted vocabulary of a categorical column"""
+        arrays, _ = self.read_feature_store()
+        return arrays["vocab_"+col].tolist()
+
+    def read_feature_tables(self):
+        """users and items model inputs, the arrays of the feature
+           store as they are (memory mapped, nothing decoded): ids are
+           replaced by their row number, categorical columns are their
+           vocabulary codes; codes of existing rows are kept as long as
+           the info files are only appended to
+
+        Returns
+        -------
+        [tuple]
+            [(users_id, users_table, items_id, items_table), ids of the
+             rows and {input name: array} in user_info_seq and
+             item_info_seq order]
+        """
+        arrays, _ = self.read_feature_store()
+        tables = []
+        for prefix, id_col in (("users", "visitorid"), ("items", "itemid")):
+            ids = arrays["{}_{}".format(prefix, id_col)]
+            table = {id_col: np.arange(len(ids), dtype=np.int32)}
+            for col in self.data_map[self.data_type][prefix[:-1]+"_info_seq"][1:]:
+                table[col] = arrays["{}_{}".format(prefix, col)]
+            tables += [ids, table]
+        return tuple(tables)
 
     # A utility method to show transromation from feature column
     @staticmethod
@@ -82,20 +184,25 @@ class Feature_util:
         print("feature dimension: ", len(column_values[0]))
         print(column_values)
 
-    def create_movie_lens_user_feature_columns(self, samples):
+    @staticmethod
+    def identity_column(key, n_codes):
+        """categorical column of the codes 0..n_codes-1 of the feature
+           store, codes beyond (users, items or values added to the
+           info files after the model was built) share one last bucket
+        """
+        return tf.feature_column.categorical_column_with_identity(key, n_codes+1,
+                                                                  default_value=n_codes)
+
+    def create_movie_lens_user_feature_columns(self):
         feature_columns = self.data_map["MovieLens_100K"]["feature_columns"]
-        # dict type of data
-        samples_dict = samples.to_dict("list")
-        # vocabulary lists
-        gender_list = list(pd.unique(samples["gender"]))
-        occupation_list = list(pd.unique(samples["occupation"]))
-        # number of categories of each column
-        n_occupation = len(pd.unique(samples["occupation"]))
-        n_gender = len(pd.unique(samples["gender"]))
-        n_users = len(pd.unique(samples["visitorid"]))
-        n_zip_code = len(pd.unique(samples["zip_code"]))
+        # number of codes of each column, persisted by the feature store
+        arrays, _ = self.read_feature_store()
+        n_users = len(arrays["users_visitorid"])
+        n_zip_code = len(arrays["vocab_zip_code"])
+        n_gender = len(arrays["vocab_gender"])
+        n_occupation = len(arrays["vocab_occupation"])
         # visitorid -> embedding for deep model
-        fc_visitorid = tf.feature_column.categorical_column_with_hash_bucket("visitorid", n_users+1, dtype=tf.int32)
+        fc_visitorid = self.identity_column("visitorid", n_users)
         fc_visitorid = tf.feature_column.embedding_column(fc_visitorid, dimension=EMBEDDING_DIM)
         feature_columns["visitorid"] = fc_visitorid
         # age -> numeric for deep model
@@ -103,23 +210,21 @@ class Feature_util:
         fc_age = tf.feature_column.numeric_column("age")
         feature_columns["age"] = fc_age
         # zip_code -> embedding for deep model
-        fc_zip_code = tf.feature_column.categorical_column_with_hash_bucket("zip_code", n_zip_code+1)
+        fc_zip_code = self.identity_column("zip_code", n_zip_code)
         fc_zip_code = tf.feature_column.embedding_column(fc_zip_code, dimension=EMBEDDING_DIM)
         feature_columns["zip_code"] = fc_zip_code
         # gender -> one hot for deep model
-        fc_gender = tf.feature_column.categorical_column_with_vocabulary_list("gender", 
-                                                                              vocabulary_list=gender_list)
-        fc_gender = tf.feature_column.indicator_column(fc_gender)
+        fc_gender_codes = self.identity_column("gender", n_gender)
+        fc_gender = tf.feature_column.indicator_column(fc_gender_codes)
         feature_columns["gender"] = fc_gender
         # occupation -> embedding for deep model
-        fc_occupation = tf.feature_column.categorical_column_with_vocabulary_list("occupation",
-                                                                                  vocabulary_list=occupation_list)
-        fc_occupation = tf.feature_column.embedding_column(fc_occupation, dimension=EMBEDDING_DIM)
+        fc_occupation_codes = self.identity_column("occupation", n_occupation)
+        fc_occupation = tf.feature_column.embedding_column(fc_occupation_codes, dimension=EMBEDDING_DIM)
         feature_columns["occupation"] = fc_occupation
         # gender_x_occupation(crossed feature) -> one hot (full cross, really wide) for wide model
-        fc_gender_x_occupation = tf.feature_column.crossed_column(["gender",
-                                                                   "occupation"],
-                                                                  n_occupation*n_gender+1)
+        fc_gender_x_occupation = tf.feature_column.crossed_column([fc_gender_codes,
+                                                                   fc_occupation_codes],
+                                                                  (n_occupation+1)*(n_gender+1))
         fc_gender_x_occupation = tf.feature_column.indicator_column(fc_gender_x_occupation)
         feature_columns["gender_x_occupation"] = fc_gender_x_occupation
     
@@ -132,26 +237,22 @@ class Feature_util:
             print("Wrong datetime value: {}, return na".format(value))
             return None
     
-    def create_movie_lens_item_feature_columns(self, samples):
+    def create_movie_lens_item_feature_columns(self):
         feature_columns = self.data_map["MovieLens_100K"]["feature_columns"]
-        # dict type of data
-        samples_dict = samples.to_dict("list")
-        # vocabulary lists
-        # number of categories of each column
-        n_items = len(pd.unique(samples["itemid"]))
+        # number of codes of each column, persisted by the feature store
+        arrays, _ = self.read_feature_store()
+        n_items = len(arrays["items_itemid"])
+        n_category_set = len(arrays["vocab_category_set"])
         # item_id -> embedding for deep model
-        fc_itemid = tf.feature_column.categorical_column_with_hash_bucket("itemid", n_items+1, dtype=tf.int32)
+        fc_itemid = self.identity_column("itemid", n_items)
         fc_itemid = tf.feature_column.embedding_column(fc_itemid, dimension=EMBEDDING_DIM)
         feature_columns["itemid"] = fc_itemid
         # release_date -> numeric
         fc_release_date = tf.feature_column.numeric_column("release_date")
         feature_columns["release_date"] = fc_release_date
-        # categories -> crossed, allow some hash conflicts, for wide model
-        # TODO: user raw 0/1 categories as input feature vector?
-        fc_cate_x_cate = tf.feature_column.crossed_column(['unknown', 'action', 'adventure', 'animation', 'child', 'comedy',
-                                                           'crime', 'docu', 'drama', 'fantasy', 'noir', 'horror', 'musical',
-                                                           'mystery', 'romance', 'sci', 'thrill', 'war', 'western'],
-                                                           1500)
+        # categories -> one hot of the category_set code, the full cross of
+        # the 19 categories over the combinations seen, for wide model
+        fc_cate_x_cate = self.identity_column("category_set", n_category_set)
         fc_cate_x_cate = tf.feature_column.indicator_column(fc_cate_x_cate)
         feature_columns["cate_x_cate"] = fc_cate_x_cate
     
@@ -160,33 +261,16 @@ class Feature_util:
         # key must correspond to the key in feature columns,
         # data type should identity with feature columns
         # input orders remains in the dict, should be same as the input row's values
+        # categorical inputs are the int codes of the feature store
         # user input
-        input_layer["visitorid"] = tf.keras.Input(shape=(1,), name="visitorid", dtype=tf.int32)
-        input_layer["age"] = tf.keras.Input(shape=(1,), name="age", dtype=tf.int32)
-        input_layer["zip_code"] = tf.keras.Input(shape=(1,), name="zip_code", dtype=tf.string)
-        input_layer["gender"] = tf.keras.Input(shape=(1,), name="gender", dtype=tf.string)
-        input_layer["occupation"] = tf.keras.Input(shape=(1,), name="occupation", dtype=tf.string)
+        input_layer["visitorid"] = tf.keras.Input(shape=(1,), name="visitorid", dtype=tf.int64)
+        input_layer["age"] = tf.keras.Input(shape=(1,), name="age", dtype=tf.int64)
+        input_layer["zip_code"] = tf.keras.Input(shape=(1,), name="zip_code", dtype=tf.int64)
+        input_layer["gender"] = tf.keras.Input(shape=(1,), name="gender", dtype=tf.int64)
+        input_layer["occupation"] = tf.keras.Input(shape=(1,), name="occupation", dtype=tf.int64)
         # item input
-        input_layer["itemid"] = tf.keras.Input(shape=(1,), name="itemid", dtype=tf.int32)
+        input_layer["itemid"] = tf.keras.Input(shape=(1,), name="itemid", dtype=tf.int64)
         input_layer["release_date"] = tf.keras.Input(shape=(1,), name="release_date", dtype=tf.float64)
-        input_layer["unknown"] = tf.keras.Input(shape=(1,), name="unknown", dtype=tf.string)
-        input_layer["action"] = tf.keras.Input(shape=(1,), name="action", dtype=tf.string)
-        input_layer["adventure"] = tf.keras.Input(shape=(1,), name="adventure", dtype=tf.string)
-        input_layer["animation"] = tf.keras.Input(shape=(1,), name="animation", dtype=tf.string)
-        input_layer["child"] = tf.keras.Input(shape=(1,), name="child", dtype=tf.string)
-        input_layer["comedy"] = tf.keras.Input(shape=(1,), name="comedy", dtype=tf.string)
-        input_layer["crime"] = tf.keras.Input(shape=(1,), name="crime", dtype=tf.string)
-        input_layer["docu"] = tf.keras.Input(shape=(1,), name="docu", dtype=tf.string)
-        input_layer["drama"] = tf.keras.Input(shape=(1,), name="drama", dtype=tf.string)
-        input_layer["fantasy"] = tf.keras.Input(shape=(1,), name="fantasy", dtype=tf.string)
-        input_layer["noir"] = tf.keras.Input(shape=(1,), name="noir", dtype=tf.string)
-        input_layer["horror"] = tf.keras.Input(shape=(1,), name="horror", dtype=tf.string)
-        input_layer["musical"] = tf.keras.Input(shape=(1,), name="musical", dtype=tf.string)
-        input_layer["mystery"] = tf.keras.Input(shape=(1,), name="mystery", dtype=tf.string)
-        input_layer["romance"] = tf.keras.Input(shape=(1,), name="romance", dtype=tf.string)
-        input_layer["sci"] = tf.keras.Input(shape=(1,), name="sci", dtype=tf.string)
-        input_layer["thrill"] = tf.keras.Input(shape=(1,), name="thrill", dtype=tf.string)
-        input_layer["war"] = tf.keras.Input(shape=(1,), name="war", dtype=tf.string)
-        input_layer["western"] = tf.keras.Input(shape=(1,), name="western", dtype=tf.string)
+        input_layer["category_set"] = tf.keras.Input(shape=(1,), name="category_set", dtype=tf.int64)
         assert list(input_layer.keys()) == self.data_map["MovieLens_100K"]["input_values_seq"][:-1]
         return input_layer
\ No newline at end of file
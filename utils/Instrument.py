@@ -0,0 +1,248 @@
+import os
+import re
+import json
+import time
+import resource
+import tracemalloc
+from functools import wraps
+
+
+class Stage_timer:
+    """context manager timing one (possibly nested) stage"""
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        Instrument.stack.append(self.name)
+        self.path = "/".join(Instrument.stack)
+        self.child_peak = 0
+        if Instrument.track_memory:
+            parent = Instrument.frames[-1] if Instrument.frames else None
+            if parent is not None:
+                # keep the parent's peak before measuring this stage alone
+                parent.child_peak = max(parent.child_peak, tracemalloc.get_traced_memory()[1])  # noqa
+            tracemalloc.reset_peak()
+        Instrument.frames.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter()-self.start
+        Instrument.frames.pop()
+        Instrument.stack.pop()
+        stage = Instrument.stages.setdefault(self.path, {"count": 0, "total": 0.0, "max": 0.0})
+        stage["count"] += 1
+        stage["total"] += elapsed
+        stage["max"] = max(stage["max"], elapsed)
+        if Instrument.track_memory:
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            stage["traced_peak_bytes"] = max(stage.get("traced_peak_bytes", 0), peak)
+            stage["rss_bytes"] = Instrument.rss()
+            if Instrument.frames:
+                parent = Instrument.frames[-1]
+                parent.child_peak = max(parent.child_peak, peak)
+        return False
+
+
+class Null_stage:
+    """shared no-op stage used while instrumentation is off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Instrument:
+    """process wide stage timers, counters and histograms
+
+       off by default, every call then returns right after one flag
+       check, turn on with Instrument.enable() or the environment
+       variable RECSYS_INSTRUMENT=1 (=memory to also track memory)
+
+       stages nest, a stage named "build_sim" inside "fit" is
+       reported as "fit/build_sim"
+    """
+    enabled = False
+    track_memory = False
+    stack = []
+    frames = []
+    stages = {}
+    counters = {}
+    histograms = {}
+    null_stage = Null_stage()
+    # histogram bucket upper bounds, latencies in seconds and sizes
+    latency_buckets = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                       0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    size_buckets = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+    @classmethod
+    def enable(cls, track_memory=False):
+        cls.enabled = True
+        cls.track_memory = track_memory
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @classmethod
+    def disable(cls):
+        cls.enabled = False
+        if cls.track_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        cls.track_memory = False
+
+    @classmethod
+    def reset(cls):
+        cls.stages, cls.counters, cls.histograms = {}, {}, {}
+
+    @classmethod
+    def stage(cls, name):
+        # a subclass method calling its base class stage is one stage
+        if not cls.enabled or (cls.stack and cls.stack[-1] == name):
+            return cls.null_stage
+        return Stage_timer(name)
+
+    @classmethod
+    def staged(cls, name):
+        """decorator running the whole method as a stage"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with cls.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    @classmethod
+    def count(cls, name, value=1, **labels):
+        if not cls.enabled:
+            return
+        key = cls.key(name, labels)
+        cls.counters[key] = cls.counters.get(key, 0)+value
+
+    @classmethod
+    def observe(cls, name, value, bounds=None, **labels):
+        """add one observation to a histogram, bounds default to
+           latency_buckets and are fixed by the first observation
+        """
+        if not cls.enabled:
+            return
+        key = cls.key(name, labels)
+        try:
+            histogram = cls.histograms[key]
+        except KeyError:
+            bounds = list(bounds or cls.latency_buckets)
+            histogram = cls.histograms[key] = {"bounds": bounds,
+                                               "buckets": [0]*len(bounds),
+                                               "count": 0, "sum": 0.0, "max": 0.0}
+        for i, bound in enumerate(histogram["bounds"]):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+                break
+        histogram["count"] += 1
+        histogram["sum"] += value
+        histogram["max"] = max(histogram["max"], value)
+
+    @classmethod
+    def timed(cls, name):
+        """decorator for model methods, the latency of every call is
+           observed in histogram name labelled by the model type
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(self, *args, **kwargs):
+                if not cls.enabled:
+                    return func(self, *args, **kwargs)
+                start = time.perf_counter()
+                result = func(self, *args, **kwargs)
+                cls.observe(name, time.perf_counter()-start, model=self.model_type)
+                return result
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def rss():
+        """current resident set size in bytes, peak RSS if unknown"""
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+    @classmethod
+    def to_dict(cls):
+        def flat(key):
+            name, labels = key
+            return {"name": name, "labels": dict(labels)}
+        return {"stages": cls.stages,
+                "counters": [dict(flat(k), value=v) for k, v in cls.counters.items()],
+                "histograms": [dict(flat(k), **v) for k, v in cls.histograms.items()]}
+
+    @classmethod
+    def to_json(cls, path=None):
+        text = json.dumps(cls.to_dict(), indent=2)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+    @staticmethod
+    def metric_name(name):
+        return "recsys_"+re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+    @staticmethod
+    def label_text(labels, **extra):
+        labels = dict(labels, **extra)
+        if not labels:
+            return ""
+        return "{"+",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))+"}"
+
+    @classmethod
+    def to_prometheus(cls, path=None):
+        """prometheus text exposition format"""
+        lines = []
+        if cls.stages:
+            lines.append("# TYPE recsys_stage_seconds summary")
+        for path_name, stage in cls.stages.items():
+            labels = cls.label_text({}, stage=path_name)
+            lines.append("recsys_stage_seconds_sum{} {}".format(labels, stage["total"]))
+            lines.append("recsys_stage_seconds_count{} {}".format(labels, stage["count"]))
+        # memory gauges, one family after the other
+        for field in ("traced_peak_bytes", "rss_bytes"):
+            metric = "recsys_stage_"+field
+            stages = [(path_name, stage) for path_name, stage in cls.stages.items() if field in stage]
+            if stages:
+                lines.append("# TYPE {} gauge".format(metric))
+            for path_name, stage in stages:
+                lines.append("{}{} {}".format(metric, cls.label_text({}, stage=path_name), stage[field]))
+        typed = set()
+        for (name, labels), value in sorted(cls.counters.items()):
+            metric = cls.metric_name(name)+"_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append("# TYPE {} counter".format(metric))
+            lines.append("{}{} {}".format(metric, cls.label_text(labels), value))
+        for (name, labels), histogram in sorted(cls.histograms.items()):
+            metric = cls.metric_name(name)
+            if metric not in typed:
+                typed.add(metric)
+                lines.append("# TYPE {} histogram".format(metric))
+            cumulative = 0
+            for bound, n in zip(histogram["bounds"], histogram["buckets"]):
+                cumulative += n
+                lines.append("{}_bucket{} {}".format(metric, cls.label_text(labels, le=bound), cumulative))  # noqa
+            lines.append("{}_bucket{} {}".format(metric, cls.label_text(labels, le="+Inf"), histogram["count"]))  # noqa
+            lines.append("{}_sum{} {}".format(metric, cls.label_text(labels), histogram["sum"]))
+            lines.append("{}_count{} {}".format(metric, cls.label_text(labels), histogram["count"]))
+        text = "\n".join(lines)+"\n"
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+
+if os.environ.get("RECSYS_INSTRUMENT"):
+    Instrument.enable(track_memory=os.environ["RECSYS_INSTRUMENT"] == "memory")
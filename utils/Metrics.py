@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+
+class Metrics:
+    """vectorized top-n metrics computed from a rank-hit matrix
+
+       hits[u, r] is True when the item ranked at position r (0 based)
+       for user u is in the user's real items, so the metrics at
+       every cutoff 1..max_n come from cumulative sums over the columns
+    """
+    @staticmethod
+    def user_metrics(hits, n_real, n_reco, n_items):
+        """
+        Parameters
+        ----------
+        hits : [np.ndarray]
+            [bool matrix of shape (n_users, max_n)]
+        n_real : [np.ndarray]
+            [number of real items of each user]
+        n_reco : [np.ndarray]
+            [length of each user's ranked list, <= max_n]
+        n_items : [int]
+            [number of items in the training set]
+
+        Returns
+        -------
+        [dict]
+            [metric name -> matrix of shape (n_users, max_n), the
+             metric of every user at every cutoff]
+        """
+        n_users, max_n = hits.shape
+        hits = hits.astype(np.float64)
+        n_real = np.asarray(n_real, dtype=np.float64)[:, None]
+        n_reco = np.asarray(n_reco, dtype=np.float64)[:, None]
+        cutoffs = np.arange(1, max_n+1, dtype=np.float64)[None, :]
+        n_TP = np.cumsum(hits, axis=1)
+        # a model may return less than n items for some users
+        n_reco_at_k = np.minimum(cutoffs, n_reco)
+        recall = n_TP/n_real
+        precision = np.divide(n_TP, n_reco_at_k,
+                              out=np.zeros_like(n_TP), where=n_reco_at_k > 0)
+        fallout = (n_reco_at_k-n_TP)/(n_items-n_real)
+        hit_rate = (n_TP > 0).astype(np.float64)
+        # discounted cumulative gain against the ideal ranking
+        discount = 1/np.log2(np.arange(2, max_n+2))
+        dcg = np.cumsum(hits*discount, axis=1)
+        ideal_dcg = np.cumsum(discount)
+        n_ideal = np.minimum(cutoffs, n_real).astype(np.int64)
+        ndcg = dcg/ideal_dcg[n_ideal-1]
+        # average precision, normalized by min(n, n_real)
+        precision_at_hit = np.cumsum(hits*n_TP/cutoffs, axis=1)
+        ap = precision_at_hit/np.minimum(cutoffs, n_real)
+        # reciprocal rank of the first hit
+        first_hit = np.where(hits.any(axis=1), hits.argmax(axis=1)+1, max_n+1)
+        rr = np.where(first_hit[:, None] <= cutoffs, 1/first_hit[:, None], 0.)
+        return {"recall": recall, "precision": precision, "fallout": fallout,
+                "ndcg": ndcg, "map": ap, "mrr": rr, "hit_rate": hit_rate}
+
+    @staticmethod
+    def rank_hit_metrics(hits, n_real, n_reco, n_items):
+        """metrics of user_metrics averaged over users
+
+        Returns
+        -------
+        [pd.DataFrame]
+            [metrics averaged over users, indexed by cutoff n]
+        """
+        metrics = Metrics.user_metrics(hits, n_real, n_reco, n_items)
+        return pd.DataFrame({name: values.mean(axis=0) for name, values in metrics.items()},
+                            index=pd.Index(np.arange(1, hits.shape[1]+1), name="n"))
+
+    @staticmethod
+    def partial_auc(fallout, recall):
+        """area under the partial ROC curve by the trapezoidal rule"""
+        x, y = np.asarray(fallout), np.asarray(recall)
+        return float(np.sum((x[1:]-x[:-1])*(y[1:]+y[:-1])/2))
+
+    @staticmethod
+    def stratified_bootstrap(values, weights, n_bootstrap=1000, confidence=0.95, rng=None):
+        """stratified mean of per user values with a bootstrap
+           confidence interval, users are resampled within their stratum
+
+        Parameters
+        ----------
+        values : [list of np.ndarray]
+            [per stratum matrix (n_users_in_stratum, n_metrics)]
+        weights : [np.ndarray]
+            [share of every stratum in the population]
+
+        Returns
+        -------
+        [tuple]
+            [(estimate, low, high) arrays of length n_metrics]
+        """
+        rng = rng or np.random.default_rng()
+        kept = [i for i, stratum in enumerate(values) if len(stratum)]
+        weights = np.asarray(weights, dtype=np.float64)[kept]
+        weights = weights/weights.sum()
+        estimate = sum(weight*values[i].mean(axis=0) for weight, i in zip(weights, kept))
+        resampled = sum(weight*values[i][rng.integers(0, len(values[i]), (n_bootstrap, len(values[i])))].mean(axis=1)  # noqa
+                        for weight, i in zip(weights, kept))
+        low, high = np.percentile(resampled, [50*(1-confidence), 50*(1+confidence)], axis=0)
+        return estimate, low, high
@@ -0,0 +1,98 @@
+import numpy as np
+import keras
+
+
+class Negative_sequence(keras.utils.Sequence):
+    """LFM training batches with negative samples drawn on the fly
+
+       every batch holds batch_size positive (user, item) pairs and
+       neg_frac negatives per positive, negatives are drawn fresh for
+       every batch of every epoch with probability popularity**power,
+       items touched by the user are drawn again, memory stays
+       O(positives) whatever neg_frac, and batches can be built by
+       parallel workers while the model trains on previous ones
+    """
+    def __init__(self, users_id, items_id, indptr, indices, neg_frac,
+                 batch_size=256, power=0.75, max_rounds=3, seed=100, touched=None,
+                 workers=1, use_multiprocessing=False, max_queue_size=10):
+        """
+        Parameters
+        ----------
+        users_id, items_id, indptr, indices : [np array]
+            [users x items CSR of the positives, see Model.user_item_csr]
+        neg_frac : [int]
+            [negative samples per positive]
+        batch_size : [int]
+            [positives per batch]
+        power : [float]
+            [negatives are drawn proportionally to popularity**power]
+        max_rounds : [int]
+            [draws of negatives hitting a touched item, the ones still
+             touched after them are dropped]
+        touched : [tuple]
+            [(indptr, indices) of all touched items over the same users
+             and items when the positives are only part of them, e.g.
+             warm start updates, default the positives]
+        workers, use_multiprocessing, max_queue_size : [int, bool, int]
+            [parallel batch building by keras, see keras.utils.PyDataset]
+        """
+        super().__init__(workers=workers, use_multiprocessing=use_multiprocessing,
+                         max_queue_size=max_queue_size)
+        self.users_id = np.asarray(users_id)
+        self.items_id = np.asarray(items_id)
+        self.n_items = len(self.items_id)
+        self.neg_frac = int(neg_frac)
+        self.batch_size = batch_size
+        self.max_rounds = max_rounds
+        self.seed = seed
+        # positives as (user row, item position), and their sorted keys
+        # for touched lookups
+        self.user_rows = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+        self.item_pos = np.asarray(indices)
+        touched_indptr, touched_indices = touched or (indptr, indices)
+        touched_rows = np.repeat(np.arange(len(touched_indptr)-1), np.diff(touched_indptr))
+        self.touched = np.sort(touched_rows.astype(np.int64)*self.n_items+np.asarray(touched_indices))
+        popularity = np.bincount(touched_indices, minlength=self.n_items).astype(np.float64)
+        probs = popularity**power
+        self.cum_probs = np.cumsum(probs/probs.sum())
+        self.epoch = 0
+        self.order = np.random.default_rng(seed).permutation(len(self.item_pos))
+
+    def __len__(self):
+        return int(np.ceil(len(self.item_pos)/self.batch_size))
+
+    def is_touched(self, user_rows, item_pos):
+        keys = user_rows.astype(np.int64)*self.n_items+item_pos
+        found = np.searchsorted(self.touched, keys)
+        found[found == len(self.touched)] = 0
+        return self.touched[found] == keys
+
+    def draw_items(self, size, rng):
+        item_pos = np.searchsorted(self.cum_probs, rng.random(size))
+        return np.minimum(item_pos, self.n_items-1)
+
+    def __getitem__(self, index):
+        # seeded by (epoch, batch) so that batches do not depend on
+        # the order in which workers build them
+        rng = np.random.default_rng((self.seed, self.epoch, index))
+        positives = self.order[index*self.batch_size:(index+1)*self.batch_size]
+        neg_user_rows = np.repeat(self.user_rows[positives], self.neg_frac)
+        neg_item_pos = self.draw_items(len(neg_user_rows), rng)
+        touched = self.is_touched(neg_user_rows, neg_item_pos)
+        for _ in range(self.max_rounds):
+            if not touched.any():
+                break
+            neg_item_pos[touched] = self.draw_items(touched.sum(), rng)
+            touched[touched] = self.is_touched(neg_user_rows[touched], neg_item_pos[touched])
+        neg_user_rows, neg_item_pos = neg_user_rows[~touched], neg_item_pos[~touched]
+        user_rows = np.r_[self.user_rows[positives], neg_user_rows]
+        item_pos = np.r_[self.item_pos[positives], neg_item_pos]
+        labels = np.r_[np.ones(len(positives)), np.zeros(len(neg_item_pos))].astype(np.float32)
+        # LFM model inputs are [item, user]
+        itemid = self.items_id[item_pos].reshape(-1, 1)
+        visitorid = self.users_id[user_rows].reshape(-1, 1)
+        return (itemid, visitorid), labels.reshape(-1, 1)
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.order = np.random.default_rng((self.seed, self.epoch)).permutation(len(self.item_pos))
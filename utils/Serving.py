@@ -0,0 +1,82 @@
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tensorflow as tf
+
+
+class Serving:
+    """compiled inference for the keras models
+
+       a model is exported as a SavedModel with one traced tf.function
+       signature, serving calls the signature directly instead of
+       keras' general predict loop, the samples of one request are
+       split in one batch per core and the batches run in parallel
+    """
+    signature_name = "serving_default"
+    min_batch_size = 256
+    max_batch_size = 8192
+    n_threads = os.cpu_count() or 1
+    pool = None
+
+    @staticmethod
+    def export(module, path):
+        """module is a tf.Module whose serve method is a tf.function
+           with a fixed input_signature, returning {"score": [None]}
+        """
+        tf.saved_model.save(module, path, signatures={Serving.signature_name: module.serve})
+
+    @staticmethod
+    def load(path):
+        """the loaded module, keep a reference to it while serving"""
+        return tf.saved_model.load(path)
+
+    @staticmethod
+    def wrap(module):
+        """serve a module in memory like a loaded one, without export,
+           e.g. a serving shard's slice of the model
+        """
+        module.signatures = {Serving.signature_name: module.serve}
+        return module
+
+    @classmethod
+    def batch_size(cls, n_samples):
+        """one batch per core, within [min_batch_size, max_batch_size]"""
+        batch_size = math.ceil(n_samples/cls.n_threads)
+        return int(min(max(batch_size, cls.min_batch_size), cls.max_batch_size))
+
+    @classmethod
+    def predict(cls, module, batched_inputs, inputs=None):
+        """scores of all samples of one request
+
+        Parameters
+        ----------
+        module : [tf.Module]
+            [loaded by Serving.load]
+        batched_inputs : [dict]
+            [name -> np array, one value per sample, split in batches]
+        inputs : [dict]
+            [name -> value passed to every batch as it is]
+
+        Returns
+        -------
+        [np array]
+            [one score per sample]
+        """
+        signature = module.signatures[cls.signature_name]
+        inputs = {name: tf.constant(value) for name, value in (inputs or {}).items()}
+        n_samples = len(next(iter(batched_inputs.values())))
+        batch_size = cls.batch_size(n_samples)
+
+        def predict_batch(start):
+            batch = {name: tf.constant(values[start:start+batch_size])
+                     for name, values in batched_inputs.items()}
+            return signature(**batch, **inputs)["score"].numpy()
+        starts = range(0, n_samples, batch_size)
+        if len(starts) == 0:
+            return np.zeros(0, dtype=np.float32)
+        if len(starts) == 1:
+            return predict_batch(0)
+        if cls.pool is None:
+            cls.pool = ThreadPoolExecutor(cls.n_threads)
+        return np.concatenate(list(cls.pool.map(predict_batch, starts)))
@@ -0,0 +1,146 @@
+import os
+import heapq
+import contextlib
+import multiprocessing
+from itertools import islice
+import numpy as np
+
+
+def prepare_worker(model_type, data_type, model_kwargs):
+    """fits the model into the cache (or finds it there), returns its
+       shard spec and the sorted items id
+    """
+    from run_model import build
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        model, _ = build(model_type, data_type, **model_kwargs)
+    items_id = np.sort(np.fromiter(model.items, dtype=np.int64, count=len(model.items)))
+    return model.shard_spec(), items_id
+
+
+def shard_worker(conn, spec, items_id):
+    """worker process owning one shard of the items: loads its slice
+       of the saved model (Model.load_shard), then answers (users_id,
+       n) requests with the local top n of every user until it
+       receives None
+    """
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        spec.load_shard(items_id)
+        conn.send(len(items_id))
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            users_id, n = request
+            conn.send([Shard_serving.local_top(spec, user_id, items_id, n)
+                       for user_id in users_id])
+    conn.close()
+
+
+class Shard_serving:
+    """item sharded scatter-gather serving on local processes
+
+       the items are split into n_shards contiguous id ranges (see
+       assign), each owned by a worker process loading the item side
+       state of its items only from the cache; a request is scattered to every shard,
+       each returns its local top n (score, -item_id) best first, and
+       the lists are merged with a heap
+    """
+    def __init__(self, model_type, data_type, n_shards, **model_kwargs):
+        """
+        Parameters
+        ----------
+        model_type : [str]
+            [model name in models/Registry.py]
+        n_shards : [int]
+            [number of worker processes]
+        model_kwargs : [dict]
+            [run_model kwargs of the model]
+        """
+        self.model_type = model_type
+        self.data_type = data_type
+        self.n_shards = n_shards
+        self.model_kwargs = model_kwargs
+        self.name = "{}_{}_shards_{}".format(data_type, model_type, n_shards)
+        self.workers, self.conns = [], []
+
+    def start(self):
+        """fit (or find) the model in the cache in a first process,
+           then start the workers, each loads its slice only
+        """
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(1) as pool:
+            spec, items_id = pool.apply(prepare_worker, (self.model_type, self.data_type,
+                                                         self.model_kwargs))
+        for shard_items_id in self.assign(items_id, self.n_shards):
+            conn, worker_conn = context.Pipe()
+            worker = context.Process(target=shard_worker, daemon=True,
+                                     args=(worker_conn, spec, shard_items_id))
+            worker.start()
+            self.workers.append(worker)
+            self.conns.append(conn)
+        self.shard_sizes = [conn.recv() for conn in self.conns]
+        print("[{}] {} workers ready, items per shard: {}".format(
+            self.name, self.n_shards, self.shard_sizes))
+        return self
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers, self.conns = [], []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def assign(items_id, n_shards):
+        """sorted items id of every shard, the only item -> shard
+           assignment, models read exactly the items they are given
+        """
+        return np.array_split(np.sort(items_id), n_shards)
+
+    @staticmethod
+    def local_top(model, user_id, items_id, n):
+        """n best (score, -item_id) of items_id for one user, best
+           first, ties broken by item id so that rankings do not depend
+           on the number of shards, or a negative int when the user
+           cannot be scored
+        """
+        scores = model.score_items(user_id, items_id)
+        if isinstance(scores, int):
+            return scores
+        scored = np.flatnonzero(~np.isnan(scores))
+        if n < len(scored):
+            # every item tied with the n-th best competes for the last places
+            kth = -np.partition(-scores[scored], n-1)[n-1]
+            scored = scored[scores[scored] >= kth]
+        best = scored[np.lexsort((items_id[scored], -scores[scored]))][:n]
+        return list(zip(scores[best].tolist(), (-items_id[best]).tolist()))
+
+    @staticmethod
+    def merge(shard_tops, n):
+        """global top n items id of the shards local tops"""
+        shard_tops = [top for top in shard_tops if not isinstance(top, int)]
+        if not shard_tops:
+            return -1
+        merged = heapq.merge(*shard_tops, reverse=True)
+        return [-neg_item_id for _, neg_item_id in islice(merged, n)]
+
+    def make_rankings(self, users_id, n):
+        """ranked top n items id of every user, users are sent to the
+           shards as one batch, a negative int for users no shard can
+           score
+        """
+        users_id = list(users_id)
+        # scatter to every shard before gathering, shards work in parallel
+        for conn in self.conns:
+            conn.send((users_id, n))
+        shards_tops = [conn.recv() for conn in self.conns]
+        return [self.merge(shard_tops, n) for shard_tops in zip(*shards_tops)]
+
+    def make_ranking(self, user_id, n):
+        return self.make_rankings([user_id], n)[0]
@@ -0,0 +1,277 @@
+import os
+import numpy as np
+from scipy import sparse
+from base.Model import Model
+
+
+class Sim_build:
+    """similarity matrix builds of ItemCF and UserCF, their cost
+       estimated from the history degrees, and the planner picking one
+       within a memory and time budget before anything is built
+
+       the similarity of two members (items for ItemCF, users for
+       UserCF) sums a weight over the groups (users, items) holding
+       both, a group of degree d adds d*(d-1) ordered pairs, so the
+       work grows with sum(d**2) and a few heavy users or popular
+       items dominate it. Strategies:
+
+           dict: python dict of dicts updated pair by pair (the
+                 original build), float64 values
+           csr:  pairs generated by chunks with numpy (heavy groups
+                 split by rows) and summed into a sparse matrix,
+                 float32 or float64 values
+
+       both are saved the same way (rows sorted by decreasing float32
+       similarity), so they share the cached sim matrix
+    """
+    strategies = ("dict", "csr")
+    dtypes = ("float32", "float64")
+    # cost model, calibrated on MovieLens_100K with
+    # benchmarks/bench_sim_build.py
+    dict_entry_bytes = 112
+    dict_pair_seconds = 6e-7
+    csr_pair_bytes = 64
+    csr_pair_seconds = 9e-8
+    csr_entry_seconds = 2e-7
+    # pairs generated at once by the csr build
+    chunk_pairs = 2**20
+
+    def __init__(self, objects, attr):
+        """
+        Parameters
+        ----------
+        objects : [dict]
+            [groups, {id: object}, e.g. users for ItemCF]
+        attr : [str]
+            [members attribute of a group, {member_id: timestamp},
+             e.g. covered_items]
+        """
+        if hasattr(objects, "fields"):
+            # loaded histories are already CSR
+            indptr, members_id, times = objects.fields[attr]
+        else:
+            lengths = [len(getattr(obj, attr)) for obj in objects.values()]
+            indptr = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+            members_id = np.fromiter((member_id for obj in objects.values()
+                                      for member_id in getattr(obj, attr)),
+                                     dtype=np.int64, count=indptr[-1])
+            times = np.fromiter((time for obj in objects.values()
+                                 for time in getattr(obj, attr).values()),
+                                dtype=np.float64, count=indptr[-1])
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.members_id, self.members = np.unique(members_id, return_inverse=True)
+        self.times = np.asarray(times, dtype=np.float64)
+        self.degrees = np.diff(self.indptr)
+        self.stats = self.degree_stats()
+
+    def degree_stats(self):
+        """degree distribution, pair operations and sim matrix nnz"""
+        n_members = len(self.members_id)
+        degrees = self.degrees.astype(np.float64)
+        pairs = degrees*(degrees-1)
+        # co-members reached by every member, bounded by the members
+        reached = np.bincount(self.members, weights=np.repeat(degrees-1, self.degrees),
+                              minlength=n_members)
+        # distinct ones if they were drawn uniformly
+        others = max(n_members-1, 1)
+        return {"groups": len(self.degrees), "members": n_members,
+                "events": int(self.indptr[-1]),
+                "max_degree": int(degrees.max()) if len(degrees) else 0,
+                "p50_degree": float(np.percentile(degrees, 50)) if len(degrees) else 0.0,
+                "p99_degree": float(np.percentile(degrees, 99)) if len(degrees) else 0.0,
+                "sum_degree_squared": float((degrees**2).sum()),
+                "pair_ops": float(pairs.sum()),
+                "nnz_upper": float(np.minimum(reached, others).sum()),
+                "nnz": float((others*-np.expm1(-reached/others)).sum())}
+
+    def estimates(self):
+        """peak memory (bytes, on top of the histories) and seconds of
+           every strategy and dtype
+        """
+        stats = self.stats
+        pair_ops, nnz = stats["pair_ops"], stats["nnz"]
+        estimates = [{"strategy": "dict", "dtype": "float64",
+                      "peak_bytes": nnz*self.dict_entry_bytes,
+                      "seconds": pair_ops*self.dict_pair_seconds}]
+        # chunks split heavy groups by rows, down to one row of the
+        # heaviest group
+        chunk_pairs = min(pair_ops, max(self.chunk_pairs, stats["max_degree"]))
+        for dtype in self.dtypes:
+            entry_bytes = 4+np.dtype(dtype).itemsize
+            # one chunk of pairs, the pending COO pairs (up to the sums
+            # size plus a chunk) and their concatenation, the sums and
+            # their next version, then the sorted rows
+            pending = min(pair_ops, max(nnz, self.chunk_pairs)+chunk_pairs)
+            estimates.append({"strategy": "csr", "dtype": dtype,
+                              "peak_bytes": (chunk_pairs*self.csr_pair_bytes
+                                             + pending*(2*entry_bytes+4)
+                                             + nnz*(3*entry_bytes+16)),
+                              "seconds": pair_ops*self.csr_pair_seconds+nnz*self.csr_entry_seconds})
+        return estimates
+
+    @staticmethod
+    def memory_available():
+        """bytes the build may use: RECSYS_MEMORY_BYTES if set, else
+           the available memory of the machine
+        """
+        if os.environ.get("RECSYS_MEMORY_BYTES"):
+            return float(os.environ["RECSYS_MEMORY_BYTES"])
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        return float(line.split()[1])*1024
+        except OSError:
+            pass
+        return float(os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_AVPHYS_PAGES"))
+
+    def plan(self, strategy="auto", dtype="float32", memory_budget=None, time_budget=None):
+        """pick the build to run, or refuse before building
+
+        Parameters
+        ----------
+        strategy : [str]
+            [auto: the fastest build within the budgets, dict or csr:
+             that build only]
+        dtype : [str]
+            [values of the csr build, auto tries float32 then float64]
+        memory_budget : [float]
+            [bytes, see memory_available by default]
+        time_budget : [float]
+            [seconds, no limit by default]
+
+        Returns
+        -------
+        [dict]
+            [the chosen estimate, strategy, dtype, peak_bytes, seconds]
+        """
+        if strategy not in ("auto",)+self.strategies:
+            raise ValueError("Invalid sim build strategy: {}, must be auto or in {}".format(
+                strategy, self.strategies))
+        if dtype not in self.dtypes:
+            raise ValueError("Invalid sim build dtype: {}, must be in {}".format(dtype, self.dtypes))
+        memory_budget = memory_budget or self.memory_available()
+        candidates = [estimate for estimate in self.estimates()
+                      if strategy in ("auto", estimate["strategy"])
+                      and (estimate["strategy"] == "dict" or strategy == "auto"
+                           or estimate["dtype"] == dtype)]
+        fitting = [estimate for estimate in candidates
+                   if estimate["peak_bytes"] <= memory_budget
+                   and (time_budget is None or estimate["seconds"] <= time_budget)]
+        if fitting:
+            return min(fitting, key=lambda estimate: (estimate["seconds"], estimate["peak_bytes"]))
+        message = ["Refusing to build the similarity matrix: no{} build fits the budget of "
+                   "{:.2f} GB{}.".format("" if strategy == "auto" else " "+strategy,
+                                         memory_budget/1e9,
+                                         "" if time_budget is None else
+                                         " and {:.0f} s".format(time_budget)),
+                   "{:.3g} pair operations (max degree {}, sum of degree**2 {:.3g}), about "
+                   "{:.3g} sim entries.".format(self.stats["pair_ops"], self.stats["max_degree"],
+                                                self.stats["sum_degree_squared"],
+                                                self.stats["nnz"])]
+        message += ["  {} {}: peak {:.2f} GB, {:.0f} s".format(
+            estimate["strategy"], estimate["dtype"], estimate["peak_bytes"]/1e9,
+            estimate["seconds"]) for estimate in self.estimates()]
+        others = [estimate for estimate in self.estimates() if estimate not in candidates
+                  and estimate["peak_bytes"] <= memory_budget
+                  and (time_budget is None or estimate["seconds"] <= time_budget)]
+        if others:
+            message.append("The {0} {1} build fits, use build=\"{0}\", dtype=\"{1}\".".format(
+                others[0]["strategy"], others[0]["dtype"]))
+        else:
+            message.append("Raise the budget (memory_budget, RECSYS_MEMORY_BYTES) or "
+                           "subsample the heaviest users or items.")
+        raise ValueError("\n".join(message))
+
+    def chunks(self):
+        """(start, end, row_start, row_end) chunks of about chunk_pairs
+           (member, member) pairs: the groups start:end, or the rows
+           row_start:row_end of a single heavier group (row_end None
+           for whole groups)
+        """
+        squared = np.cumsum(self.degrees.astype(np.int64)**2)
+        start = 0
+        while start < len(self.degrees):
+            offset = squared[start-1] if start else 0
+            end = max(int(np.searchsorted(squared, offset+self.chunk_pairs, side="right")),
+                      start+1)
+            degree = int(self.degrees[start])
+            if degree**2 > self.chunk_pairs:
+                # a group of degree d is d*d pairs, split into row blocks
+                block = max(self.chunk_pairs//degree, 1)
+                for row_start in range(0, degree, block):
+                    yield start, end, row_start, min(row_start+block, degree)
+            else:
+                yield start, end, 0, None
+            start = end
+
+    @staticmethod
+    def merge(sums, pending):
+        """CSR sums plus the pending (rows, columns, values) chunks,
+           converted to CSR at once, duplicates summed
+        """
+        if not pending:
+            return sums
+        rows, columns, values = map(np.concatenate, zip(*pending))
+        return sums+sparse.csr_matrix((values, (rows, columns)), shape=sums.shape)
+
+    def build_csr(self, timestamp, dtype="float32", normalize=False):
+        """members x members similarity as sim CSR arrays of an
+           artifact (see base/Artifact.py), same values as the dict
+           build: every group adds 1/log(1+d), times the time decay of
+           the two members' timestamps with timestamp, normalize
+           divides by sqrt of the two members' degrees
+
+           the chunks of pairs are collected as COO and merged into the
+           sums once they outgrow them, every merge adds at least as
+           many pairs as the sums hold, so merging is O(pairs) in all,
+           not O(chunks x nnz)
+        """
+        n_members = len(self.members_id)
+        index_dtype = np.int32 if n_members < 2**31 else np.int64
+        sums = sparse.csr_matrix((n_members, n_members), dtype=dtype)
+        pending, n_pending = [], 0
+        for start, end, row_start, row_end in self.chunks():
+            degrees = self.degrees[start:end]
+            # every (a, b) position of every group (of the rows
+            # row_start:row_end of a split group), the diagonal dropped
+            rows = degrees if row_end is None else np.array([row_end-row_start])
+            positions = rows*degrees
+            group = np.repeat(np.arange(start, end), positions)
+            offset = np.arange(positions.sum())-np.repeat(np.cumsum(positions)-positions, positions)
+            a, b = np.divmod(offset, np.repeat(degrees, positions))
+            a += row_start
+            keep = a != b
+            group, a, b = group[keep], a[keep], b[keep]
+            a += self.indptr[group]
+            b += self.indptr[group]
+            values = 1/np.log1p(self.degrees[group].astype(np.float64))
+            if timestamp:
+                values *= Model.time_elapse(self.times[a], self.times[b])
+            pending.append((self.members[a].astype(index_dtype), self.members[b].astype(index_dtype),
+                            values.astype(dtype)))
+            n_pending += len(values)
+            if n_pending >= max(sums.nnz, self.chunk_pairs):
+                sums = self.merge(sums, pending)
+                pending, n_pending = [], 0
+        sim = self.merge(sums, pending)
+        sim.sum_duplicates()
+        if normalize:
+            member_degrees = np.bincount(self.members, minlength=n_members).astype(np.float64)
+            rows = np.repeat(np.arange(n_members), np.diff(sim.indptr))
+            sim.data /= np.sqrt(member_degrees[rows]*member_degrees[sim.indices]).astype(dtype)
+        return self.sorted_rows(sim)
+
+    def sorted_rows(self, sim):
+        """sim CSR arrays, rows sorted by decreasing float32 value,
+           members without similar members have no row
+        """
+        lengths = np.diff(sim.indptr)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        values = sim.data.astype(np.float32)
+        order = np.lexsort((self.members_id[sim.indices], -values, rows))
+        ids = self.members_id[lengths > 0]
+        return {"sim_ids": ids, "sim_order": np.argsort(ids, kind="stable"),
+                "sim_indptr": np.r_[0, np.cumsum(lengths[lengths > 0])],
+                "sim_indices": self.members_id[sim.indices[order]],
+                "sim_values": values[order]}
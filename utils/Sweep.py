@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import multiprocessing
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from run_model import build
+from models.Registry import Registry
+
+
+class Sweep:
+    """run many run_model configurations and collect one result table
+
+       configs differing only in serving parameters are grouped so
+       that data loading, similarity build, negative samples and
+       keras training happen once per group, the groups are
+       independent and run on a process pool
+    """
+    def __init__(self, configs, n_workers=None):
+        """
+        Parameters
+        ----------
+        configs : [list of dict]
+            [each dict holds model_type, data_type and run_model kwargs]
+        n_workers : [int]
+            [size of the process pool, default number of cpus]
+        """
+        self.configs = configs
+        self.n_workers = n_workers
+
+    @staticmethod
+    def grid(model_type, data_type, **param_lists):
+        """cartesian product of parameter lists as sweep configs"""
+        names = list(param_lists.keys())
+        configs = []
+        for values in product(*[param_lists[name] for name in names]):
+            config = {"model_type": model_type, "data_type": data_type}
+            config.update(zip(names, values))
+            configs.append(config)
+        return configs
+
+    def training_key(self, config):
+        """the config without its serving params, as a string since
+           values may be lists or dicts (e.g. Blend components)
+        """
+        serving = Registry.serving_params(config["model_type"])
+        return json.dumps({param: value for param, value in config.items()
+                           if param not in serving}, sort_keys=True, default=str)
+
+    def group_configs(self):
+        groups = {}
+        for config in self.configs:
+            groups.setdefault(self.training_key(config), []).append(config)
+        return list(groups.values())
+
+    @staticmethod
+    def run_group(configs):
+        """fit once, evaluate every serving config of the group
+
+           configs differing only in n are answered by one ranking
+           evaluation up to the largest n
+        """
+        model_type, data_type = configs[0]["model_type"], configs[0]["data_type"]
+        kwargs = {param: value for param, value in configs[0].items()
+                  if param not in ("model_type", "data_type")}
+        kwargs["n"] = max(config["n"] for config in configs)
+        start = time.time()
+        model, test_data = build(model_type, data_type, **kwargs)
+        fit_time = time.time()-start
+        by_serving = {}
+        for config in configs:
+            key = tuple(sorted((param, value) for param, value in config.items()
+                               if param in Registry.serving_params(model_type) and param != "n"))
+            by_serving.setdefault(key, []).append(config)
+        rows = []
+        for serving, group in by_serving.items():
+            for param, value in serving:
+                setattr(model, param, value)
+            max_n = max(config["n"] for config in group)
+            start = time.time()
+            result = model.evaluate_ranking(test_data, max_n)
+            eval_time = time.time()-start
+            for config in group:
+                row = dict(config)
+                row.update(result.loc[config["n"]].to_dict())
+                row["fit_time"], row["eval_time"] = fit_time, eval_time
+                rows.append(row)
+        return rows
+
+    def run(self, result_path=None):
+        groups = self.group_configs()
+        print("[Sweep] {} configs in {} training groups".format(len(self.configs), len(groups)))  # noqa
+        rows = []
+        # spawn, keras/tensorflow state is not fork safe
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.n_workers,
+                                 mp_context=context) as executor:
+            for group_rows in executor.map(Sweep.run_group, groups):
+                rows.extend(group_rows)
+        result = pd.DataFrame(rows)
+        if result_path is not None:
+            os.makedirs(os.path.dirname(result_path) or ".", exist_ok=True)
+            result.to_csv(result_path, index=False)
+        return result
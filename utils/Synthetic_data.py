@@ -0,0 +1,222 @@
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+OCCUPATIONS = ["administrator", "artist", "doctor", "educator", "engineer",
+               "entertainment", "executive", "healthcare", "homemaker", "lawyer",
+               "librarian", "marketing", "none", "other", "programmer", "retired",
+               "salesman", "scientist", "student", "technician", "writer"]
+N_GENRES = 19
+
+
+class Synthetic_data:
+    """generate a MovieLens like data set of any size
+
+       user activity and item popularity follow power laws, every user
+       is active over a random span inside the timestamp range, and
+       MovieLens style u.user/u.item side info files are written so that
+       Data_util and Feature_util read the folder like MovieLens_100K,
+       optionally every event also gets a Hetrec style tag id column
+    """
+    # MovieLens 100K time range and rating distribution
+    start_timestamp = 874724710
+    end_timestamp = 893286638
+    rating_probs = [0.061, 0.114, 0.271, 0.342, 0.212]
+    units = {"K": 10**3, "M": 10**6}
+
+    def __init__(self, n_events, n_users=None, n_items=None, tags=False,
+                 n_tags=None, user_alpha=0.5, item_alpha=0.8,
+                 min_user_events=20, seed=100):
+        """
+        Parameters
+        ----------
+        n_events : [int]
+            [number of events, every user-item pair occurs once]
+        n_users, n_items : [int]
+            [default to the MovieLens_100K ratio of events per user/item]
+        tags : [bool]
+            [add a tag id column to the events]
+        user_alpha, item_alpha : [float]
+            [power law exponents of user activity and item popularity]
+        min_user_events : [int]
+            [events every user gets before the power law part]
+        """
+        self.n_events = int(n_events)
+        self.n_users = int(n_users or max(10, self.n_events//106))
+        self.n_items = int(n_items or max(10, self.n_events//60))
+        self.tags = tags
+        self.n_tags = int(n_tags or max(10, self.n_items//10))
+        self.user_alpha = user_alpha
+        self.item_alpha = item_alpha
+        self.min_user_events = min(min_user_events, self.n_events//self.n_users)
+        self.seed = seed
+
+    @staticmethod
+    def parse_size(data_type):
+        """Synthetic_100K -> 100000, Synthetic_10M -> 10000000"""
+        size = data_type.split("_", 1)[1]
+        if size[-1] not in Synthetic_data.units:
+            raise ValueError("Synthetic data size must end with K or M, got {}".format(size))  # noqa
+        return int(float(size[:-1])*Synthetic_data.units[size[-1]])
+
+    @classmethod
+    def from_data_type(cls, data_type, **kwargs):
+        return cls(cls.parse_size(data_type), **kwargs)
+
+    @staticmethod
+    def power_law(n, alpha, rng):
+        """probabilities of n objects following a power law,
+           shuffled so that popularity is not correlated with id
+        """
+        weights = np.arange(1, n+1, dtype=np.float64)**-alpha
+        rng.shuffle(weights)
+        return weights/weights.sum()
+
+    def sample_user_items(self, user_counts, item_probs, rng, max_rounds=10):
+        """draw user_counts[u] distinct items for every user u,
+           a user rates an item once as in MovieLens, so repeated
+           pairs are dropped and redrawn for a few rounds
+        """
+        visitorid = np.zeros(0, dtype=np.int64)
+        itemid = np.zeros(0, dtype=np.int64)
+        missing = user_counts
+        for round in range(max_rounds):
+            new_visitorid = np.repeat(np.arange(1, self.n_users+1), missing)
+            # heavy users saturate the popular items, the last rounds
+            # draw uniformly to fill them up
+            probs = item_probs if round < max_rounds-3 else None
+            new_itemid = rng.choice(self.n_items, size=len(new_visitorid), p=probs)+1
+            visitorid = np.concatenate([visitorid, new_visitorid])
+            itemid = np.concatenate([itemid, new_itemid])
+            pairs = np.unique(visitorid*(self.n_items+1)+itemid)
+            visitorid, itemid = pairs//(self.n_items+1), pairs % (self.n_items+1)
+            missing = user_counts-np.bincount(visitorid-1, minlength=self.n_users)
+            if missing.sum() == 0:
+                break
+        return visitorid, itemid
+
+    def generate_events(self):
+        rng = np.random.default_rng(self.seed)
+        # events per user: a minimum plus a power law share of the rest
+        user_probs = self.power_law(self.n_users, self.user_alpha, rng)
+        n_rest = self.n_events-self.min_user_events*self.n_users
+        user_counts = self.min_user_events+rng.multinomial(n_rest, user_probs)
+        user_counts = np.minimum(user_counts, self.n_items)
+        item_probs = self.power_law(self.n_items, self.item_alpha, rng)
+        visitorid, itemid = self.sample_user_items(user_counts, item_probs, rng)
+        # every user is active over a random span of the time range
+        t_range = self.end_timestamp-self.start_timestamp
+        user_start = rng.uniform(self.start_timestamp, self.end_timestamp, self.n_users)
+        user_span = np.minimum(rng.exponential(t_range/8, self.n_users),
+                               self.end_timestamp-user_start)
+        timestamp = (user_start[visitorid-1] +
+                     rng.uniform(0, 1, len(visitorid))*user_span[visitorid-1])
+        events = pd.DataFrame({"visitorid": visitorid, "itemid": itemid,
+                               "rating": rng.choice(np.arange(1, 6), size=len(visitorid),
+                                                    p=self.rating_probs),
+                               "timestamp": timestamp.astype(np.int64)})
+        if self.tags:
+            # half of the tags follow the item's main tag, the rest a power law
+            main_tag = rng.choice(self.n_tags, size=self.n_items,
+                                  p=self.power_law(self.n_tags, 1.0, rng))
+            random_tag = rng.choice(self.n_tags, size=len(events),
+                                    p=self.power_law(self.n_tags, 1.0, rng))
+            use_main = rng.uniform(0, 1, len(events)) < 0.5
+            events["tagid"] = np.where(use_main, main_tag[itemid-1], random_tag)+1
+        return events
+
+    def generate_users_info(self):
+        rng = np.random.default_rng(self.seed+1)
+        return pd.DataFrame({
+            "visitorid": np.arange(1, self.n_users+1),
+            "age": rng.integers(7, 74, self.n_users),
+            "gender": rng.choice(["M", "F"], size=self.n_users, p=[0.71, 0.29]),
+            "occupation": rng.choice(OCCUPATIONS, size=self.n_users),
+            "zip_code": ["{:05d}".format(z) for z in rng.integers(0, 100000, self.n_users)]})  # noqa
+
+    def generate_items_info(self):
+        rng = np.random.default_rng(self.seed+2)
+        itemid = np.arange(1, self.n_items+1)
+        release = pd.to_datetime(rng.integers(pd.Timestamp("1922-01-01").value//10**9,
+                                              pd.Timestamp("1998-12-31").value//10**9,
+                                              self.n_items), unit="s")
+        release_date = pd.Series(release.strftime("%d-%b-%Y"))
+        # a few items without release date, as item 267 of MovieLens
+        release_date[rng.uniform(0, 1, self.n_items) < 0.001] = ""
+        info = pd.DataFrame({"itemid": itemid,
+                             "title": ["Item {}".format(i) for i in itemid],
+                             "release_date": release_date,
+                             "video_release_date": "",
+                             "URL": ""})
+        # 1 to 3 genres per item
+        genres = np.zeros((self.n_items, N_GENRES), dtype=np.int64)
+        n_genres = rng.integers(1, 4, self.n_items)
+        for k in range(3):
+            picked = rng.integers(0, N_GENRES, self.n_items)
+            genres[(n_genres > k).nonzero()[0], picked[n_genres > k]] = 1
+        for genre in range(N_GENRES):
+            info["genre_{}".format(genre)] = genres[:, genre]
+        return info
+
+    @staticmethod
+    def write_table(data, path, sep):
+        # to_csv only supports single char separators, write tab
+        # separated chunks and replace the separator
+        with open(path, "w") as f:
+            for start in range(0, len(data), 10**6):
+                chunk = data.iloc[start:start+10**6].to_csv(sep="\t", header=False,
+                                                            index=False)
+                f.write(chunk if sep == "\t" else chunk.replace("\t", sep))
+
+    def write(self, data_type, data_dir="data", replace=True):
+        """write ratings.dat, u.user, u.item and u.info under data_dir/data_type
+
+           files are generated into a hidden temporary folder renamed
+           into place once complete, so an interrupted generation never
+           leaves a truncated data set behind; a data set another process
+           renamed into place meanwhile (e.g. sweep or cross validation
+           workers generating it on first use) is kept and ours dropped
+
+        Parameters
+        ----------
+        replace : [bool]
+            [remove a previous generation first, False to keep it]
+        """
+        folder = os.path.join(data_dir, data_type)
+        os.makedirs(data_dir, exist_ok=True)
+        tmp_folder = tempfile.mkdtemp(prefix=".{}-".format(data_type), dir=data_dir)
+        print("[{}] Generating {} events for {} users and {} items...".format(
+            data_type, self.n_events, self.n_users, self.n_items))
+        try:
+            events = self.generate_events()
+            # same separator rule as Data_util: ..K tab, ..M '::'
+            sep = "::" if data_type[-1] == "M" else "\t"
+            self.write_table(events, os.path.join(tmp_folder, "ratings.dat"), sep)
+            self.write_table(self.generate_users_info(), os.path.join(tmp_folder, "u.user"), "|")
+            self.write_table(self.generate_items_info(), os.path.join(tmp_folder, "u.item"), "|")
+            with open(os.path.join(tmp_folder, "u.info"), "w") as f:
+                f.write("{} users\n{} items\n{} ratings\n".format(
+                    self.n_users, self.n_items, len(events)))
+            if replace:
+                shutil.rmtree(folder, ignore_errors=True)
+            try:
+                os.replace(tmp_folder, folder)
+            except OSError:
+                # fails on an existing non empty folder
+                if not os.path.isdir(folder):
+                    raise
+                print("[{}] Generated meanwhile by another process, kept".format(data_type))
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            raise
+        print("[{}] {} events written to {}".format(data_type, len(events), folder))
+        return folder
+
+if __name__ == "__main__":
+    # python -m utils.Synthetic_data Synthetic_10M [tags]
+    data_type = sys.argv[1] if len(sys.argv) > 1 else "Synthetic_100K"
+    Synthetic_data.from_data_type(data_type, tags="tags" in sys.argv).write(data_type)
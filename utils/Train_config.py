@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import inspect
+import tempfile
+import contextlib
+import multiprocessing
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import keras
+import tensorflow as tf
+
+
+class Epoch_timer(keras.callbacks.Callback):
+    """wall time and loss of every epoch"""
+    def __init__(self):
+        super().__init__()
+        self.seconds, self.losses = [], []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.seconds.append(time.perf_counter()-self.start)
+        self.losses.append(float((logs or {}).get("loss", np.nan)))
+
+
+def trial_worker(model_type, data_type, config, epochs, steps_per_epoch, run_kwargs):
+    """fit the model for a few short epochs with the config in a fresh
+       process, the thread pools of tensorflow can only be set before
+       its first op; fitted files go to a throwaway cache, removed
+       once the trial's metrics are collected
+    """
+    from base.Model import Model
+    from run_model import fit_model
+    from utils.Data_util import Data_util
+    config = Train_config(**config)
+    timer = Epoch_timer()
+    config.epochs, config.steps_per_epoch, config.callbacks = epochs, steps_per_epoch, [timer]
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        DU = Data_util(data_type)
+        train_data, _ = DU.read_event_data()
+        with tempfile.TemporaryDirectory(prefix="autotune_") as saved_models_dir:
+            Model.saved_models_dir = saved_models_dir
+            model = fit_model(model_type, data_type, DU, train_data, train_config=config, **run_kwargs)
+            batch_size = config.training_batch_size(model.base_batch_size())
+    return {"seconds": timer.seconds, "losses": timer.losses, "batch_size": batch_size}
+
+
+class Train_config:
+    """CPU training performance settings of the keras models (LFM
+       and Wide&Deep): tensorflow thread pools, XLA compilation, batch
+       size with learning rate scaling and deterministic ops
+
+       defaults keep tensorflow's choices and the model's own batch
+       size, a tuned config is persisted per data set and model by
+       autotune and read back with Train_config.load
+    """
+    # persisted tuned configs, <data_type>_<model_type>.json
+    configs_dir = "models/train_configs"
+    lr_scalings = ("linear", "sqrt", "none")
+    fields = ("intra_op_threads", "inter_op_threads", "jit_compile", "batch_size",
+              "lr_scaling", "deterministic", "seed")
+
+    def __init__(self, intra_op_threads=None, inter_op_threads=None, jit_compile=False,
+                 batch_size=None, lr_scaling="linear", deterministic=False, seed=100):
+        """
+        Parameters
+        ----------
+        intra_op_threads, inter_op_threads : [int]
+            [tensorflow thread pool sizes, None lets tensorflow pick]
+        jit_compile : [bool]
+            [compile the train step with XLA]
+        batch_size : [int]
+            [training batch size, None keeps the model's batch_size]
+        lr_scaling : [str]
+            [learning rate scaling with batch_size/model batch size:
+             linear, sqrt or none]
+        deterministic : [bool]
+            [seed python, numpy and tensorflow and use deterministic
+             ops, slower on some kernels]
+        """
+        if lr_scaling not in self.lr_scalings:
+            raise ValueError("Invalid lr scaling: {}, must be in {}".format(
+                lr_scaling, self.lr_scalings))
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.jit_compile = jit_compile
+        self.batch_size = batch_size
+        self.lr_scaling = lr_scaling
+        self.deterministic = deterministic
+        self.seed = seed
+        # short autotune trials only, never persisted
+        self.epochs = None
+        self.steps_per_epoch = None
+        self.callbacks = []
+
+    @classmethod
+    def create(cls, config, data_type, model_type):
+        """Train_config from a model's train_config parameter: None
+           (defaults), a dict of fields, "tuned" (the persisted config
+           of the data set and model, defaults if none) or a config
+        """
+        if config is None:
+            return cls()
+        if isinstance(config, cls):
+            return config
+        if isinstance(config, dict):
+            return cls(**config)
+        if config == "tuned":
+            return cls.load(data_type, model_type) or cls()
+        raise ValueError("Invalid train config: {}, must be None, a dict, \"tuned\" or a "
+                         "Train_config".format(config))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def name_suffix(self, batch_size):
+        """suffix of the model name, only batch size changes the
+           trained model (learning rate follows it)
+        """
+        if self.batch_size is None or self.batch_size == batch_size:
+            return ""
+        return "_bs_{}_{}".format(self.batch_size, self.lr_scaling)
+
+    def apply(self):
+        """set the thread pools and determinism, before the first
+           tensorflow op of the process
+        """
+        try:
+            if self.intra_op_threads is not None:
+                tf.config.threading.set_intra_op_parallelism_threads(self.intra_op_threads)
+            if self.inter_op_threads is not None:
+                tf.config.threading.set_inter_op_parallelism_threads(self.inter_op_threads)
+        except RuntimeError as E:
+            # the runtime is already initialized, pools stay as they are
+            print("[train_config] Thread pools not set: {}".format(E))
+        if self.deterministic:
+            tf.keras.utils.set_random_seed(self.seed)
+            tf.config.experimental.enable_op_determinism()
+
+    def training_batch_size(self, batch_size):
+        return self.batch_size or batch_size
+
+    def learning_rate(self, learning_rate, batch_size):
+        """learning_rate tuned for the model's batch_size, scaled to
+           the training batch size
+        """
+        ratio = self.training_batch_size(batch_size)/batch_size
+        if self.lr_scaling == "linear":
+            return learning_rate*ratio
+        if self.lr_scaling == "sqrt":
+            return learning_rate*np.sqrt(ratio)
+        return learning_rate
+
+    def compile_kwargs(self):
+        return {"jit_compile": self.jit_compile}
+
+    def fit_kwargs(self, epochs):
+        """model.fit kwargs, epochs unless shortened by a trial"""
+        kwargs = {"epochs": self.epochs or epochs, "callbacks": list(self.callbacks)}
+        if self.steps_per_epoch:
+            kwargs["steps_per_epoch"] = self.steps_per_epoch
+        return kwargs
+
+    @classmethod
+    def path(cls, data_type, model_type):
+        return os.path.join(cls.configs_dir, "{}_{}.json".format(data_type, model_type))
+
+    def save(self, data_type, model_type, trials=None):
+        os.makedirs(self.configs_dir, exist_ok=True)
+        path = self.path(data_type, model_type)
+        with open(path+".tmp", "w") as f:
+            json.dump({"config": self.to_dict(), "trials": trials or []}, f, indent=2)
+        os.replace(path+".tmp", path)
+
+    @classmethod
+    def load(cls, data_type, model_type):
+        """the persisted config, None if the model was never tuned"""
+        try:
+            with open(cls.path(data_type, model_type)) as f:
+                return cls(**json.load(f)["config"])
+        except OSError:
+            return None
+
+    @staticmethod
+    def grid(**field_lists):
+        """cartesian product of field lists as config dicts"""
+        names = list(field_lists)
+        return [dict(zip(names, values))
+                for values in product(*[field_lists[name] for name in names])]
+
+    @classmethod
+    def default_grid(cls, batch_size):
+        n_cores = os.cpu_count() or 1
+        return cls.grid(intra_op_threads=sorted({n_cores, max(n_cores//2, 1)}),
+                        inter_op_threads=[1, 2], jit_compile=[False, True],
+                        batch_size=[batch_size, 4*batch_size])
+
+    @classmethod
+    def autotune(cls, model_type, data_type, configs=None, epochs=3, steps_per_epoch=50,
+                 max_loss_ratio=1.5, **run_kwargs):
+        """time short training runs of every config and persist the
+           fastest stable one for the data set and model
+
+        Parameters
+        ----------
+        configs : [list of dict]
+            [Train_config fields of the trials, default_grid of the
+             model's default batch size by default]
+        epochs, steps_per_epoch : [int]
+            [trial length, the first epoch (tracing, XLA compilation)
+             is not timed]
+        max_loss_ratio : [float]
+            [a trial is stable when its losses are finite and the last
+             one is at most max_loss_ratio times the first]
+        run_kwargs : [dict]
+            [run_model kwargs of the model, e.g. n and neg_frac]
+
+        Returns
+        -------
+        [Train_config]
+            [the persisted config]
+        """
+        from models.Registry import Registry
+        if configs is None:
+            model_cls = Registry.model_class(model_type)
+            batch_size = inspect.signature(model_cls).parameters["batch_size"].default
+            configs = cls.default_grid(run_kwargs.get("batch_size", batch_size))
+        trials = []
+        # one fresh process per trial for its thread pools, one trial
+        # at a time so trials do not compete for the cores
+        context = multiprocessing.get_context("spawn")
+        for config in configs:
+            config = cls(**config).to_dict()
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                trial = executor.submit(trial_worker, model_type, data_type, config, epochs,
+                                        steps_per_epoch, run_kwargs).result()
+            # the first epoch traces and compiles
+            timed = trial["seconds"][1:] or trial["seconds"]
+            losses = np.array(trial["losses"])
+            stable = bool(np.isfinite(losses).all() and losses[-1] <= max_loss_ratio*losses[0])
+            trials.append(dict(config, stable=stable, losses=trial["losses"],
+                               examples_per_second=steps_per_epoch*trial["batch_size"]/float(np.median(timed))))
+            print("[train_config] {} {}: {:.0f} examples/s, losses {}{}".format(
+                model_type, config, trials[-1]["examples_per_second"],
+                " ".join("{:.4f}".format(loss) for loss in trial["losses"]),
+                "" if stable else ", unstable"))
+        stable_trials = [trial for trial in trials if trial["stable"]]
+        if not stable_trials:
+            raise ValueError("No stable train config of {} on {} among {} trials, lower the "
+                             "batch sizes or use lr_scaling sqrt".format(model_type, data_type,
+                                                                        len(trials)))
+        best = max(stable_trials, key=lambda trial: trial["examples_per_second"])
+        config = cls(**{field: best[field] for field in cls.fields})
+        config.save(data_type, model_type, trials)
+        print("[train_config] {} on {}: {} saved to {}".format(
+            model_type, data_type, config.to_dict(), cls.path(data_type, model_type)))
+        return config
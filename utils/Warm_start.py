@@ -0,0 +1,117 @@
+import os
+import json
+import numpy as np
+import keras
+from .Instrument import Instrument
+
+
+class Epoch_checkpoint(keras.callbacks.Callback):
+    """saves the model (weights and optimizer state) and the number of
+       finished epochs after every epoch, both written aside and
+       renamed into place, so an interrupted run resumes from the last
+       finished epoch
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def on_epoch_end(self, epoch, logs=None):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, "model.tmp.h5")
+        self.model.save(tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, "model.h5"))
+        Warm_start.write_state(self.path, {"epoch": epoch+1})
+
+
+class Warm_start:
+    """helpers to update a fitted keras model with new events: grow
+       its embedding tables, mix new samples with a replay sample of
+       old ones, and train a few epochs with resumable checkpoints
+    """
+    @staticmethod
+    def read_state(path):
+        try:
+            with open(os.path.join(path, "state.json")) as f:
+                return json.load(f)
+        except OSError:
+            return {"epoch": 0}
+
+    @staticmethod
+    def write_state(path, state):
+        tmp_path = os.path.join(path, "state.tmp.json")
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, os.path.join(path, "state.json"))
+
+    @staticmethod
+    def grow_weights(old_model, new_model):
+        """copy the weights of old_model into new_model, layers are
+           matched by name and may have more rows in new_model (larger
+           embedding tables), the extra rows keep their initialization
+        """
+        for layer in new_model.layers:
+            old_weights = old_model.get_layer(layer.name).get_weights()
+            weights = layer.get_weights()
+            for i, old in enumerate(old_weights):
+                if old.shape[1:] != weights[i].shape[1:] or len(old) > len(weights[i]):
+                    raise ValueError("Cannot grow weights of layer {}: {} -> {}".format(
+                        layer.name, old.shape, weights[i].shape))
+                weights[i][:len(old)] = old
+            layer.set_weights(weights)
+
+    @staticmethod
+    def csr(rows, cols, n_rows, n_cols):
+        """CSR arrays (indptr, indices) of the unique (row, col) pairs"""
+        keys = np.unique(np.asarray(rows, dtype=np.int64)*n_cols+np.asarray(cols))
+        rows, cols = np.divmod(keys, max(n_cols, 1))
+        indptr = np.r_[0, np.cumsum(np.bincount(rows, minlength=n_rows))].astype(np.int64)
+        return indptr, cols
+
+    @staticmethod
+    def replay_sample(indptr, indices, n, seed):
+        """(rows, cols) of n entries of a CSR drawn uniformly without
+           replacement
+        """
+        rows = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+        rng = np.random.default_rng(seed)
+        positions = np.sort(rng.choice(len(rows), size=min(n, len(rows)), replace=False))
+        return rows[positions], np.asarray(indices)[positions]
+
+    @staticmethod
+    def seed(key):
+        """integer seed of a cache key, a resumed run draws the same
+           replay sample
+        """
+        return int(key[:8], 16)
+
+    @staticmethod
+    def train(model, data, epochs, path, load_model, **fit_kwargs):
+        """fit for epochs, resuming from the checkpoint at path left by
+           an interrupted run
+
+        Parameters
+        ----------
+        data : [tf.data.Dataset or keras.utils.Sequence]
+            [training data, a Sequence is advanced to the resumed epoch]
+        path : [str]
+            [checkpoint directory]
+        load_model : [function]
+            [loads the checkpointed .h5 model]
+
+        Returns
+        -------
+        [keras model]
+            [the trained model]
+        """
+        state = Warm_start.read_state(path)
+        if state["epoch"] > 0:
+            model = load_model(os.path.join(path, "model.h5"))
+            print("[Warm_start] Checkpoint found, resuming from epoch {}".format(state["epoch"]))
+            if hasattr(data, "on_epoch_end"):
+                for _ in range(state["epoch"]):
+                    data.on_epoch_end()
+        if state["epoch"] < epochs:
+            with Instrument.stage("train"):
+                model.fit(data, epochs=epochs, initial_epoch=state["epoch"],
+                          callbacks=[Epoch_checkpoint(path)], **fit_kwargs)
+        return model